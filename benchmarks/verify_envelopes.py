@@ -0,0 +1,39 @@
+#coding: utf-8
+u'''
+Замер масштабирования пакетной проверки подписей (signer.verify_envelopes)
+в зависимости от количества процессов.
+
+Запуск::
+
+    PYTHONPATH=. python benchmarks/verify_envelopes.py [количество сообщений]
+'''
+
+import sys
+import time
+import multiprocessing
+
+from lxml import etree
+
+from libsmev.signer import verify_envelopes, SignerError
+from libsmev.test_libsmev import TEST_ENVELOPE
+
+
+def main(count=400):
+    envelopes = [etree.fromstring(TEST_ENVELOPE) for _ in range(count)]
+
+    workers = 1
+    baseline = None
+    while workers <= multiprocessing.cpu_count():
+        started = time.time()
+        results = list(verify_envelopes(envelopes, workers=workers, chunksize=8))
+        elapsed = time.time() - started
+        baseline = baseline or elapsed
+
+        errors = len([r for r in results if isinstance(r, SignerError)])
+        print '%3d workers: %8.1f envelopes/s, speedup x%.2f, errors: %d' % (
+            workers, count / elapsed, baseline / elapsed, errors)
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
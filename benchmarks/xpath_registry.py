@@ -0,0 +1,107 @@
+#coding: utf-8
+u'''
+Сравнение времени выборки элементов сообщения СМЭВ строковыми
+XPath-выражениями (doc.xpath) и скомпилированными выражениями
+из реестра helpers.compile_xpath, а также выборки из нескольких потоков
+общими для потоков объектами etree.XPath (lxml блокирует объект на время
+вычисления) и реестрами compile_xpath, у каждого потока своими.
+
+Набор выражений соответствует выборкам, выполняемым при подписании
+(signer.sign_document) и разборе контекста сообщения
+(skeleton.extract_context_from_envelope).
+
+Запуск::
+
+    PYTHONPATH=. python benchmarks/xpath_registry.py [количество повторов]
+'''
+
+import sys
+import time
+import timeit
+import threading
+import multiprocessing
+
+from lxml import etree
+
+from libsmev.helpers import tags
+from libsmev.namespaces import NS_MAP
+from libsmev.test_libsmev import TEST_ENVELOPE
+
+SECURITY = '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security'
+SIGNED_INFO = SECURITY + '/ds:Signature/ds:SignedInfo'
+
+PATHS = [
+    '/SOAP-ENV:Envelope/SOAP-ENV:Header',
+    SECURITY,
+    '/SOAP-ENV:Envelope/SOAP-ENV:Body',
+    SIGNED_INFO + '/ds:Reference',
+    SIGNED_INFO + '/ds:Reference/ds:DigestValue',
+    SIGNED_INFO,
+    SECURITY + '/ds:Signature/ds:SignatureValue',
+] + ['.//smev:%s/smev:%s' % (node, field)
+     for node in ('Sender', 'Originator', 'Recipient')
+     for field in ('Code', 'Name')] + [
+    './/smev:Service/smev:Mnemonic',
+    './/smev:Service/smev:Version',
+    './/smev:Status',
+    './/smev:TypeCode',
+    './/smev:TestMsg',
+]
+
+
+def raw(envelope):
+    for path in PATHS:
+        envelope.xpath(path, namespaces=NS_MAP)
+
+
+def compiled(envelope):
+    for path in PATHS:
+        tags(envelope, path)
+
+
+# Общий для потоков реестр
+SHARED = dict((path, etree.XPath(path, namespaces=NS_MAP)) for path in PATHS)
+
+
+def shared(envelope):
+    for path in PATHS:
+        SHARED[path](envelope)
+
+
+def run_threads(func, threads, number):
+    u'''
+    Время выборки number сообщений в каждом из threads потоков (у каждого
+    потока свое сообщение).
+    '''
+    def run():
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        for _ in xrange(number):
+            func(envelope)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - started
+
+
+def main(number=2000):
+    envelope = etree.fromstring(TEST_ENVELOPE)
+
+    for name, func in (('doc.xpath', raw), ('compiled', compiled)):
+        elapsed = timeit.timeit(lambda: func(envelope), number=number)
+        print '%-10s %8.1f us per envelope (%d expressions)' % (
+            name, elapsed / number * 1e6, len(PATHS))
+
+    threads = max(multiprocessing.cpu_count(), 2)
+    print
+    print '%d threads:' % threads
+    for name, func in (('shared', shared), ('per-thread', compiled)):
+        elapsed = run_threads(func, threads, number)
+        print '%-10s %8.1f envelopes/s' % (name, threads * number / elapsed)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -2,15 +2,27 @@
 
 import base64
 import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
 import tempfile
+from tempfile import SpooledTemporaryFile
 import uuid
+import multiprocessing
+from itertools import imap, izip
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from zipfile import ZipFile
 from StringIO import StringIO
 from mimetypes import types_map as mime_types_map
 from lxml import etree
 
-from signer import get_file_digest, get_text_digest
-from helpers import make_node, dict_to_xmldoc, parse_xml_string
+import signer
+from signer import get_file_digest, get_file_digests, get_text_digest, FILE_CHUNK_SIZE
+from helpers import make_node, dict_to_xmldoc, parse_xml_string, tags
+from streaming import BinaryDataSource, BinaryDataFile, _Base64Decoder, SPOOL_MAX_SIZE
 
 
 class InvalidManifestException(Exception):
@@ -21,67 +33,297 @@ class InvalidFileDigestException(Exception):
     pass
 
 
-def encode_directory(directory):
+# Кэш хэш-кодов файлов, см. configure_digest_cache
+_digest_cache = None
+
+
+class DigestCache(object):
     u'''
-    Преобразование содержимого папки и её структуры в вид, пригодный для присоединения
-    к СМЭВ-сообщению согласно МР 2.4.4-2.5.6.
+    Постоянный кэш хэш-кодов файлов по ГОСТ Р 34.11-94 в базе SQLite.
+
+    Для каждого пути хранится одна запись с размером, временем изменения,
+    номером inode и контрольной суммой SHA-1 файла, хэш-коды хранятся
+    отдельно по контрольной сумме и размеру. Запись файла находится по
+    его атрибутам; при включенной проверке содержимого (check_content)
+    совпадение подтверждается контрольной суммой, которая вычисляется
+    на порядки быстрее ГОСТ Р 34.11-94. Для файла без записи (или с
+    изменившимся содержимым) хэш-код ищется по контрольной сумме, поэтому
+    файлы с одинаковым содержимым по разным путям получают его из одной
+    записи, не вытесняя записи друг друга.
+
+    Базу могут одновременно использовать несколько процессов. Количество
+    записей ограничено max_entries, при превышении удаляются записи,
+    которые дольше всего не использовались.
+
+    :param unicode path: Путь к файлу базы.
+    :param int max_entries: Максимальное количество записей.
+    :param bool check_content: Проверка содержимого файла по контрольной сумме.
+    :param float timeout: Время ожидания блокировки базы другим процессом.
+    '''
 
-    Результатом выполнения будет кортеж с уникальным GUID кодом (поле заголовка RequestCode)
-    и закодированный в base64 ZIP-архив с манифестом, файлами директории и соответствующими
-    файлами подписей.
+    def __init__(self, path, max_entries=10000, check_content=True, timeout=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.check_content = check_content
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        u'''
+        Соединение с базой для текущего потока (и процесса).
+        '''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                'inode INTEGER, checksum TEXT, used REAL)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS digests ('
+                'checksum TEXT, size INTEGER, digest TEXT, used REAL, '
+                'PRIMARY KEY (checksum, size))')
+            for table in ('files', 'digests'):
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS %s_used ON %s (used)' % (table, table))
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _checksum(path_to_file):
+        hasher = hashlib.sha1()
+        with open(path_to_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(FILE_CHUNK_SIZE), ''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def get_file_digest(self, path_to_file):
+        u'''
+        Получение хэш-кода файла из кэша или его вычисление
+        (см. signer.get_file_digest).
+
+        :param unicode path_to_file: Путь к файлу.
+        :return: Закодированный в base64 хэш-код файла.
+        :rtype: unicode
+        '''
+        stat = os.stat(path_to_file)
+        path_to_file = os.path.abspath(path_to_file)
+        connection = self._connect()
+        now = time.time()
+
+        row = connection.execute(
+            'SELECT files.checksum, digests.digest FROM files JOIN digests '
+            'ON digests.checksum = files.checksum AND digests.size = files.size '
+            'WHERE files.path = ? AND files.size = ? AND files.mtime = ? AND files.inode = ?',
+            (path_to_file, stat.st_size, stat.st_mtime, stat.st_ino)).fetchone()
+        checksum = None
+        if row:
+            if not self.check_content:
+                checksum, dgst = row
+            else:
+                checksum = self._checksum(path_to_file)
+                # Содержимое изменилось без изменения атрибутов
+                dgst = row[1] if checksum == row[0] else None
+            if dgst is not None:
+                connection.execute('UPDATE files SET used = ? WHERE path = ?',
+                                   (now, path_to_file))
+                connection.execute('UPDATE digests SET used = ? WHERE checksum = ? AND size = ?',
+                                   (now, checksum, stat.st_size))
+                # SQLite возвращает unicode, хэш-код в base64 - ASCII-строка
+                return str(dgst)
+
+        if checksum is None:
+            checksum = self._checksum(path_to_file)
+        row = connection.execute(
+            'SELECT digest FROM digests WHERE checksum = ? AND size = ?',
+            (checksum, stat.st_size)).fetchone()
+        dgst = str(row[0]) if row else get_file_digest(path_to_file)
+
+        connection.execute(
+            'INSERT OR REPLACE INTO digests (checksum, size, digest, used) VALUES (?, ?, ?, ?)',
+            (checksum, stat.st_size, dgst, now))
+        connection.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime, inode, checksum, used) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (path_to_file, stat.st_size, stat.st_mtime, stat.st_ino, checksum, now))
+        self._evict(connection)
+        return dgst
+
+    def _evict(self, connection):
+        for table in ('files', 'digests'):
+            connection.execute(
+                'DELETE FROM %s WHERE rowid IN ('
+                'SELECT rowid FROM %s ORDER BY used DESC LIMIT -1 OFFSET ?)' % (table, table),
+                (self.max_entries,))
+
+    def clear(self):
+        u'''
+        Удаление всех записей кэша.
+        '''
+        connection = self._connect()
+        connection.execute('DELETE FROM files')
+        connection.execute('DELETE FROM digests')
+
+
+def configure_digest_cache(path=None, **kwargs):
+    u'''
+    Включение постоянного кэша хэш-кодов файлов для encode_directory и
+    encode_directory_stream. Вызов без пути к базе отключает кэш.
+
+    :param unicode path: Путь к файлу базы SQLite.
+    :param kwargs: Дополнительные параметры DigestCache
+                   (max_entries, check_content, timeout).
+    :return: Созданный кэш или None.
+    :rtype: DigestCache
+    '''
+    global _digest_cache
+    _digest_cache = DigestCache(path, **kwargs) if path else None
+    return _digest_cache
 
-    ZIP-архив формируется в памяти.
 
-    :param  unicode directory:   Путь к папке, содержимое которой необходимо прикрепить.
-    :return: GUID и закодированный в base64 ZIP-архив.
-    :rtype:  (unicode, unicode)
+def _file_digests(path_to_file):
+    u'''
+    Хэш-коды файла и его подписи.
+    '''
+    if _digest_cache is not None:
+        dgst = _digest_cache.get_file_digest(path_to_file)
+    else:
+        dgst = get_file_digest(path_to_file)
+    return dgst, get_text_digest(dgst)
+
+
+def _use_batch_digests():
+    u'''
+    Вычислять ли хэш-коды файлов пакетно (get_file_digests): если
+    встроенная реализация хэш-функции не выбрана явно, а
+    криптографический модуль запускает внешние процессы. При
+    USE_BUILTIN_DIGEST = None небольшие файлы get_file_digests
+    обрабатывает встроенной реализацией.
+    '''
+    return signer.USE_BUILTIN_DIGEST is not True and not signer.get_crypto_backend().in_process
+
+
+def _batch_file_digests(paths):
+    u'''
+    Хэш-коды пакета файлов и их подписей в порядке следования файлов.
+    '''
+    file_digests = get_file_digests(paths)
+    return [(file_digests[fn], get_text_digest(file_digests[fn])) for fn in paths]
+
+
+def _iter_file_digests(paths, workers=1, pool=None):
+    u'''
+    Вычисление хэш-кодов файлов с выдачей результатов в порядке
+    следования файлов.
+
+    По умолчанию хэш-коды вычисляются последовательно. Переданный пул
+    (объект с методом imap, например multiprocessing.Pool) используется
+    без закрытия. Если workers больше 1 (None - по числу ядер), на время
+    вычисления запускается пул: процессов для встроенной реализации
+    хэш-функции, потоков - для криптографического модуля. Если кэш
+    хэш-кодов не используется, а криптографический модуль запускает
+    внешние процессы, хэш-коды файлов вычисляются пакетно
+    (get_file_digests): файлы делятся на пакеты по числу исполнителей.
+    '''
+    batch = _use_batch_digests() and _digest_cache is None and len(paths) > 1
+    if batch:
+        parts = (workers if pool is None else None) or multiprocessing.cpu_count()
+        size = -(-len(paths) // parts)
+        func, items = _batch_file_digests, [paths[i:i + size] for i in xrange(0, len(paths), size)]
+    else:
+        func, items = _file_digests, paths
+
+    own_pool = None
+    if pool is not None:
+        results = pool.imap(func, items)
+    elif workers == 1 or len(items) < 2:
+        results = imap(func, items)
+    else:
+        if signer.USE_BUILTIN_DIGEST:
+            own_pool = multiprocessing.Pool(workers)
+        else:
+            own_pool = ThreadPool(workers or multiprocessing.cpu_count())
+        results = own_pool.imap(func, items)
+
+    try:
+        for result in results:
+            if batch:
+                for digests in result:
+                    yield digests
+            else:
+                yield result
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+            own_pool.join()
+
+
+def _write_directory_archive(directory, output, workers=1, pool=None):
+    u'''
+    Запись ZIP-архива с манифестом, файлами папки и файлами их подписей.
+
+    Хэш-коды файлов могут вычисляться в пуле исполнителей, архив и манифест
+    формируются в текущем потоке по мере готовности хэш-кодов в порядке
+    обхода папки, поэтому результат не зависит от количества исполнителей.
+
+    :param unicode directory: Путь к папке.
+    :param output: Файловый объект, в который записывается архив.
+    :param int workers: Размер запускаемого пула (по умолчанию - последовательное
+                        вычисление, None - по числу ядер).
+    :param pool: Используемый пул (объект с методом imap).
+    :return: GUID (код запроса).
+    :rtype: unicode
     '''
     # Генерируем код запроса
     request_code = str(uuid.uuid4())
     i = 1
 
-    in_memory_file = StringIO()
-    zip_arc = ZipFile(in_memory_file, 'w')
+    zip_arc = ZipFile(output, 'w', allowZip64=True)
 
-    applied_documents_node = make_node('AppliedDocuments')
-    for (path, subdirs, files) in os.walk(directory):
-        for fn in files:
+    files = []
+    for (path, subdirs, filenames) in os.walk(directory):
+        for fn in filenames:
             path_to_file = os.path.join(path, fn).replace('\\', '/').replace('\\\\', '/')
-            relative_path = path_to_file[len(directory):].lstrip('/')
-            dgst = get_file_digest(path_to_file)
-            dot_pos = fn.find('.')
-
-            applied_documents = [
-                {
-                    'URL': relative_path,
-                    'Name': fn,
-                    'DigestValue': dgst,
-                    # Пытаемся определить MIME-тип файла, но если нет - бинарный файл.
-                    'Type': mime_types_map.get(fn[dot_pos:], 'application/octet-stream'),
-                    # TODO: выяснить правила генерации кода документа
-                    'CodeDocument': u'0000',
-                    'Number': i,
-                },
-                # Файл с подписью по PKCS/7
-                {
-                    'URL': u'%s%s' % (relative_path, '.sig'),
-                    'Name': u'%s.sig' % fn,
-                    'DigestValue': get_text_digest(dgst),
-                    'Type': 'application/x-pkcs7-signature',
-                    'CodeDocument': u'0000',
-                    'Number': i + 1,
-                }]
-
-            i += 2
-
-            for doc in applied_documents:
-                app_doc_node = make_node('AppliedDocument')
-                dict_to_xmldoc(app_doc_node, doc)
-                applied_documents_node.append(app_doc_node)
-
-            # Добавляем в ZIP-архив файл и его подпись
-            zip_arc.write(path_to_file, arcname=relative_path)
-            zip_arc.writestr('%s.sig' % relative_path, dgst)
+            files.append((fn, path_to_file, path_to_file[len(directory):].lstrip('/')))
+
+    applied_documents_node = make_node('AppliedDocuments')
+    digests = _iter_file_digests([path_to_file for fn, path_to_file, _ in files], workers, pool)
+    for (fn, path_to_file, relative_path), (dgst, sig_dgst) in izip(files, digests):
+        dot_pos = fn.find('.')
+
+        applied_documents = [
+            {
+                'URL': relative_path,
+                'Name': fn,
+                'DigestValue': dgst,
+                # Пытаемся определить MIME-тип файла, но если нет - бинарный файл.
+                'Type': mime_types_map.get(fn[dot_pos:], 'application/octet-stream'),
+                # TODO: выяснить правила генерации кода документа
+                'CodeDocument': u'0000',
+                'Number': i,
+            },
+            # Файл с подписью по PKCS/7
+            {
+                'URL': u'%s%s' % (relative_path, '.sig'),
+                'Name': u'%s.sig' % fn,
+                'DigestValue': sig_dgst,
+                'Type': 'application/x-pkcs7-signature',
+                'CodeDocument': u'0000',
+                'Number': i + 1,
+            }]
+
+        i += 2
+
+        for doc in applied_documents:
+            app_doc_node = make_node('AppliedDocument')
+            dict_to_xmldoc(app_doc_node, doc)
+            applied_documents_node.append(app_doc_node)
+
+        # Добавляем в ZIP-архив файл и его подпись
+        zip_arc.write(path_to_file, arcname=relative_path)
+        zip_arc.writestr('%s.sig' % relative_path, dgst)
 
     # Добавляем в ZIP-архив манифест и его подпись
     manifest_str = etree.tostring(applied_documents_node, pretty_print=True)
@@ -89,70 +331,403 @@ def encode_directory(directory):
     zip_arc.writestr('req_%s.sig' % request_code, get_text_digest(manifest_str))
 
     zip_arc.close()
-    in_memory_file.seek(0)
+
+    return request_code
+
+
+def encode_directory(directory, workers=1, pool=None):
+    u'''
+    Преобразование содержимого папки и её структуры в вид, пригодный для присоединения
+    к СМЭВ-сообщению согласно МР 2.4.4-2.5.6.
+
+    Результатом выполнения будет кортеж с уникальным GUID кодом (поле заголовка RequestCode)
+    и закодированный в base64 ZIP-архив с манифестом, файлами директории и соответствующими
+    файлами подписей.
+
+    ZIP-архив формируется в памяти. Для больших вложений следует
+    использовать encode_directory_stream.
+
+    :param  unicode directory:   Путь к папке, содержимое которой необходимо прикрепить.
+    :param  int workers: Размер пула, запускаемого для вычисления хэш-кодов
+                         (по умолчанию - последовательное вычисление,
+                         None - по числу ядер).
+    :param  pool: Существующий пул для вычисления хэш-кодов (объект с
+                  методом imap, например multiprocessing.Pool); не закрывается.
+    :return: GUID и закодированный в base64 ZIP-архив.
+    :rtype:  (unicode, unicode)
+    '''
+    in_memory_file = StringIO()
+    request_code = _write_directory_archive(directory, in_memory_file, workers, pool)
 
     # Преобразуем ZIP-архив в base64
-    encoded = base64.b64encode(in_memory_file.read())
+    encoded = base64.b64encode(in_memory_file.getvalue())
     in_memory_file.close()
 
     return request_code, encoded
 
 
-def extract_directory(request_code, binary_data, destination=None,
-                      verify=True, exclude_sigs=True):
+def encode_directory_stream(directory, workers=1, max_size=SPOOL_MAX_SIZE, pool=None):
     u'''
-    Извлечение файлов из закодированного по МР архива вложений.
-    Если не указана папка назначения, то создается временная и распаковка
-    производится в неё.
+    Потоковый вариант encode_directory.
 
-    :param str request_code: Код заявления.
-    :param str binary_data: Закодированное в base64 содержимое вложения.
-    :param str destination: Папка назначения, куда распаковывается содержимое.
-    :param bool verify: Флаг проверки подписей вложенных файлов.
-    :param bool exclude_sigs: Флаг пропуска файлов подписей (.sig) при распаковке.
-    :return: XML-дерево файла манифеста, путь назначения.
-    :rtype: (lxml.Element, unicode)
+    ZIP-архив (с поддержкой Zip64) записывается во временный файл, который
+    хранится в памяти, пока его размер не превышает max_size. Вместо
+    строки возвращается streaming.BinaryDataSource, выдающий архив в
+    base64 порциями ограниченного размера (iter_base64); его можно сразу
+    передать в контекст construct_smev_envelope. Временный файл
+    удаляется методом close источника.
+
+    :param  unicode directory:   Путь к папке, содержимое которой необходимо прикрепить.
+    :param  int workers: Размер пула для вычисления хэш-кодов (см. encode_directory).
+    :param  int max_size: Размер архива, при превышении которого он
+                          переносится на диск.
+    :param  pool: Существующий пул для вычисления хэш-кодов.
+    :return: GUID и источник данных архива.
+    :rtype:  (unicode, streaming.BinaryDataSource)
+    '''
+    spool = SpooledTemporaryFile(max_size=max_size)
+    try:
+        request_code = _write_directory_archive(directory, spool, workers, pool)
+    except:
+        spool.close()
+        raise
+    return request_code, BinaryDataSource(spool)
+
+
+def _open_binary_data(binary_data):
+    u'''
+    Получение файлового объекта с декодированным архивом.
+
+    :return: Файловый объект и флаг необходимости его закрытия.
+    :rtype: (file, bool)
     '''
+    if isinstance(binary_data, basestring):
+        return StringIO(base64.b64decode(binary_data)), True
+
+    # Вложение, полученное при потоковом разборе сообщения
+    if isinstance(binary_data, BinaryDataFile):
+        return binary_data.open(), False
 
-    # Распаковываем архив
-    decoded = base64.b64decode(binary_data)
-    in_memory_file = StringIO(decoded)
-    zip_arc = ZipFile(in_memory_file, 'r')
+    if hasattr(binary_data, 'iter_base64'):
+        chunks = binary_data.iter_base64()
+    else:
+        chunks = iter(lambda: binary_data.read(FILE_CHUNK_SIZE), '')
 
-    # Пробуем получить манифест из архива
+    decoded = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    decoder = _Base64Decoder(decoded.write)
     try:
-        manifest_file = zip_arc.open('req_%s.xml' % request_code, 'r')
-        manifest_str = manifest_file.read()
-        manifest_file.close()
-    except KeyError:
-        raise InvalidManifestException(u'Manifest file "req_%s.xml" not found' % request_code)
+        for chunk in chunks:
+            decoder.feed(chunk)
+        decoder.close()
+    except:
+        decoded.close()
+        raise
+    return decoded, True
 
-    manifest = parse_xml_string(manifest_str)
-    applied_documents = manifest.xpath('.//AppliedDocument')
 
-    if not destination:
-        destination = tempfile.mkdtemp()
+def _copy_member(zip_arc, member, write, hasher=None):
+    u'''
+    Передача распаковываемого содержимого файла архива порциями
+    в функцию записи и объект хэширования.
+    '''
+    source = zip_arc.open(member, 'r')
+    try:
+        for chunk in iter(lambda: source.read(FILE_CHUNK_SIZE), ''):
+            write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+    finally:
+        source.close()
+
+
+def _extract_member(zip_arc, member, destination, hasher=None):
+    u'''
+    Распаковка файла из архива с передачей данных в объект хэширования.
+
+    Путь к файлу формируется так же, как в ZipFile.extract: абсолютные
+    пути и ссылки на родительские папки отбрасываются.
+
+    :return: Путь к распакованному файлу.
+    :rtype: unicode
+    '''
+    arcname = member.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(part for part in arcname.split(os.path.sep)
+                               if part not in ('', os.path.curdir, os.path.pardir))
 
-    for doc in applied_documents:
-        doc_info = dict([(n.tag, n.text) for n in doc])
+    path_to_file = os.path.join(destination, arcname)
+    directory = os.path.dirname(path_to_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
 
-        # Мы проверяем подписи по манифесту, поэтому по умолчанию
-        # игнорируем файлы с ними и не распаковываем
-        if doc_info['Name'].endswith('.sig') and exclude_sigs:
-            continue
+    with open(path_to_file, 'wb') as target:
+        _copy_member(zip_arc, member, target.write, hasher)
 
-        zip_arc.extract(doc_info['URL'], destination)
-        path_to_file = os.path.join(destination, doc_info['URL'])
+    return path_to_file
 
-        # Проверяем подписи файлов по данным из манифеста
+
+class AttachmentArchive(object):
+    u'''
+    Архив вложений СМЭВ-сообщения с доступом к отдельным файлам
+    без распаковки всего архива.
+
+    Манифест разбирается при создании объекта, файлы читаются из архива
+    по требованию. Хэш-код файла проверяется по манифесту только при
+    обращении к нему и только один раз. Распакованные во временную папку
+    файлы удаляются методом close или при выходе из блока with.
+
+    :param str request_code: Код заявления.
+    :param binary_data: Закодированное в base64 содержимое вложения
+                        (см. extract_directory).
+    '''
+
+    def __init__(self, request_code, binary_data):
+        self.request_code = request_code
+        self._file, self._close_file = _open_binary_data(binary_data)
+        self._temp_dir = None
+        self._verified = set()
+        self.zip_arc = None
+
+        # При ошибке в архиве или манифесте архив и файл закрываются
+        try:
+            self.zip_arc = ZipFile(self._file, 'r')
+
+            # Пробуем получить манифест из архива
+            try:
+                manifest_str = self.zip_arc.read('req_%s.xml' % request_code)
+            except KeyError:
+                raise InvalidManifestException(u'Manifest file "req_%s.xml" not found' % request_code)
+
+            self.manifest = parse_xml_string(manifest_str)
+
+            # Описания файлов из манифеста по URL и по имени
+            self.documents = OrderedDict()
+            self._names = {}
+            for doc in tags(self.manifest, './/AppliedDocument'):
+                doc_info = dict([(n.tag, n.text) for n in doc])
+                self.documents[doc_info['URL']] = doc_info
+                self._names.setdefault(doc_info['Name'], doc_info['URL'])
+        except:
+            self.close()
+            raise
+
+    def get_document(self, url):
+        u'''
+        Описание файла из манифеста.
+
+        :param unicode url: URL или имя файла.
+        :return: Словарь с полями AppliedDocument.
+        :rtype: dict
+        '''
+        if url not in self.documents:
+            if url not in self._names:
+                raise KeyError(url)
+            url = self._names[url]
+        return self.documents[url]
+
+    def __contains__(self, url):
+        return url in self.documents or url in self._names
+
+    def digest(self, url):
+        u'''
+        Вычисление хэш-кода файла архива.
+
+        :param unicode url: URL или имя файла.
+        :return: Закодированный в base64 хэш-код.
+        :rtype: unicode
+        '''
+        doc_info = self.get_document(url)
+        hasher = signer.new_hasher()
+        _copy_member(self.zip_arc, doc_info['URL'], hasher.update)
+        return base64.b64encode(hasher.digest())
+
+    def _check_digest(self, doc_info, dgst):
+        if doc_info['DigestValue'] != dgst:
+            raise InvalidFileDigestException((doc_info['URL'],
+                                             doc_info['DigestValue'],
+                                             dgst))
+        self._verified.add(doc_info['URL'])
+
+    def verify(self, url):
+        u'''
+        Проверка хэш-кода файла по данным манифеста.
+
+        :param unicode url: URL или имя файла.
+        :raises InvalidFileDigestException: Хэш-код не совпадает.
+        '''
+        doc_info = self.get_document(url)
+        if doc_info['URL'] not in self._verified:
+            self._check_digest(doc_info, self.digest(url))
+
+    def open(self, url, verify=True):
+        u'''
+        Открытие файла архива на чтение.
+
+        :param unicode url: URL или имя файла.
+        :param bool verify: Проверка хэш-кода файла перед открытием.
+        :return: Файловый объект с распаковываемым содержимым.
+        :rtype: zipfile.ZipExtFile
+        '''
         if verify:
-            dgst = get_file_digest(path_to_file)
-            if doc_info['DigestValue'] != dgst:
-                raise InvalidFileDigestException((doc_info['URL'],
-                                                 doc_info['DigestValue'],
-                                                 dgst))
+            self.verify(url)
+        return self.zip_arc.open(self.get_document(url)['URL'], 'r')
+
+    def extract(self, url, destination=None, verify=True):
+        u'''
+        Распаковка файла архива.
+
+        Хэш-код вычисляется во время распаковки. Если папка назначения
+        не указана, файл распаковывается во временную папку, удаляемую
+        при закрытии архива.
+
+        :param unicode url: URL или имя файла.
+        :param unicode destination: Папка назначения.
+        :param bool verify: Проверка хэш-кода файла.
+        :return: Путь к распакованному файлу.
+        :rtype: unicode
+        '''
+        doc_info = self.get_document(url)
+        if not destination:
+            if self._temp_dir is None:
+                self._temp_dir = tempfile.mkdtemp()
+            destination = self._temp_dir
+
+        verify = verify and doc_info['URL'] not in self._verified
+        hasher = signer.new_hasher() if verify else None
+        path_to_file = _extract_member(self.zip_arc, doc_info['URL'], destination, hasher)
 
-    zip_arc.close()
-    in_memory_file.close()
+        if verify:
+            self._check_digest(doc_info, base64.b64encode(hasher.digest()))
+
+        return path_to_file
+
+    def read(self, url, verify=True, max_size=None):
+        u'''
+        Чтение файла архива в память.
+
+        Хэш-код вычисляется во время чтения. Файлы, размер которых
+        превышает max_size, возвращаются в виде временного файла
+        (SpooledTemporaryFile), установленного на начало; его закрытие
+        остается за вызывающим кодом.
+
+        :param unicode url: URL или имя файла.
+        :param bool verify: Проверка хэш-кода файла.
+        :param int max_size: Размер файла, начиная с которого вместо
+                             строки возвращается временный файл
+                             (по умолчанию - всегда строка).
+        :return: Содержимое файла.
+        :rtype: str или SpooledTemporaryFile
+        '''
+        doc_info = self.get_document(url)
+        verify = verify and doc_info['URL'] not in self._verified
+        hasher = signer.new_hasher() if verify else None
+
+        if max_size is None or self.zip_arc.getinfo(doc_info['URL']).file_size <= max_size:
+            chunks = []
+            _copy_member(self.zip_arc, doc_info['URL'], chunks.append, hasher)
+            result = ''.join(chunks)
+        else:
+            result = SpooledTemporaryFile(max_size=max_size)
+            try:
+                _copy_member(self.zip_arc, doc_info['URL'], result.write, hasher)
+            except:
+                result.close()
+                raise
+            result.seek(0)
+
+        if hasher is not None:
+            try:
+                self._check_digest(doc_info, base64.b64encode(hasher.digest()))
+            except InvalidFileDigestException:
+                if not isinstance(result, str):
+                    result.close()
+                raise
+
+        return result
+
+    def close(self):
+        if self.zip_arc is not None:
+            self.zip_arc.close()
+        if self._close_file:
+            self._file.close()
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-    return manifest, destination
+
+def extract_directory(request_code, binary_data, destination=None,
+                      verify=True, exclude_sigs=True, in_memory=False,
+                      max_size=SPOOL_MAX_SIZE):
+    u'''
+    Извлечение файлов из закодированного по МР архива вложений.
+    Если не указана папка назначения, то создается временная и распаковка
+    производится в неё.
+
+    Хэш-коды файлов вычисляются по мере распаковки, без повторного
+    чтения файлов с диска (если USE_BUILTIN_DIGEST выставлен в False,
+    а криптографический модуль запускает внешние процессы, хэш-коды
+    распакованных файлов вычисляются OpenSSL пакетно). Для чтения
+    отдельных файлов без распаковки архива используется AttachmentArchive.
+
+    При in_memory=True файлы не записываются на диск: вместо пути
+    назначения возвращается словарь URL файла - содержимое (строка или,
+    для файлов больше max_size, SpooledTemporaryFile, см.
+    AttachmentArchive.read).
+
+    :param str request_code: Код заявления.
+    :param binary_data: Закодированное в base64 содержимое вложения:
+                        строка, файловый объект, streaming.BinaryDataFile
+                        или streaming.BinaryDataSource.
+    :param str destination: Папка назначения, куда распаковывается содержимое.
+    :param bool verify: Флаг проверки подписей вложенных файлов.
+    :param bool exclude_sigs: Флаг пропуска файлов подписей (.sig) при распаковке.
+    :param bool in_memory: Распаковка файлов в память.
+    :param int max_size: Размер файла, начиная с которого при распаковке
+                         в память возвращается временный файл.
+    :return: XML-дерево файла манифеста, путь назначения (или словарь
+             с содержимым файлов при in_memory=True).
+    :rtype: (lxml.Element, unicode)
+    '''
+    with AttachmentArchive(request_code, binary_data) as archive:
+        if in_memory:
+            files = OrderedDict()
+        elif not destination:
+            destination = tempfile.mkdtemp()
+
+        extracted = []
+        batch_verify = verify and not in_memory and _use_batch_digests()
+
+        for url, doc_info in archive.documents.iteritems():
+            # Мы проверяем подписи по манифесту, поэтому по умолчанию
+            # игнорируем файлы с ними и не распаковываем
+            if doc_info['Name'].endswith('.sig') and exclude_sigs:
+                continue
+
+            if in_memory:
+                try:
+                    files[url] = archive.read(url, verify, max_size)
+                except:
+                    for content in files.itervalues():
+                        if not isinstance(content, str):
+                            content.close()
+                    raise
+            elif batch_verify:
+                extracted.append((doc_info, archive.extract(url, destination, False)))
+            else:
+                archive.extract(url, destination, verify)
+
+        # Хэш-коды распакованных файлов вычисляются OpenSSL пакетно
+        if extracted:
+            digests = get_file_digests([path_to_file for _, path_to_file in extracted])
+            for doc_info, path_to_file in extracted:
+                archive._check_digest(doc_info, digests[path_to_file])
+
+    return archive.manifest, files if in_memory else destination
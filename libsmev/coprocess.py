@@ -0,0 +1,449 @@
+#coding: utf-8
+u'''
+Пул постоянных процессов-исполнителей внешних команд.
+
+Каждый исполнитель - небольшой процесс Python, запускаемый один раз и
+принимающий задания через каналы (stdin/stdout). Порождение процессов
+OpenSSL происходит из исполнителя, а не из (как правило, большого)
+рабочего процесса приложения, что избавляет от дорогостоящего fork.
+Процесс OpenSSL по-прежнему запускается на каждую команду; чтобы модуль
+(engine) загружался один раз, следует использовать
+crypto.LibcryptoBackend.
+
+Модуль намеренно не зависит от остальной части библиотеки: этот же файл
+запускается как сценарий в процессе-исполнителе.
+'''
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import pickle
+import threading
+import subprocess
+from Queue import Queue
+from tempfile import NamedTemporaryFile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_header = struct.Struct('>I')
+
+# Команда проверки работоспособности исполнителя
+PING = '__ping__'
+
+# Метка элемента PipeInput при передаче команды исполнителю
+PIPE_MARKER = '__pipe__'
+
+
+# Возможность передачи данных через каналы в виде /dev/fd/N
+PIPES_SUPPORTED = fcntl is not None and os.path.isdir('/dev/fd')
+
+# Блокировка запуска процессов: процесс, запущенный без close_fds
+# (см. execute), не должен унаследовать каналы, которые другой поток
+# создает в это время и еще не успел пометить FD_CLOEXEC.
+_spawn_lock = threading.Lock()
+
+
+class CoprocessError(Exception):
+    u'''
+    Ошибка обмена данными с процессом-исполнителем.
+    '''
+    pass
+
+
+class PipeInput(object):
+    u'''
+    Данные, передаваемые запускаемой команде в качестве файла.
+
+    Элемент команды заменяется на путь /dev/fd/N к каналу, в который
+    записываются данные. Если каналы не поддерживаются ОС, данные
+    записываются во временный файл, удаляемый после выполнения команды.
+
+    :param str data: Передаваемые данные.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _feed(fd, data):
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    except OSError:
+        # Команда завершилась, не дочитав данные
+        pass
+    finally:
+        os.close(fd)
+
+
+def _set_cloexec(*files):
+    if fcntl is None:
+        return
+    for fh in files:
+        if fh is not None:
+            fcntl.fcntl(fh.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+
+def spawn(args, **kwargs):
+    u'''
+    Запуск процесса (subprocess.Popen) под блокировкой запуска.
+
+    Концы каналов stdin/stdout/stderr в текущем процессе помечаются
+    FD_CLOEXEC до снятия блокировки, поэтому не наследуются процессами,
+    запускаемыми execute из других потоков.
+
+    :param list args: Команда для запуска.
+    :param kwargs: Параметры subprocess.Popen.
+    :rtype: subprocess.Popen
+    '''
+    with _spawn_lock:
+        process = subprocess.Popen(args, **kwargs)
+        _set_cloexec(process.stdin, process.stdout, process.stderr)
+    return process
+
+
+def _kill(process, expired):
+    expired.append(True)
+    try:
+        process.kill()
+    except OSError:
+        # Процесс уже завершился
+        pass
+
+
+def execute(cmd, input=None, timeout=None):
+    u'''
+    Запуск команды и считывание выводимых ею данных.
+
+    Элементы команды типа PipeInput заменяются на пути к каналам
+    (или временным файлам) с соответствующими данными.
+
+    :param list cmd: Команда для запуска.
+    :param str input: Входные данные, подаваемые на stdin команды.
+    :param float timeout: Время выполнения, по истечении которого
+                          процесс завершается и возбуждается OSError
+                          (ETIMEDOUT).
+    :return: Вывод команды в stdout и stderr.
+    :rtype: tuple
+    '''
+    args = []
+    read_fds = []
+    pending = []
+    feeders = []
+    tmp_files = []
+
+    try:
+        # Каналы PipeInput передаются команде по номерам дескрипторов,
+        # поэтому она запускается без close_fds. Каналы создаются и
+        # помечаются FD_CLOEXEC под блокировкой запуска, иначе их конец
+        # для записи может унаследовать процесс, запускаемый другим
+        # потоком, и команда не дождется конца данных.
+        with _spawn_lock:
+            for arg in cmd:
+                if not isinstance(arg, PipeInput):
+                    args.append(arg)
+                elif PIPES_SUPPORTED:
+                    read_fd, write_fd = os.pipe()
+                    read_fds.append(read_fd)
+                    fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                    pending.append((write_fd, arg.data))
+                    args.append('/dev/fd/%d' % read_fd)
+                else:
+                    # Windows не позволяет считывать открытые файлы,
+                    # поэтому файл закрывается сразу после записи.
+                    tmp_file = NamedTemporaryFile(delete=False)
+                    tmp_files.append(tmp_file.name)
+                    tmp_file.file.write(arg.data)
+                    tmp_file.file.close()
+                    args.append(tmp_file.name)
+
+            pr = subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            _set_cloexec(pr.stdin, pr.stdout, pr.stderr)
+
+            # Концы для чтения нужны только запущенной команде
+            while read_fds:
+                os.close(read_fds.pop())
+
+        while pending:
+            write_fd, data = pending.pop()
+            if len(data) <= select.PIPE_BUF:
+                # Помещается в буфер канала целиком
+                _feed(write_fd, data)
+                continue
+            feeder = threading.Thread(target=_feed, args=(write_fd, data))
+            feeder.daemon = True
+            feeder.start()
+            feeders.append(feeder)
+
+        if timeout is None:
+            return pr.communicate(input=input)
+
+        expired = []
+        timer = threading.Timer(timeout, _kill, (pr, expired))
+        timer.start()
+        try:
+            result = pr.communicate(input=input)
+        finally:
+            timer.cancel()
+        if expired:
+            raise OSError(errno.ETIMEDOUT, 'Command timed out after %s s' % timeout)
+        return result
+    finally:
+        for fd in read_fds:
+            os.close(fd)
+        for write_fd, data in pending:
+            os.close(write_fd)
+        for feeder in feeders:
+            feeder.join()
+        for fn in tmp_files:
+            os.remove(fn)
+
+
+def _encode_cmd(cmd):
+    return [(PIPE_MARKER, arg.data) if isinstance(arg, PipeInput) else arg
+            for arg in cmd]
+
+
+def _decode_cmd(cmd):
+    return [PipeInput(arg[1]) if isinstance(arg, tuple) and arg[0] == PIPE_MARKER else arg
+            for arg in cmd]
+
+
+def _write_frame(stream, obj):
+    data = pickle.dumps(obj, 2)
+    stream.write(_header.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def _read_exactly(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError('Unexpected end of stream')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _read_frame(stream):
+    size, = _header.unpack(_read_exactly(stream, _header.size))
+    return pickle.loads(_read_exactly(stream, size))
+
+
+def serve(stdin, stdout):
+    u'''
+    Цикл обработки заданий процессом-исполнителем.
+
+    Задание - кортеж (команда, входные данные, время выполнения), ответ -
+    кортеж (stdout, stderr, ошибка запуска).
+
+    :param file stdin: Поток, из которого считываются задания.
+    :param file stdout: Поток, в который записываются результаты.
+    '''
+    while True:
+        try:
+            cmd, input, timeout = _read_frame(stdin)
+        except EOFError:
+            break
+
+        if cmd == PING:
+            _write_frame(stdout, (PING, '', None))
+            continue
+
+        try:
+            out, err = execute(_decode_cmd(cmd), input, timeout)
+        except OSError as exc:
+            _write_frame(stdout, (None, None, (exc.errno, exc.strerror)))
+        else:
+            _write_frame(stdout, (out, err, None))
+
+
+class Coprocess(object):
+    u'''
+    Процесс-исполнитель внешних команд.
+    '''
+
+    def __init__(self, executable=None):
+        self.executable = executable or sys.executable
+        self.process = None
+        self.last_used = 0
+        self.start()
+
+    def start(self):
+        u'''
+        Запуск процесса-исполнителя.
+        '''
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        self.process = spawn(
+            [self.executable, '-u', script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=(os.name == 'posix'))
+        self.last_used = time.time()
+
+    def stop(self):
+        u'''
+        Остановка процесса-исполнителя.
+        '''
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def restart(self):
+        u'''
+        Перезапуск процесса-исполнителя.
+        '''
+        self.stop()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def call(self, cmd, input=None, timeout=None):
+        u'''
+        Передача задания исполнителю и ожидание результата.
+
+        :param list cmd: Команда для запуска.
+        :param str input: Входные данные, подаваемые на stdin команды.
+        :param float timeout: Время выполнения команды (см. execute).
+        :return: Кортеж (stdout, stderr, ошибка запуска).
+        :rtype: tuple
+        '''
+        try:
+            if cmd != PING:
+                cmd = _encode_cmd(cmd)
+            _write_frame(self.process.stdin, (cmd, input, timeout))
+            result = _read_frame(self.process.stdout)
+        except (IOError, OSError, ValueError, EOFError, struct.error,
+                pickle.UnpicklingError) as err:
+            raise CoprocessError(unicode(err))
+        self.last_used = time.time()
+        return result
+
+    def ping(self):
+        u'''
+        Проверка работоспособности исполнителя.
+
+        :rtype: bool
+        '''
+        try:
+            return self.call(PING)[0] == PING
+        except CoprocessError:
+            return False
+
+
+class CoprocessPool(object):
+    u'''
+    Пул процессов-исполнителей внешних команд.
+
+    Перед выдачей задания исполнитель проверяется: завершившийся процесс
+    перезапускается, а простаивавший дольше health_check_interval секунд
+    предварительно опрашивается. Если исполнитель аварийно завершился
+    во время выполнения задания, он перезапускается и задание
+    повторяется один раз. Зависшая команда завершается исполнителем
+    по истечении timeout секунд.
+
+    :param int size: Количество процессов-исполнителей.
+    :param unicode executable: Интерпретатор Python для исполнителей.
+    :param float health_check_interval: Интервал простоя, после которого
+                                        исполнитель опрашивается перед
+                                        выдачей задания.
+    :param float timeout: Время выполнения команды по умолчанию
+                          (None - без ограничения).
+    '''
+
+    def __init__(self, size=2, executable=None, health_check_interval=30, timeout=None):
+        assert size > 0, 'Pool size should be positive'
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._workers = [Coprocess(executable) for _ in range(size)]
+        self._idle = Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._closed = False
+
+    def _acquire(self):
+        worker = self._idle.get()
+        try:
+            if not worker.is_alive():
+                worker.restart()
+            elif time.time() - worker.last_used > self.health_check_interval:
+                if not worker.ping():
+                    worker.restart()
+        except:
+            self._idle.put(worker)
+            raise
+        return worker
+
+    def run(self, cmd, input=None, timeout=None):
+        u'''
+        Выполнение команды одним из исполнителей пула.
+
+        Повторяет интерфейс helpers.run_cmd.
+
+        :param list cmd: Команда для запуска.
+        :param str input: Входные данные, подаваемые на stdin команды.
+        :param float timeout: Время выполнения команды (по умолчанию -
+                              заданное для пула).
+        :return: Вывод команды в stdout и stderr.
+        :rtype: tuple
+        '''
+        if self._closed:
+            raise CoprocessError('Pool is closed')
+        if timeout is None:
+            timeout = self.timeout
+
+        worker = self._acquire()
+        try:
+            try:
+                out, err, exc = worker.call(cmd, input, timeout)
+            except CoprocessError:
+                worker.restart()
+                out, err, exc = worker.call(cmd, input, timeout)
+        finally:
+            self._idle.put(worker)
+
+        if exc is not None:
+            raise OSError(*exc)
+        return out, err
+
+    def close(self):
+        u'''
+        Остановка всех процессов-исполнителей пула.
+        '''
+        self._closed = True
+        for worker in self._workers:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    serve(sys.stdin, sys.stdout)
@@ -0,0 +1,667 @@
+#coding: utf-8
+u'''
+Криптографические модули: вычисление хэш-кодов, ЭП и работа с ключами.
+
+Функции модуля signer выполняют криптографические операции через
+текущий модуль (см. signer.configure_crypto_backend):
+
+* CliBackend - запуск утилиты командной строки OpenSSL (по умолчанию);
+* LibcryptoBackend - вызов функций EVP библиотеки libcrypto через ctypes
+  в текущем процессе;
+* FakeBackend - детерминированная имитация для тестов, не требующая
+  OpenSSL с поддержкой ГОСТ.
+'''
+
+import os
+import hmac
+import base64
+import hashlib
+import threading
+import ctypes
+import ctypes.util
+from tempfile import NamedTemporaryFile
+
+import gost94
+from helpers import run_cmd, PipeInput
+from coprocess import PIPES_SUPPORTED
+
+
+# Размер блока, которым считываются файлы при вычислении хэш-кода.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Объем данных потокового хэш-кода (см. CliBackend.new_digest), при
+# превышении которого они переносятся из памяти во временный файл.
+DIGEST_SPOOL_SIZE = 1024 * 1024
+
+
+def _get_max_cmd_length():
+    u'''
+    Допустимая длина командной строки запускаемого процесса (с запасом
+    на переменные окружения).
+    '''
+    try:
+        return min(os.sysconf('SC_ARG_MAX') // 2, 1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        # Ограничение командной строки Windows
+        return 32 * 1024
+
+
+# Максимальная длина команды при пакетном вычислении хэш-кодов файлов.
+MAX_CMD_LENGTH = _get_max_cmd_length()
+
+
+class CryptoError(Exception):
+    u'''
+    Ошибка выполнения криптографической операции.
+    '''
+    pass
+
+
+class CryptoBackend(object):
+    u'''
+    Интерфейс криптографического модуля.
+
+    Данные передаются и возвращаются в двоичном виде (без base64),
+    ключи и сертификаты - в виде PEM. При ошибках возбуждается CryptoError.
+    '''
+
+    # Возможность подписания расшифрованным ключом, хранящимся в памяти
+    # (см. signer.Signer). Иначе используются файл ключа и пароль.
+    supports_key_data = True
+
+    # Операции выполняются в текущем процессе без запуска внешних
+    # (см. signer.USE_BUILTIN_DIGEST).
+    in_process = True
+
+    def digest(self, text):
+        u'''
+        Хэш-код текста.
+
+        :param str text: Данные.
+        :return: Хэш-код.
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def file_digest(self, fn):
+        u'''
+        Хэш-код файла.
+
+        :param unicode fn: Путь к файлу.
+        :return: Хэш-код.
+        :rtype: str
+        '''
+        with open(fn, 'rb') as fh:
+            return self.digest(fh.read())
+
+    def file_digests(self, paths):
+        u'''
+        Хэш-коды списка файлов.
+
+        :param list paths: Пути к файлам.
+        :return: Словарь путь к файлу - хэш-код.
+        :rtype: dict
+        '''
+        return dict((fn, self.file_digest(fn)) for fn in paths)
+
+    def new_digest(self):
+        u'''
+        Объект последовательного вычисления хэш-кода (методы update и
+        digest, как у объектов hashlib).
+        '''
+        return _BufferedDigest(self)
+
+    def decrypt_private_key(self, data, password):
+        u'''
+        Расшифровка частного ключа.
+
+        :param str data: PEM с зашифрованным частным ключом.
+        :param str password: Пароль к ключу.
+        :return: PEM с расшифрованным частным ключом.
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def sign(self, text, private_key):
+        u'''
+        ЭП текста расшифрованным частным ключом.
+
+        :param str text: Подписываемые данные.
+        :param str private_key: PEM с расшифрованным частным ключом.
+        :return: ЭП.
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def sign_with_key_file(self, text, private_key_fn, private_key_pass):
+        u'''
+        ЭП текста ключом из файла.
+
+        :param str text: Подписываемые данные.
+        :param unicode private_key_fn: Путь к PEM-файлу с частным ключом.
+        :param str private_key_pass: Пароль к ключу.
+        :return: ЭП.
+        :rtype: str
+        '''
+        with open(private_key_fn, 'rb') as fh:
+            data = fh.read()
+        return self.sign(text, self.decrypt_private_key(data, private_key_pass))
+
+    def verify(self, text, public_key, signature):
+        u'''
+        Проверка ЭП текста.
+
+        :param str text: Подписанные данные.
+        :param str public_key: PEM с публичным ключом.
+        :param str signature: ЭП.
+        :rtype: bool
+        '''
+        raise NotImplementedError
+
+    def extract_public_key(self, certificate):
+        u'''
+        Извлечение публичного ключа из сертификата.
+
+        :param str certificate: PEM с сертификатом.
+        :return: PEM с публичным ключом.
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+
+class _BufferedDigest(object):
+    u'''
+    Накопление данных для однократного вызова CryptoBackend.digest.
+    '''
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._chunks = []
+
+    def update(self, data):
+        self._chunks.append(data)
+
+    def digest(self):
+        return self._backend.digest(''.join(self._chunks))
+
+
+class _SpooledDigest(object):
+    u'''
+    Накопление данных для однократного вызова CryptoBackend.digest или,
+    если их больше DIGEST_SPOOL_SIZE, CryptoBackend.file_digest для
+    временного файла.
+    '''
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def update(self, data):
+        if self._file is None:
+            self._chunks.append(data)
+            self._size += len(data)
+            if self._size <= DIGEST_SPOOL_SIZE:
+                return
+            # Файл удаляется при закрытии, в т.ч. если digest не вызван
+            self._file = NamedTemporaryFile(prefix='libsmev-digest-')
+            data, self._chunks = ''.join(self._chunks), None
+        self._file.write(data)
+
+    def digest(self):
+        if self._file is None:
+            return self._backend.digest(''.join(self._chunks))
+        try:
+            self._file.flush()
+            return self._backend.file_digest(self._file.name)
+        finally:
+            self._file.close()
+
+
+def _split_digest_cmds(cmd, paths):
+    u'''
+    Разбиение списка файлов на команды, длина которых не превышает
+    MAX_CMD_LENGTH.
+    '''
+    base_length = sum(len(arg) + 1 for arg in cmd)
+    chunk, length = [], base_length
+    for path in paths:
+        if chunk and length + len(path) + 1 > MAX_CMD_LENGTH:
+            yield chunk
+            chunk, length = [], base_length
+        chunk.append(path)
+        length += len(path) + 1
+    if chunk:
+        yield chunk
+
+
+class CliBackend(CryptoBackend):
+    u'''
+    Криптографический модуль, запускающий утилиту командной строки
+    OpenSSL (через helpers.run_cmd).
+
+    :param str digest_name: Имя алгоритма хэширования OpenSSL.
+    :param float timeout: Время выполнения команды, по истечении которого
+                          процесс OpenSSL завершается (None - без
+                          ограничения, см. helpers.run_cmd).
+    '''
+
+    supports_key_data = PIPES_SUPPORTED
+    in_process = False
+
+    def __init__(self, digest_name='md_gost94', timeout=None):
+        self.digest_name = digest_name
+        self.timeout = timeout
+
+    def _execute(self, cmd, input=None):
+        try:
+            return run_cmd(cmd, input=input, timeout=self.timeout)
+        except OSError as err:
+            # OpenSSL не запустился или не уложился в timeout
+            raise CryptoError(u'openssl failed: %s' % err)
+
+    def _run(self, cmd, input=None):
+        out, err = self._execute(cmd, input)
+        if err:
+            raise CryptoError(err)
+        return out
+
+    def digest(self, text):
+        return self._run(['openssl', 'dgst', '-binary', '-' + self.digest_name], text)
+
+    def file_digest(self, fn):
+        return self._run(['openssl', 'dgst', '-binary', '-' + self.digest_name, fn])
+
+    def file_digests(self, paths):
+        u'''
+        Хэш-коды списка файлов. Каждый процесс OpenSSL обрабатывает
+        столько файлов, сколько позволяет длина командной строки.
+        '''
+        cmd = ['openssl', 'dgst', '-binary', '-' + self.digest_name]
+
+        digests = {}
+        for chunk in _split_digest_cmds(cmd, paths):
+            out = self._run(cmd + chunk)
+            # Хэш-коды выводятся подряд без разделителей
+            if not chunk or len(out) % len(chunk):
+                raise CryptoError(u'unexpected output length %d' % len(out))
+            size = len(out) // len(chunk)
+            for i, fn in enumerate(chunk):
+                digests[fn] = out[i * size:(i + 1) * size]
+
+        return digests
+
+    def new_digest(self):
+        u'''
+        Данные накапливаются (свыше DIGEST_SPOOL_SIZE - во временном
+        файле) и передаются OpenSSL одной командой, как и в digest и
+        file_digest: через пул исполнителей и с ограничением timeout.
+        '''
+        return _SpooledDigest(self)
+
+    def decrypt_private_key(self, data, password):
+        return self._run(['openssl', 'pkey', '-in', PipeInput(data), '-passin', 'stdin'],
+                         password + '\n')
+
+    def sign(self, text, private_key):
+        # Ключ передается OpenSSL через канал и не записывается на диск
+        return self._run(['openssl', 'dgst', '-sign', PipeInput(private_key), '-binary',
+                          '-' + self.digest_name], text)
+
+    def sign_with_key_file(self, text, private_key_fn, private_key_pass):
+        return self._run(['openssl', 'dgst', '-sign', private_key_fn, '-binary',
+                          '-' + self.digest_name, '-passin', 'stdin'],
+                         private_key_pass + '\n' + text)
+
+    def verify(self, text, public_key, signature):
+        # OpenSSL не умеет считывать ключ и значение подписи со стандартного
+        # ввода, поэтому они передаются через каналы (см. PipeInput).
+        out, err = self._execute(['openssl', 'dgst', '-' + self.digest_name, '-verify',
+                                  PipeInput(public_key), '-signature', PipeInput(signature)],
+                                 text)
+        # Новые версии OpenSSL выводят причину неверной подписи в stderr
+        if out.strip().lower() == 'verification failure':
+            return False
+        if err:
+            raise CryptoError(err)
+        return out.strip() == 'Verified OK'
+
+    def extract_public_key(self, certificate):
+        return self._run(['openssl', 'x509', '-inform', 'PEM', '-pubkey', '-noout'],
+                         certificate)
+
+
+def _declare(lib, name, restype, argtypes, fallback=None):
+    func = getattr(lib, name, None)
+    if func is None and fallback is not None:
+        func = getattr(lib, fallback)
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+
+class LibcryptoBackend(CryptoBackend):
+    u'''
+    Криптографический модуль, вызывающий функции EVP библиотеки libcrypto
+    через ctypes без запуска внешних процессов.
+
+    Библиотека и модуль (engine) загружаются один раз в процессе при
+    первой операции. Для использования из нескольких потоков требуется
+    OpenSSL 1.1 и новее.
+
+    :param str digest_name: Имя алгоритма хэширования OpenSSL.
+    :param str engine: Идентификатор загружаемого модуля OpenSSL
+                       (None - без модуля).
+    :param unicode library: Путь к libcrypto (по умолчанию ищется в системе).
+    '''
+
+    _BIO_CTRL_PENDING = 10
+    _ENGINE_METHOD_ALL = 0xFFFF
+    _OPENSSL_INIT_LOAD_CONFIG = 0x40
+
+    def __init__(self, digest_name='md_gost94', engine='gost', library=None):
+        self.digest_name = digest_name
+        self.engine = engine
+        self.library = library
+        self._lib = None
+        self._md = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        u'''
+        Загрузка библиотеки, модуля и алгоритма хэширования.
+        '''
+        if self._md is not None:
+            return self._lib, self._md
+
+        with self._lock:
+            if self._md is None:
+                self._lib, self._md = self._load_library()
+        return self._lib, self._md
+
+    def _load_library(self):
+        path = self.library or ctypes.util.find_library('crypto')
+        if not path:
+            raise CryptoError(u'libcrypto not found')
+        lib = ctypes.CDLL(path)
+
+        p, c_int, c_char_p = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p
+        for name, restype, argtypes, fallback in (
+                ('EVP_MD_CTX_new', p, [], 'EVP_MD_CTX_create'),
+                ('EVP_MD_CTX_free', None, [p], 'EVP_MD_CTX_destroy'),
+                ('EVP_get_digestbyname', p, [c_char_p], None),
+                ('EVP_DigestInit_ex', c_int, [p, p, p], None),
+                ('EVP_DigestUpdate', c_int, [p, c_char_p, ctypes.c_size_t], None),
+                ('EVP_DigestFinal_ex', c_int, [p, c_char_p, ctypes.POINTER(ctypes.c_uint)], None),
+                ('EVP_DigestSignInit', c_int, [p, p, p, p, p], None),
+                ('EVP_DigestSignFinal', c_int, [p, c_char_p, ctypes.POINTER(ctypes.c_size_t)], None),
+                ('EVP_DigestVerifyInit', c_int, [p, p, p, p, p], None),
+                ('EVP_DigestVerifyFinal', c_int, [p, c_char_p, ctypes.c_size_t], None),
+                ('EVP_PKEY_free', None, [p], None),
+                ('BIO_new_mem_buf', p, [c_char_p, c_int], None),
+                ('BIO_new', p, [p], None),
+                ('BIO_s_mem', p, [], None),
+                ('BIO_ctrl', ctypes.c_long, [p, c_int, ctypes.c_long, p], None),
+                ('BIO_read', c_int, [p, c_char_p, c_int], None),
+                ('BIO_free', c_int, [p], None),
+                ('PEM_read_bio_PrivateKey', p, [p, p, p, c_char_p], None),
+                ('PEM_read_bio_PUBKEY', p, [p, p, p, p], None),
+                ('PEM_read_bio_X509', p, [p, p, p, p], None),
+                ('PEM_write_bio_PrivateKey', c_int, [p, p, p, p, c_int, p, p], None),
+                ('PEM_write_bio_PUBKEY', c_int, [p, p], None),
+                ('X509_get_pubkey', p, [p], None),
+                ('X509_free', None, [p], None),
+                ('ERR_get_error', ctypes.c_ulong, [], None),
+                ('ERR_error_string_n', None, [ctypes.c_ulong, c_char_p, ctypes.c_size_t], None),
+                ('OPENSSL_init_crypto', c_int, [ctypes.c_uint64, p], None),
+                ('OPENSSL_config', None, [c_char_p], None),
+                ('OpenSSL_add_all_digests', None, [], None),
+                ('ENGINE_load_builtin_engines', None, [], None),
+                ('ENGINE_by_id', p, [c_char_p], None),
+                ('ENGINE_init', c_int, [p], None),
+                ('ENGINE_set_default', c_int, [p, ctypes.c_uint], None)):
+            setattr(self, '_' + name, _declare(lib, name, restype, argtypes, fallback))
+
+        # Загрузка конфигурации OpenSSL (в ней может быть подключен модуль)
+        if self._OPENSSL_init_crypto is not None:
+            self._OPENSSL_init_crypto(self._OPENSSL_INIT_LOAD_CONFIG, None)
+        else:
+            if self._OPENSSL_config is not None:
+                self._OPENSSL_config(None)
+            if self._OpenSSL_add_all_digests is not None:
+                self._OpenSSL_add_all_digests()
+
+        if self.engine:
+            if self._ENGINE_load_builtin_engines is not None:
+                self._ENGINE_load_builtin_engines()
+            engine = self._ENGINE_by_id(self.engine)
+            if not engine or self._ENGINE_init(engine) != 1:
+                raise CryptoError(u'Engine "%s" is not available: %s' % (self.engine, self._errors()))
+            self._ENGINE_set_default(engine, self._ENGINE_METHOD_ALL)
+
+        md = self._EVP_get_digestbyname(self.digest_name)
+        if not md:
+            raise CryptoError(u'Unknown message digest: %s' % self.digest_name)
+        return lib, md
+
+    def _errors(self):
+        u'''
+        Считывание очереди ошибок OpenSSL.
+        '''
+        messages = []
+        buf = ctypes.create_string_buffer(256)
+        code = self._ERR_get_error()
+        while code:
+            self._ERR_error_string_n(code, buf, len(buf))
+            messages.append(buf.value)
+            code = self._ERR_get_error()
+        return '; '.join(messages)
+
+    def _check(self, result, operation):
+        if result != 1:
+            raise CryptoError(u'%s failed: %s' % (operation, self._errors()))
+
+    def _read_bio(self, bio):
+        size = self._BIO_ctrl(bio, self._BIO_CTRL_PENDING, 0, None)
+        buf = ctypes.create_string_buffer(size)
+        read = self._BIO_read(bio, buf, size)
+        return buf.raw[:read]
+
+    def _read_pem(self, reader, data, password=None):
+        u'''
+        Разбор PEM функцией PEM_read_bio_*.
+
+        Для частных ключей пароль передается всегда (пустой, если не
+        указан), иначе OpenSSL запрашивает его с терминала.
+        '''
+        bio = self._BIO_new_mem_buf(data, len(data))
+        try:
+            obj = reader(bio, None, None, password)
+        finally:
+            self._BIO_free(bio)
+        if not obj:
+            raise CryptoError(u'PEM read failed: %s' % self._errors())
+        return obj
+
+    def _write_pem(self, writer, *args):
+        u'''
+        Запись PEM функцией PEM_write_bio_*.
+        '''
+        bio = self._BIO_new(self._BIO_s_mem())
+        try:
+            self._check(writer(bio, *args), 'PEM write')
+            return self._read_bio(bio)
+        finally:
+            self._BIO_free(bio)
+
+    def _digest_chunks(self, chunks):
+        digest = self.new_digest()
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.digest()
+
+    def new_digest(self):
+        return _EvpDigest(self)
+
+    def digest(self, text):
+        return self._digest_chunks([text])
+
+    def file_digest(self, fn):
+        with open(fn, 'rb') as fh:
+            return self._digest_chunks(iter(lambda: fh.read(FILE_CHUNK_SIZE), ''))
+
+    def decrypt_private_key(self, data, password):
+        self._load()
+        pkey = self._read_pem(self._PEM_read_bio_PrivateKey, data, password)
+        try:
+            return self._write_pem(self._PEM_write_bio_PrivateKey, pkey, None, None, 0, None, None)
+        finally:
+            self._EVP_PKEY_free(pkey)
+
+    def sign(self, text, private_key):
+        lib, md = self._load()
+        pkey = self._read_pem(self._PEM_read_bio_PrivateKey, private_key, '')
+        ctx = self._EVP_MD_CTX_new()
+        try:
+            self._check(self._EVP_DigestSignInit(ctx, None, md, None, pkey), 'EVP_DigestSignInit')
+            self._check(self._EVP_DigestUpdate(ctx, text, len(text)), 'EVP_DigestSignUpdate')
+            size = ctypes.c_size_t()
+            self._check(self._EVP_DigestSignFinal(ctx, None, ctypes.byref(size)), 'EVP_DigestSignFinal')
+            buf = ctypes.create_string_buffer(size.value)
+            self._check(self._EVP_DigestSignFinal(ctx, buf, ctypes.byref(size)), 'EVP_DigestSignFinal')
+            return buf.raw[:size.value]
+        finally:
+            self._EVP_MD_CTX_free(ctx)
+            self._EVP_PKEY_free(pkey)
+
+    def sign_with_key_file(self, text, private_key_fn, private_key_pass):
+        self._load()
+        with open(private_key_fn, 'rb') as fh:
+            pkey = self._read_pem(self._PEM_read_bio_PrivateKey, fh.read(), private_key_pass)
+        try:
+            private_key = self._write_pem(self._PEM_write_bio_PrivateKey, pkey, None, None, 0, None, None)
+        finally:
+            self._EVP_PKEY_free(pkey)
+        return self.sign(text, private_key)
+
+    def verify(self, text, public_key, signature):
+        lib, md = self._load()
+        pkey = self._read_pem(self._PEM_read_bio_PUBKEY, public_key)
+        ctx = self._EVP_MD_CTX_new()
+        try:
+            self._check(self._EVP_DigestVerifyInit(ctx, None, md, None, pkey), 'EVP_DigestVerifyInit')
+            self._check(self._EVP_DigestUpdate(ctx, text, len(text)), 'EVP_DigestVerifyUpdate')
+            result = self._EVP_DigestVerifyFinal(ctx, signature, len(signature))
+            # Неверная подпись оставляет ошибку в очереди
+            self._errors()
+            return result == 1
+        finally:
+            self._EVP_MD_CTX_free(ctx)
+            self._EVP_PKEY_free(pkey)
+
+    def extract_public_key(self, certificate):
+        self._load()
+        x509 = self._read_pem(self._PEM_read_bio_X509, certificate)
+        try:
+            pkey = self._X509_get_pubkey(x509)
+            if not pkey:
+                raise CryptoError(u'X509_get_pubkey failed: %s' % self._errors())
+            try:
+                return self._write_pem(self._PEM_write_bio_PUBKEY, pkey)
+            finally:
+                self._EVP_PKEY_free(pkey)
+        finally:
+            self._X509_free(x509)
+
+
+class _EvpDigest(object):
+    u'''
+    Хэш-код, вычисляемый функциями EVP_Digest* libcrypto.
+    '''
+
+    def __init__(self, backend):
+        self._backend = backend
+        lib, md = backend._load()
+        self._ctx = backend._EVP_MD_CTX_new()
+        try:
+            backend._check(backend._EVP_DigestInit_ex(self._ctx, md, None), 'EVP_DigestInit_ex')
+        except CryptoError:
+            self._free()
+            raise
+
+    def _free(self):
+        if self._ctx:
+            self._backend._EVP_MD_CTX_free(self._ctx)
+            self._ctx = None
+
+    def update(self, data):
+        self._backend._check(
+            self._backend._EVP_DigestUpdate(self._ctx, data, len(data)), 'EVP_DigestUpdate')
+
+    def digest(self):
+        buf = ctypes.create_string_buffer(64)
+        size = ctypes.c_uint()
+        try:
+            self._backend._check(
+                self._backend._EVP_DigestFinal_ex(self._ctx, buf, ctypes.byref(size)),
+                'EVP_DigestFinal_ex')
+        finally:
+            self._free()
+        return buf.raw[:size.value]
+
+    def __del__(self):
+        self._free()
+
+
+def _pem_section(data, marker):
+    u'''
+    Содержимое (в base64) раздела PEM с указанной меткой.
+    '''
+    begin = '-----BEGIN %s-----' % marker
+    end = '-----END %s-----' % marker
+    start = data.find(begin)
+    stop = data.find(end, start)
+    if start < 0 or stop < 0:
+        raise CryptoError(u'PEM has no %s' % marker)
+    return ''.join(data[start + len(begin):stop].split())
+
+
+class FakeBackend(CryptoBackend):
+    u'''
+    Детерминированная имитация криптографического модуля для тестов.
+
+    Хэш-коды вычисляются встроенной реализацией ГОСТ Р 34.11-94 и
+    совпадают с настоящими. "Публичный ключ" - хэш-код сертификата,
+    "ЭП" - HMAC текста на этом ключе, поэтому подпись проверяется
+    по сертификату, но не имеет криптографической стойкости. Частный
+    ключ не расшифровывается: контейнер ключа должен содержать сертификат.
+    '''
+
+    def digest(self, text):
+        return gost94.new(text).digest()
+
+    def new_digest(self):
+        return gost94.new()
+
+    def decrypt_private_key(self, data, password):
+        _pem_section(data, 'CERTIFICATE')
+        return data
+
+    def _key(self, certificate):
+        return hashlib.sha256(base64.b64decode(_pem_section(certificate, 'CERTIFICATE'))).digest()
+
+    def sign(self, text, private_key):
+        return hmac.new(self._key(private_key), text, hashlib.sha256).digest()
+
+    def verify(self, text, public_key, signature):
+        try:
+            key = base64.b64decode(_pem_section(public_key, 'PUBLIC KEY'))
+        except TypeError:
+            raise CryptoError(u'Invalid public key')
+        return hmac.new(key, text, hashlib.sha256).digest() == signature
+
+    def extract_public_key(self, certificate):
+        return '-----BEGIN PUBLIC KEY-----\n%s\n-----END PUBLIC KEY-----\n' % \
+            base64.b64encode(self._key(certificate))
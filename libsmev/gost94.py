@@ -0,0 +1,237 @@
+#coding: utf-8
+u'''
+Реализация функции хэширования ГОСТ Р 34.11-94 на чистом Python.
+
+Используется набор параметров узлов замены CryptoPro
+(1.2.643.2.2.30.1, GostR3411_94_CryptoProParamSet), совпадающий с
+параметрами алгоритма md_gost94 модуля GOST в OpenSSL.
+
+Интерфейс повторяет объекты из модуля hashlib::
+
+    >>> h = new()
+    >>> h.update('abc')
+    >>> h.hexdigest()
+    'b285056dbf18d7392d7677369524dd14747459ed8143997e163b2986f92fd42c'
+'''
+
+import struct
+
+digest_size = 32
+block_size = 32
+
+# Узлы замены CryptoPro (k8 ... k1)
+CRYPTOPRO_SBOX = (
+    (0x1, 0x3, 0xA, 0x9, 0x5, 0xB, 0x4, 0xF, 0x8, 0x6, 0x7, 0xE, 0xD, 0x0, 0x2, 0xC),
+    (0xD, 0xE, 0x4, 0x1, 0x7, 0x0, 0x5, 0xA, 0x3, 0xC, 0x8, 0xF, 0x6, 0x2, 0x9, 0xB),
+    (0x7, 0x6, 0x2, 0x4, 0xD, 0x9, 0xF, 0x0, 0xA, 0x1, 0x5, 0xB, 0x8, 0xE, 0xC, 0x3),
+    (0x7, 0x6, 0x4, 0xB, 0x9, 0xC, 0x2, 0xA, 0x1, 0x8, 0x0, 0xE, 0xF, 0xD, 0x3, 0x5),
+    (0x4, 0xA, 0x7, 0xC, 0x0, 0xF, 0x2, 0x8, 0xE, 0x1, 0x6, 0x5, 0xD, 0xB, 0x9, 0x3),
+    (0x7, 0xF, 0xC, 0xE, 0x9, 0x4, 0x1, 0x0, 0x3, 0xB, 0x5, 0x2, 0x6, 0xA, 0x8, 0xD),
+    (0x5, 0xF, 0x4, 0x0, 0x2, 0xD, 0xB, 0x9, 0x1, 0x7, 0x6, 0x3, 0xC, 0xE, 0xA, 0x8),
+    (0xA, 0x4, 0x5, 0x6, 0x8, 0x1, 0x3, 0x7, 0xD, 0xC, 0xE, 0x0, 0x9, 0x2, 0xB, 0xF),
+)
+
+
+def _make_tables(sbox):
+    u'''
+    Построение таблиц подстановки по байту с уже выполненным
+    циклическим сдвигом на 11 бит влево (как в gosthash.c).
+    '''
+    k8, k7, k6, k5, k4, k3, k2, k1 = sbox
+
+    def rol11(x):
+        return ((x << 11) | (x >> 21)) & 0xFFFFFFFF
+
+    t87, t65, t43, t21 = [], [], [], []
+    for i in range(256):
+        hi, lo = i >> 4, i & 15
+        t87.append(rol11((k8[hi] << 4 | k7[lo]) << 24))
+        t65.append(rol11((k6[hi] << 4 | k5[lo]) << 16))
+        t43.append(rol11((k4[hi] << 4 | k3[lo]) << 8))
+        t21.append(rol11(k2[hi] << 4 | k1[lo]))
+    return tuple(t87), tuple(t65), tuple(t43), tuple(t21)
+
+
+def _make_psi_power(n):
+    u'''
+    Вычисление n-й степени линейного преобразования psi в виде списка
+    индексов 16-битных слов, сумма (XOR) которых дает каждое слово результата.
+    '''
+    words = [1 << i for i in range(16)]
+    for _ in range(n):
+        words = words[1:] + [words[0] ^ words[1] ^ words[2] ^ words[3] ^
+                             words[12] ^ words[15]]
+    return tuple(tuple(j for j in range(16) if mask >> j & 1) for mask in words)
+
+
+_TABLES = _make_tables(CRYPTOPRO_SBOX)
+_PSI_12 = _make_psi_power(12)
+_PSI_1 = _make_psi_power(1)
+_PSI_61 = _make_psi_power(61)
+
+# Константа C3 для вычисления третьего ключа
+_C3 = (0, 0xFF, 0, 0xFF, 0, 0xFF, 0, 0xFF, 0xFF, 0, 0xFF, 0, 0xFF, 0, 0xFF, 0,
+       0, 0xFF, 0xFF, 0, 0xFF, 0, 0, 0xFF, 0xFF, 0, 0, 0, 0xFF, 0xFF, 0, 0xFF)
+
+_unpack_bytes = struct.Struct('32B').unpack
+_unpack_words = struct.Struct('<16H').unpack
+_pack_words = struct.Struct('<16H').pack
+_unpack_halves = struct.Struct('<8I').unpack
+_pack_halves = struct.Struct('<8I').pack
+
+
+def _encrypt(w, n1, n2, tables=_TABLES):
+    u'''
+    Зашифрование блока (n1, n2) по ГОСТ 28147-89 в режиме простой замены
+    ключом, полученным из W преобразованием P.
+    '''
+    t87, t65, t43, t21 = tables
+    k = [w[j] | w[8 + j] << 8 | w[16 + j] << 16 | w[24 + j] << 24 for j in range(8)]
+    for key in k + k + k + k[::-1]:
+        x = (n1 + key) & 0xFFFFFFFF
+        n2 ^= t87[x >> 24] | t65[x >> 16 & 255] | t43[x >> 8 & 255] | t21[x & 255]
+        n1, n2 = n2, n1
+    return n2, n1
+
+
+def _a(y):
+    u'''Преобразование A: сдвиг на 8 байт с добавлением y1 ^ y2.'''
+    return y[8:] + [y[i] ^ y[8 + i] for i in range(8)]
+
+
+def _psi(words, power):
+    return [reduce(lambda acc, j: acc ^ words[j], idx, 0) for idx in power]
+
+
+def _step(h, m):
+    u'''
+    Шаговая функция хэширования f(H, M).
+
+    :param str h: Текущее значение хэша (32 байта).
+    :param str m: Блок сообщения (32 байта).
+    :return: Новое значение хэша.
+    :rtype: str
+    '''
+    hb = list(_unpack_bytes(h))
+    mb = list(_unpack_bytes(m))
+    hh = _unpack_halves(h)
+
+    # Генерация ключей и шифрующее преобразование
+    u, v = hb, mb
+    s = []
+    for i in range(4):
+        if i:
+            u = _a(u)
+            if i == 2:
+                u = [a ^ b for a, b in zip(u, _C3)]
+            v = _a(_a(v))
+        w = [a ^ b for a, b in zip(u, v)]
+        s.extend(_encrypt(w, hh[2 * i], hh[2 * i + 1]))
+
+    # Перемешивающее преобразование
+    s = _psi(_unpack_words(_pack_halves(*s)), _PSI_12)
+    s = [a ^ b for a, b in zip(s, _unpack_words(m))]
+    s = _psi(s, _PSI_1)
+    s = [a ^ b for a, b in zip(s, _unpack_words(h))]
+    s = _psi(s, _PSI_61)
+    return _pack_words(*s)
+
+
+def _add_mod256(a, b):
+    u'''Сложение двух 256-битных чисел (little-endian) по модулю 2^256.'''
+    x = _unpack_halves(a)
+    y = _unpack_halves(b)
+    result = []
+    carry = 0
+    for i in range(8):
+        t = x[i] + y[i] + carry
+        result.append(t & 0xFFFFFFFF)
+        carry = t >> 32
+    return _pack_halves(*result)
+
+
+class GostHash(object):
+    u'''
+    Объект вычисления хэш-кода по ГОСТ Р 34.11-94 с поддержкой
+    инкрементального добавления данных.
+    '''
+
+    name = 'md_gost94'
+    digest_size = digest_size
+    block_size = block_size
+
+    def __init__(self, data=None):
+        self._h = '\x00' * 32
+        self._sigma = '\x00' * 32
+        self._length = 0
+        self._buffer = ''
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        u'''
+        Добавление очередной порции данных.
+
+        :param str data: Данные.
+        '''
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        data = str(data)
+        self._length += len(data)
+        data = self._buffer + data
+        tail = len(data) % 32
+        h, sigma = self._h, self._sigma
+        for pos in xrange(0, len(data) - tail, 32):
+            block = data[pos:pos + 32]
+            h = _step(h, block)
+            sigma = _add_mod256(sigma, block)
+        self._h, self._sigma = h, sigma
+        self._buffer = data[len(data) - tail:]
+
+    def copy(self):
+        u'''
+        Копия объекта с текущим состоянием.
+
+        :rtype: GostHash
+        '''
+        other = GostHash()
+        other._h, other._sigma = self._h, self._sigma
+        other._length, other._buffer = self._length, self._buffer
+        return other
+
+    def digest(self):
+        u'''
+        Значение хэш-кода для добавленных данных. Состояние объекта
+        не изменяется.
+
+        :return: Хэш-код (32 байта).
+        :rtype: str
+        '''
+        h, sigma = self._h, self._sigma
+        if self._buffer:
+            block = self._buffer.ljust(32, '\x00')
+            h = _step(h, block)
+            sigma = _add_mod256(sigma, block)
+        bit_length = self._length * 8
+        length_block = _pack_halves(*[(bit_length >> (32 * i)) & 0xFFFFFFFF
+                                      for i in range(8)])
+        h = _step(h, length_block)
+        return _step(h, sigma)
+
+    def hexdigest(self):
+        u'''
+        Значение хэш-кода в шестнадцатеричном виде.
+
+        :rtype: str
+        '''
+        return self.digest().encode('hex')
+
+
+def new(data=None):
+    u'''
+    Создание объекта хэширования по ГОСТ Р 34.11-94.
+
+    :param str data: Начальная порция данных.
+    :rtype: GostHash
+    '''
+    return GostHash(data)
@@ -1,11 +1,39 @@
 #coding: utf-8
 
-import subprocess
+import atexit
+import threading
 
 from lxml import etree
 from lxml.etree import XMLSyntaxError
 
 from namespaces import NS_MAP, REVERSE_NS_MAP, make_node_with_ns
+from coprocess import CoprocessPool, PipeInput, execute
+
+
+# Реестры скомпилированных XPath-выражений (см. compile_xpath), у каждого
+# потока свой, и их предельный размер, при достижении которого вытесняются
+# выражения, не использовавшиеся с прошлого вытеснения.
+_xpath_registries = threading.local()
+XPATH_REGISTRY_SIZE = 1024
+
+# Пул процессов-исполнителей, через который run_cmd запускает команды.
+# Настраивается функцией configure_coprocess_pool.
+_coprocess_pool = None
+
+# Параметры парсеров parse_xml_string (см. configure_parser). Внешние
+# сущности не подставляются, сеть не используется.
+PARSER_OPTIONS = {
+    'remove_comments': True,
+    'resolve_entities': False,
+    'no_network': True,
+    'huge_tree': False,
+}
+
+# Парсеры lxml не допускают одновременного использования, поэтому
+# у каждого потока свой экземпляр. При изменении параметров номер
+# поколения увеличивается и парсеры создаются заново.
+_parsers = threading.local()
+_parser_generation = 0
 
 
 class Fault(Exception):
@@ -15,12 +43,67 @@ class Fault(Exception):
     pass
 
 
+def compile_xpath(path, ns_map=None):
+    u'''
+    Получение скомпилированного XPath-выражения из реестра.
+
+    Выражение компилируется при первом обращении и в дальнейшем
+    используется повторно. lxml блокирует объект etree.XPath на время
+    вычисления, и вычисления одного объекта из разных потоков
+    выполнялись бы по очереди, поэтому у каждого потока свой реестр.
+
+    :param  unicode path:    XPath-выражение.
+    :param  dict ns_map:  Словарь с пространством имен (по умолчанию NS_MAP).
+    :return: Скомпилированное выражение.
+    :rtype: lxml.etree.XPath
+    '''
+    if ns_map is None or ns_map is NS_MAP:
+        key = (path, None)
+    else:
+        key = (path, tuple(sorted(ns_map.items())))
+
+    try:
+        registry = _xpath_registries.registry
+    except AttributeError:
+        registry = _xpath_registries.registry = _XPathRegistry()
+
+    try:
+        xpath = registry[key]
+    except KeyError:
+        xpath = registry.add(key, etree.XPath(
+            path, namespaces=NS_MAP if ns_map is None else ns_map))
+    registry.used[key] = True
+    return xpath
+
+
+class _XPathRegistry(dict):
+    u'''
+    Реестр скомпилированных XPath-выражений потока. В used отмечаются
+    выражения, использованные после последнего вытеснения: отметка
+    дешевле упорядочивания выражений по времени использования.
+    '''
+
+    __slots__ = ('used',)
+
+    def __init__(self):
+        super(_XPathRegistry, self).__init__()
+        self.used = {}
+
+    def add(self, key, xpath):
+        if len(self) >= XPATH_REGISTRY_SIZE:
+            for old_key in [old_key for old_key in self if old_key not in self.used]:
+                del self[old_key]
+            self.used.clear()
+        self[key] = xpath
+        return xpath
+
+
 def tags(doc, path, ns_map=None):
     u'''
     Выборка XML-элемента по указанному XPath c заранее прописанным
     пространством имен.
 
-    Существует исключительно для удобства.
+    Выражение компилируется один раз (см. compile_xpath).
 
     :param  doc:     XML-документ, по которому производится выборка.
     :type   doc:     lxml.Element
@@ -30,9 +113,7 @@ def tags(doc, path, ns_map=None):
     :rtype: list of lxml.Element
     '''
 
-    if ns_map is None:
-        ns_map = NS_MAP
-    return doc.xpath(path, namespaces=ns_map)
+    return compile_xpath(path, ns_map)(doc)
 
 
 def tag_single(doc, path, ns_map=None):
@@ -65,30 +146,265 @@ def tag_single(doc, path, ns_map=None):
 make_node = lambda el_name: etree.Element(('%s' % el_name))
 
 
-def run_cmd(cmd, input=None):
+def configure_coprocess_pool(size=2, **kwargs):
+    u'''
+    Включение пула постоянных процессов-исполнителей для run_cmd.
+
+    Вместо порождения процесса из текущего (возможно, большого) процесса
+    при каждом вызове, команды передаются через каналы заранее запущенным
+    исполнителям. Повторный вызов пересоздает пул, вызов с size=0
+    отключает его.
+
+    Пул избавляет только от fork рабочего процесса: исполнитель
+    по-прежнему запускает новый процесс OpenSSL на каждую команду. Чтобы
+    не запускать процессы вовсе, следует использовать
+    crypto.LibcryptoBackend.
+
+    :param int size: Количество процессов-исполнителей.
+    :param kwargs: Дополнительные параметры coprocess.CoprocessPool
+                   (executable, health_check_interval, timeout).
+    :return: Созданный пул или None.
+    :rtype: coprocess.CoprocessPool
+    '''
+    global _coprocess_pool
+
+    if _coprocess_pool is not None:
+        _coprocess_pool.close()
+        _coprocess_pool = None
+
+    if size:
+        _coprocess_pool = CoprocessPool(size=size, **kwargs)
+    return _coprocess_pool
+
+
+@atexit.register
+def _close_coprocess_pool():
+    if _coprocess_pool is not None:
+        _coprocess_pool.close()
+
+
+def run_cmd(cmd, input=None, timeout=None):
     u'''
     Выполняем команду в интерпретаторе ОС и считываем выводимые ею данные.
 
+    Если включен пул процессов-исполнителей (см. configure_coprocess_pool),
+    команда выполняется одним из них.
+
+    Дополнительные данные, которые команда должна прочитать из файлов,
+    передаются элементами команды типа PipeInput - они заменяются путями
+    к каналам, через которые передаются данные.
+
     :param  unicode cmd:     Команда для запуска.
     :param  unicode input:   Входные данные, которые будут поданы на stdin.
+    :param  float timeout:   Время выполнения, по истечении которого процесс
+                             завершается и возбуждается OSError.
     :return: Вывод вызванной программы
     :rtype:  unicode
     '''
-    pr = subprocess.Popen(
-        cmd,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    if _coprocess_pool is not None:
+        return _coprocess_pool.run(cmd, input=input, timeout=timeout)
+
+    return execute(cmd, input=input, timeout=timeout)
+
 
-    return pr.communicate(input=input)
+def _qname(prefix, name):
+    return '{%s}%s' % (NS_MAP[prefix], name)
 
 
-def parse_xml_string(xml_string, charset=u'utf-8',
-                     parser=etree.XMLParser(remove_comments=True)):
+def _is_within(node, ancestor):
+    u'''
+    Проверка того, что элемент по-прежнему находится внутри ancestor.
+    '''
+    parent = node.getparent()
+    while parent is not None:
+        if parent is ancestor:
+            return True
+        parent = parent.getparent()
+    return False
+
+
+class EnvelopeView(object):
+    u'''
+    Структурный индекс SOAP-конверта СМЭВ-сообщения.
+
+    Элементы конверта (Header, Security, Body, Message, MessageData,
+    AppData и др.) находятся при первом обращении и далее берутся из
+    кэша. Поиск ведется по дочерним элементам, без просмотра всего
+    документа.
+
+    Перед выдачей закэшированного элемента проверяется, что он
+    по-прежнему находится внутри своего родителя, поэтому удаление или
+    перемещение частей конверта приводит к повторному поиску.
+    Отсутствующие элементы не кэшируются: добавленные позднее (например,
+    заголовок WS-Security при подписании) будут найдены. При иных
+    изменениях структуры следует вызвать invalidate.
+
+    Индекс принимается вместо XML-документа функциями sign_document,
+    verify_envelope_signature, extract_smev_parts,
+    extract_context_from_envelope и convert_smev_request.
+
+    :param lxml.Element envelope: Корень XML-документа (SOAP-ENV:Envelope).
+    '''
+
+    def __init__(self, envelope):
+        self.envelope = envelope
+        self._nodes = {}
+
+    @classmethod
+    def of(cls, envelope):
+        u'''
+        Получение индекса конверта: переданный индекс возвращается
+        как есть, для XML-документа создается новый.
+
+        :param envelope: XML-документ или его индекс.
+        :type envelope: lxml.Element or EnvelopeView
+        :rtype: EnvelopeView
+        '''
+        if isinstance(envelope, cls):
+            return envelope
+        return cls(envelope)
+
+    def invalidate(self):
+        u'''
+        Сброс всех найденных элементов.
+        '''
+        self._nodes.clear()
+
+    def _resolve(self, name, parent, find):
+        node = self._nodes.get(name)
+        if node is not None and parent is not None and _is_within(node, parent):
+            return node
+        node = find(parent) if parent is not None else None
+        if node is None:
+            self._nodes.pop(name, None)
+        else:
+            self._nodes[name] = node
+        return node
+
+    @staticmethod
+    def _find_message_part(body, name):
+        # Как правило, элемент - потомок элемента операции в теле запроса
+        tag = _qname('smev', name)
+        for operation in body.iterchildren(tag=etree.Element):
+            node = operation.find(tag)
+            if node is not None:
+                return node
+        return next(body.iterdescendants(tag=tag), None)
+
+    @property
+    def header(self):
+        return self._resolve(
+            'header', self.envelope,
+            lambda envelope: envelope.find(_qname('SOAP-ENV', 'Header')))
+
+    @property
+    def body(self):
+        return self._resolve(
+            'body', self.envelope,
+            lambda envelope: envelope.find(_qname('SOAP-ENV', 'Body')))
+
+    @property
+    def security(self):
+        return self._resolve(
+            'security', self.header,
+            lambda header: header.find(_qname('wsse', 'Security')))
+
+    @property
+    def token(self):
+        return self._resolve(
+            'token', self.security,
+            lambda security: security.find(_qname('wsse', 'BinarySecurityToken')))
+
+    @property
+    def signature(self):
+        return self._resolve(
+            'signature', self.security,
+            lambda security: security.find(_qname('ds', 'Signature')))
+
+    @property
+    def signed_info(self):
+        return self._resolve(
+            'signed_info', self.signature,
+            lambda signature: signature.find(_qname('ds', 'SignedInfo')))
+
+    @property
+    def digest_value(self):
+        return self._resolve(
+            'digest_value', self.signed_info,
+            lambda signed_info: signed_info.find('%s/%s' % (
+                _qname('ds', 'Reference'), _qname('ds', 'DigestValue'))))
+
+    @property
+    def signature_value(self):
+        return self._resolve(
+            'signature_value', self.signature,
+            lambda signature: signature.find(_qname('ds', 'SignatureValue')))
+
+    @property
+    def message(self):
+        return self._resolve(
+            'message', self.body,
+            lambda body: self._find_message_part(body, 'Message'))
+
+    @property
+    def message_data(self):
+        return self._resolve(
+            'message_data', self.body,
+            lambda body: self._find_message_part(body, 'MessageData'))
+
+    @property
+    def app_data(self):
+        return self._resolve(
+            'app_data', self.message_data,
+            lambda message_data: message_data.find(_qname('smev', 'AppData')))
+
+    @property
+    def binary_data(self):
+        return self._resolve(
+            'binary_data', self.message_data,
+            lambda message_data: message_data.find('%s/%s' % (
+                _qname('smev', 'AppDocument'), _qname('smev', 'BinaryData'))))
+
+
+def configure_parser(**options):
+    u'''
+    Изменение параметров парсеров, используемых parse_xml_string
+    по умолчанию.
+
+    Параметры применяются ко всем потокам: парсеры пересоздаются
+    при следующем разборе.
+
+    :param options: Параметры etree.XMLParser (huge_tree,
+                    resolve_entities, remove_comments и т.д.).
+    :return: Действующие параметры.
+    :rtype: dict
+    '''
+    global _parser_generation
+
+    PARSER_OPTIONS.update(options)
+    _parser_generation += 1
+    return dict(PARSER_OPTIONS)
+
+
+def get_parser():
+    u'''
+    Получение парсера текущего потока с параметрами PARSER_OPTIONS.
+
+    :rtype: lxml.etree.XMLParser
+    '''
+    if getattr(_parsers, 'generation', None) != _parser_generation:
+        _parsers.parser = etree.XMLParser(**PARSER_OPTIONS)
+        _parsers.generation = _parser_generation
+    return _parsers.parser
+
+
+def parse_xml_string(xml_string, charset=u'utf-8', parser=None):
     u'''
     Разбор строки, содержащей XML-документ с настраиваемым парсером.
 
-    По умолчанию используется парсер, удаляющий комментарии из документа.
+    По умолчанию используется парсер текущего потока (см. get_parser),
+    удаляющий комментарии из документа и не подставляющий внешние
+    сущности. Функцию можно вызывать из нескольких потоков одновременно.
 
     :param  unicode xml_string:  Строка, содержащая XML-документ.
     :param  unicode charset:     Кодировка.
@@ -96,6 +412,9 @@ def parse_xml_string(xml_string, charset=u'utf-8',
     :return: Корень XML-документа.
     :rtype:  lxml.Element
     '''
+    if parser is None:
+        parser = get_parser()
+
     try:
         try:
             root, xmlids = etree.XMLID(xml_string, parser)
@@ -114,30 +433,23 @@ def _from_soap(envelope):
     Выделение заголовка и тела SOAP-запроса из XML-документа.
 
     :param  envelope:    XML-документ, содержащий SOAP-запрос.
-    :type   envelope:    lxml.Element
+    :type   envelope:    lxml.Element or EnvelopeView
 
     :return: Заголовок и тело запроса.
     :rtype:  list of lxml.Element
     '''
 
+    view = EnvelopeView.of(envelope)
+
     # Выделение из конверта заголовка и тела запроса.
-    if envelope.tag != "{%s}Envelope" % NS_MAP['SOAP-ENV']:
+    if view.envelope.tag != "{%s}Envelope" % NS_MAP['SOAP-ENV']:
         raise Fault("No {%s}Envelope element was found!" % NS_MAP['SOAP-ENV'])
 
-    header_envelope = envelope.xpath("e:Header", namespaces={"e": NS_MAP['SOAP-ENV']})
-    body_envelope = envelope.xpath("e:Body", namespaces={"e": NS_MAP['SOAP-ENV']})
+    header, body = view.header, view.body
 
-    if len(header_envelope) == 0 and len(body_envelope) == 0:
+    if header is None and body is None:
         raise Fault("Soap envelope is empty!")
 
-    header = None
-    if len(header_envelope) > 0:
-        header = header_envelope[0]
-
-    body = None
-    if len(body_envelope) > 0:
-        body = body_envelope[0]
-
     return header, body
 
 
@@ -146,26 +458,23 @@ def extract_smev_parts(envelope):
     Выделение из SOAP-запроса относящихся к СМЭВу частей.
 
     :param  envelope:    XML-документ, содержащий SOAP-запрос.
-    :type   envelope:    lxml.Element
+    :type   envelope:    lxml.Element or EnvelopeView
 
     :return: Токен, подпись, заголовок сообщения, сообщение.
     :rtype:  list of lxml.Element
     '''
 
-    header, body = _from_soap(envelope)
-
-    security_node = tags(header, 'wsse:Security')
-    if security_node:
-        security_node = security_node[0]
-        token_node = tags(security_node, 'wsse:BinarySecurityToken')[0]
-        signature_node = tags(security_node, 'ds:Signature')[0]
-    else:
-        token_node = signature_node = None
+    view = EnvelopeView.of(envelope)
+    _from_soap(view)
 
-    message_node = tags(body, '//smev:Message')[0]
-    message_data_node = tags(body, '//smev:MessageData')[0]
+    message_node = view.message
+    if message_node is None:
+        raise Fault("No {%s}Message element was found!" % NS_MAP['smev'])
+    message_data_node = view.message_data
+    if message_data_node is None:
+        raise Fault("No {%s}MessageData element was found!" % NS_MAP['smev'])
 
-    return token_node, signature_node, message_node, message_data_node
+    return view.token, view.signature, message_node, message_data_node
 
 
 def dict_to_xmldoc(node, d, inherited_ns=None):
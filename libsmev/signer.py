@@ -1,21 +1,80 @@
 #coding: utf-8
 
+import os
+import copy
 import uuid
+import time
 import base64
-import os
-from tempfile import NamedTemporaryFile
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, namedtuple, deque
+from Queue import Queue
 
 from lxml import etree
 
-from helpers import run_cmd, tags, _from_soap
+import gost94
+from helpers import tag_single, _from_soap, EnvelopeView, parse_xml_string
+from crypto import CliBackend, CryptoError, FILE_CHUNK_SIZE
 from skeleton import make_node_with_ns
+from streaming import write_c14n, _get_binary_data
 from namespaces import NS_MAP
 
 
+# Использовать встроенную реализацию ГОСТ Р 34.11-94 (модуль gost94)
+# вместо криптографического модуля при вычислении хэш-кодов: True - всегда,
+# False - никогда, None - только для данных не больше BUILTIN_DIGEST_MAX_SIZE,
+# если модуль запускает внешние процессы (crypto.CliBackend). Модуль,
+# работающий в текущем процессе (crypto.LibcryptoBackend), при значении
+# None вычисляет все хэш-коды.
+USE_BUILTIN_DIGEST = None
+
+# Размер данных, до которого запуск процесса OpenSSL обходится дороже
+# встроенной реализации: запуск занимает около 5 мс, за это время
+# встроенная реализация обрабатывает около 1 КБ (4 КБ - уже около 20 мс).
+BUILTIN_DIGEST_MAX_SIZE = 1024
+
+# Криптографический модуль, см. configure_crypto_backend
+_crypto_backend = CliBackend()
+
+# Клиенты служб подписания, используемые sign_document: путь к сокету -
+# (номер процесса, клиент). Соединение не используется после fork.
+_signing_clients = {}
+_signing_clients_lock = threading.Lock()
+
+
 class SignerError(Exception):
     pass
 
 
+def configure_crypto_backend(backend=None):
+    u'''
+    Выбор криптографического модуля (см. модуль crypto), через который
+    выполняются вычисление хэш-кодов (см. USE_BUILTIN_DIGEST), ЭП и ее
+    проверка, работа с ключами и сертификатами.
+
+    Модуль наследуется процессами пулов, запускаемых после вызова.
+
+    :param crypto.CryptoBackend backend: Криптографический модуль
+                                         (по умолчанию - crypto.CliBackend).
+    :return: Текущий криптографический модуль.
+    :rtype: crypto.CryptoBackend
+    '''
+    global _crypto_backend
+    _crypto_backend = backend if backend is not None else CliBackend()
+    return _crypto_backend
+
+
+def get_crypto_backend():
+    u'''
+    Текущий криптографический модуль.
+
+    :rtype: crypto.CryptoBackend
+    '''
+    return _crypto_backend
+
+
 def _format_pem(data):
     u'''
     Форматирование текстового представления сертификата
@@ -75,14 +134,88 @@ def load_pubkey_from_pem(data):
 
     assert data, 'No PEM provided!'
 
-    load_key_cmd = ['openssl', 'x509', '-inform', 'PEM', '-pubkey', '-noout']
+    try:
+        return _crypto_backend.extract_public_key(data)
+    except CryptoError as err:
+        raise SignerError(unicode(err))
 
-    out, err = run_cmd(load_key_cmd, input=data)
 
-    if err:
-        raise SignerError(unicode(err))
+class PubkeyCache(object):
+    u'''
+    Ограниченный по размеру LRU-кэш публичных ключей, извлеченных
+    из сертификатов (BinarySecurityToken).
+
+    Ключом кэша является отпечаток SHA-1 сертификата. Записи старше
+    ttl секунд считаются устаревшими и извлекаются заново.
+
+    :param int maxsize: Максимальное количество хранимых ключей.
+    :param float ttl: Время жизни записи в секундах (None - без ограничения).
+    '''
 
-    return out
+    def __init__(self, maxsize=128, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(certificate):
+        u'''
+        Отпечаток сертификата, не зависящий от переносов строк.
+
+        :param unicode certificate: Текст сертификата в base64.
+        :rtype: str
+        '''
+        return hashlib.sha1(''.join(certificate.split())).hexdigest()
+
+    def get(self, certificate, loader=None):
+        u'''
+        Получение публичного ключа сертификата из кэша либо его
+        извлечение и сохранение в кэше.
+
+        :param unicode certificate: Текст сертификата в base64.
+        :param loader: Функция извлечения ключа из PEM сертификата
+                       (по умолчанию load_pubkey_from_pem).
+        :return: PEM, содержащий публичный ключ.
+        :rtype: unicode
+        '''
+        key = self.fingerprint(certificate)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (self.ttl is None or now - entry[0] < self.ttl):
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        public_key = (loader or load_pubkey_from_pem)(_format_pem(certificate))
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now, public_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return public_key
+
+    def clear(self):
+        u'''
+        Очистка кэша и счетчиков.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Кэш публичных ключей, используемый verify_envelope_signature
+pubkey_cache = PubkeyCache()
 
 
 def c14n_tags(tag):
@@ -98,10 +231,113 @@ def c14n_tags(tag):
     return etree.tostring(tag, method='c14n', exclusive=True, with_comments=False)
 
 
+def _use_backend_digest(size):
+    u'''
+    Вычислять ли хэш-код данных указанного размера криптографическим
+    модулем (см. USE_BUILTIN_DIGEST).
+    '''
+    if USE_BUILTIN_DIGEST is None:
+        return _crypto_backend.in_process or size > BUILTIN_DIGEST_MAX_SIZE
+    return not USE_BUILTIN_DIGEST
+
+
+class _Hasher(object):
+    u'''
+    Объект вычисления хэш-кода по ГОСТ Р 34.11-94, см. new_hasher.
+    '''
+
+    def __init__(self, threshold=None):
+        self._threshold = threshold
+        self._chunks = []
+        self._size = 0
+        self._digest = None
+        if threshold is None:
+            self._digest = self._call(_crypto_backend.new_digest)
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            return func(*args)
+        except (CryptoError, EnvironmentError) as err:
+            raise ValueError(u'OpenSSL error: %s' % err)
+
+    def update(self, data):
+        if self._digest is None:
+            self._chunks.append(data)
+            self._size += len(data)
+            if self._size <= self._threshold:
+                return
+            # Данных больше порога - передаем их криптографическому модулю
+            self._digest = self._call(_crypto_backend.new_digest)
+            data, self._chunks = ''.join(self._chunks), None
+        self._call(self._digest.update, data)
+
+    def digest(self):
+        if self._digest is None:
+            return gost94.new(''.join(self._chunks)).digest()
+        return self._call(self._digest.digest)
+
+
+def new_hasher():
+    u'''
+    Объект последовательного вычисления хэш-кода по ГОСТ Р 34.11-94
+    (методы update и digest) для данных, размер которых заранее
+    неизвестен.
+
+    Способ вычисления выбирается по USE_BUILTIN_DIGEST: при значении
+    None данные накапливаются, пока их размер не превысит
+    BUILTIN_DIGEST_MAX_SIZE, после чего передаются криптографическому
+    модулю по мере поступления.
+
+    :return: Объект хэширования.
+    '''
+    if USE_BUILTIN_DIGEST:
+        return gost94.new()
+    if USE_BUILTIN_DIGEST is None and not _crypto_backend.in_process:
+        return _Hasher(BUILTIN_DIGEST_MAX_SIZE)
+    return _Hasher()
+
+
+class _DigestWriter(object):
+    u'''
+    Файлоподобный объект, передающий записываемые данные в объект
+    хэширования.
+    '''
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+
+
+def get_c14n_digest(tag, binary_data=None):
+    u'''
+    Получение хэш-кода по ГОСТ Р 34.11-94 исключительной каноникализированной
+    формы дерева XML-элементов.
+
+    Каноникализированная форма не собирается в одну строку, а по частям
+    передается в объект хэширования, поэтому объем потребляемой памяти
+    не зависит от размера дерева (например, вложений в BinaryData).
+    Результат совпадает с get_text_digest(c14n_tags(tag)).
+
+    Содержимое вынесенных из дерева вложений (см. модуль streaming)
+    подставляется в каноникализированную форму по частям. Хэш-код
+    вычисляется объектом new_hasher.
+
+    :param lxml.Element tag: Корень дерева XML-элементов.
+    :param list binary_data: Вложения (BinaryDataFile, BinaryDataSource).
+    :return: Закодированный в base64 хэш-код.
+    :rtype: unicode
+    '''
+    hasher = new_hasher()
+    write_c14n(tag, _DigestWriter(hasher), binary_data)
+    return base64.b64encode(hasher.digest())
+
+
 def get_text_signature(text, private_key_fn, private_key_pass):
     u'''
-    Получение ЭП указанного текста через вызов внешнего экземпляра OpenSSL,
-    с использованием частного ключа ОИВ.
+    Получение ЭП указанного текста с использованием частного ключа ОИВ.
 
     :param unicode text: Подписываемый текст.
     :param unicode private_key_fn: Путь к PEM-файлу, содержащему частный ключ.
@@ -110,12 +346,47 @@ def get_text_signature(text, private_key_fn, private_key_pass):
     :return: Закодированная в base64 ЭП текста.
     :rtype: unicode
     '''
-    openssl_sign_cmd = [
-        'openssl', 'dgst', '-sign', private_key_fn, '-binary',
-        '-md_gost94', '-passin', 'stdin']
+    try:
+        out = _crypto_backend.sign_with_key_file(text, private_key_fn, private_key_pass)
+    except CryptoError as err:
+        raise ValueError(u'OpenSSL error: %s' % err)
+
+    return base64.b64encode(out)
+
+
+def decrypt_private_key(data, private_key_pass):
+    u'''
+    Расшифровка частного ключа из PEM-контейнера.
+
+    :param unicode data: Содержимое PEM-контейнера с зашифрованным
+                         частным ключом.
+    :param unicode private_key_pass: Пароль к частному ключу.
+    :return: PEM с расшифрованным частным ключом.
+    :rtype: unicode
+    '''
+    try:
+        return _crypto_backend.decrypt_private_key(data, private_key_pass)
+    except CryptoError as err:
+        raise SignerError(u'OpenSSL error: %s' % err)
+
+
+def get_text_signature_with_key(text, private_key):
+    u'''
+    Получение ЭП указанного текста с использованием расшифрованного
+    частного ключа (см. decrypt_private_key).
 
-    out, err = run_cmd(openssl_sign_cmd, input=private_key_pass + '\n' + text)
-    if err:
+    Ключ не записывается на диск (модулем crypto.CliBackend передается
+    OpenSSL через канал).
+
+    :param unicode text: Подписываемый текст.
+    :param unicode private_key: PEM с расшифрованным частным ключом.
+
+    :return: Закодированная в base64 ЭП текста.
+    :rtype: unicode
+    '''
+    try:
+        out = _crypto_backend.sign(text, private_key)
+    except CryptoError as err:
         raise ValueError(u'OpenSSL error: %s' % err)
 
     return base64.b64encode(out)
@@ -126,14 +397,19 @@ def get_text_digest(text):
     Получение текстового представления хэш-кода переданного текста
     по ГОСТ Р 34.11-94.
 
+    Хэш-код вычисляется встроенной реализацией или криптографическим
+    модулем (см. USE_BUILTIN_DIGEST, configure_crypto_backend).
+
     :param unicode text: Текст, хэш-код которого необходимо получить.
     :return: Закодированный в base64 хэш-код текста.
     :rtype:  unicode
     '''
-    openssl_sign_cmd = ['openssl', 'dgst', '-binary', '-md_gost94']
+    if not _use_backend_digest(len(text)):
+        return base64.b64encode(gost94.new(text).digest())
 
-    out, err = run_cmd(openssl_sign_cmd, input=text)
-    if err:
+    try:
+        out = _crypto_backend.digest(text)
+    except CryptoError as err:
         raise ValueError(u'OpenSSL error: %s' % err)
 
     return base64.b64encode(out)
@@ -144,28 +420,66 @@ def get_file_digest(fn):
     Получение текстового представления хэш-кода переданного файла
     по ГОСТ Р 34.11-94.
 
+    Хэш-код вычисляется встроенной реализацией или криптографическим
+    модулем (см. USE_BUILTIN_DIGEST, configure_crypto_backend).
+
     :param unicode fn: Путь к файлу, хэш-код которого необходимо получить.
     :return: Закодированный в base64 хэш-код текста.
     :rtype: unicode
     '''
-    openssl_sign_cmd = ['openssl', 'dgst', '-binary', '-md_gost94', fn]
-
-    out, err = run_cmd(openssl_sign_cmd)
-    if err:
+    if not _use_backend_digest(os.path.getsize(fn)):
+        hasher = gost94.new()
+        with open(fn, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(FILE_CHUNK_SIZE), ''):
+                hasher.update(chunk)
+        return base64.b64encode(hasher.digest())
+
+    try:
+        out = _crypto_backend.file_digest(fn)
+    except CryptoError as err:
         raise ValueError(u'OpenSSL error: %s' % err)
 
     return base64.b64encode(out)
 
 
-def construct_wsse_header(digest=None, signature=None, certificate=None):
+def get_file_digests(paths):
     u'''
-    Формирование в виде дерева XML-элементов заголовка WS-Security.
+    Получение хэш-кодов по ГОСТ Р 34.11-94 для списка файлов.
 
-    :param unicode digest: Хэш-код подписи элементов сообщения.
-    :param unicode signature: ЭП сообщения.
-    :param unicode certificate: Открытый ключ сообщения.
+    Файлы, хэш-коды которых вычисляются криптографическим модулем
+    (см. USE_BUILTIN_DIGEST), обрабатываются одним вызовом:
+    crypto.CliBackend запускает минимальное количество процессов OpenSSL,
+    каждый обрабатывает столько файлов, сколько позволяет длина командной
+    строки.
 
-    :return: WS-Security заголовок.
+    :param list paths: Пути к файлам.
+    :return: Словарь путь к файлу - закодированный в base64 хэш-код.
+    :rtype: dict
+    '''
+    result, backend_paths = {}, []
+    for fn in paths:
+        if _use_backend_digest(os.path.getsize(fn)):
+            backend_paths.append(fn)
+        else:
+            result[fn] = get_file_digest(fn)
+
+    if backend_paths:
+        try:
+            digests = _crypto_backend.file_digests(backend_paths)
+        except CryptoError as err:
+            raise ValueError(u'OpenSSL error: %s' % err)
+        for fn, out in digests.iteritems():
+            result[fn] = base64.b64encode(out)
+
+    return result
+
+
+def _build_wsse_header_template():
+    u'''
+    Формирование шаблона заголовка WS-Security, содержащего только
+    постоянные для всех сообщений элементы и атрибуты.
+
+    :return: Шаблон WS-Security заголовка.
     :rtype: lxml.Element
     '''
     ds_node = make_node_with_ns('ds')
@@ -196,8 +510,6 @@ def construct_wsse_header(digest=None, signature=None, certificate=None):
     #x509_data_node = ds_node('X509Data')
     #x509_cert_node = ds_node('X509Certificate')
 
-    binary_sec_token_node.text = certificate
-
     # Установка предопределенных значений согласно метод. рекомендациям v. 2.5.6
     c14n_method_node.attrib['Algorithm'] = 'http://www.w3.org/2001/10/xml-exc-c14n#'
     transform2_node.attrib['Algorithm'] = 'http://www.w3.org/2001/10/xml-exc-c14n#'
@@ -208,9 +520,8 @@ def construct_wsse_header(digest=None, signature=None, certificate=None):
     reference_node.attrib['URI'] = '#body'
     binary_sec_token_node.attrib['EncodingType'] = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-soap-message-security-1.0#Base64Binary'
     binary_sec_token_node.attrib['ValueType'] = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3'
-    cert_id = 'CertId-%s' % str(uuid.uuid4())
-    binary_sec_token_node.attrib['{%s}Id' % NS_MAP['wsu']] = cert_id
-    token_reference_node.attrib['URI'] = '#%s' % cert_id
+    # Ссылка на сертификат заполняется при копировании шаблона
+    token_reference_node.attrib['URI'] = ''
     token_reference_node.attrib['ValueType'] = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3'
 
     sec_token_reference_node.append(token_reference_node)
@@ -246,59 +557,473 @@ def construct_wsse_header(digest=None, signature=None, certificate=None):
     return security_node
 
 
-def sign_document(doc, priv_key_fn, priv_key_pass, cert_file=None):
+# Шаблон заголовка WS-Security, копируемый при подписании сообщений
+_WSSE_HEADER_TEMPLATE = _build_wsse_header_template()
+
+# Элементы заголовка WS-Security, изменяемые при подписании сообщения
+WsseHeader = namedtuple('WsseHeader', [
+    'security', 'token', 'signed_info', 'reference', 'digest_value',
+    'signature_value'])
+
+
+def _new_wsse_header(certificate=None, digest=None, signature=None):
+    u'''
+    Создание заголовка WS-Security копированием шаблона и заполнение
+    изменяемых для каждого сообщения значений.
+
+    :param unicode certificate: Открытый ключ сообщения.
+    :param unicode digest: Хэш-код подписи элементов сообщения.
+    :param unicode signature: ЭП сообщения.
+    :return: Элементы заголовка.
+    :rtype: WsseHeader
+    '''
+    security_node = copy.deepcopy(_WSSE_HEADER_TEMPLATE)
+    token_node, signature_node = security_node
+    signed_info_node, signature_value_node, key_info_node = signature_node
+    reference_node = signed_info_node[2]
+    digest_value_node = reference_node[2]
+
+    cert_id = 'CertId-%s' % str(uuid.uuid4())
+    token_node.text = certificate
+    token_node.attrib['{%s}Id' % NS_MAP['wsu']] = cert_id
+    key_info_node[0][0].attrib['URI'] = '#%s' % cert_id
+
+    digest_value_node.text = digest
+    signature_value_node.text = signature
+
+    return WsseHeader(security_node, token_node, signed_info_node, reference_node,
+                      digest_value_node, signature_value_node)
+
+
+def _find_wsse_header(security_node):
+    u'''
+    Поиск изменяемых при подписании элементов в существующем
+    заголовке WS-Security.
+
+    :param lxml.Element security_node: Заголовок WS-Security.
+    :rtype: WsseHeader
+    '''
+    return WsseHeader(
+        security_node,
+        tag_single(security_node, 'wsse:BinarySecurityToken'),
+        tag_single(security_node, 'ds:Signature/ds:SignedInfo'),
+        tag_single(security_node, 'ds:Signature/ds:SignedInfo/ds:Reference'),
+        tag_single(security_node, 'ds:Signature/ds:SignedInfo/ds:Reference/ds:DigestValue'),
+        tag_single(security_node, 'ds:Signature/ds:SignatureValue'))
+
+
+def construct_wsse_header(digest=None, signature=None, certificate=None):
+    u'''
+    Формирование в виде дерева XML-элементов заголовка WS-Security.
+
+    Заголовок создается копированием заранее сформированного шаблона.
+
+    :param unicode digest: Хэш-код подписи элементов сообщения.
+    :param unicode signature: ЭП сообщения.
+    :param unicode certificate: Открытый ключ сообщения.
+
+    :return: WS-Security заголовок.
+    :rtype: lxml.Element
+    '''
+    return _new_wsse_header(certificate, digest, signature).security
+
+
+def _prepare_envelope(doc, certificate):
+    u'''
+    Первый этап подписания сообщения: добавление заголовка WS-Security
+    и идентификатора тела.
+
+    :param doc: Подписываемый XML-документ.
+    :type doc: lxml.Element or EnvelopeView
+    :param certificate: Функция, возвращающая base64-представление
+                        сертификата (вызывается, если в документе
+                        еще нет заголовка WS-Security).
+    :return: Тело сообщения и элементы заголовка WS-Security.
+    :rtype: (lxml.Element, WsseHeader)
+    '''
+    view = EnvelopeView.of(doc)
+    header_node = view.header
+
+    if header_node is None:
+        header_node = etree.Element('{%s}Header' % NS_MAP['SOAP-ENV'])
+        view.envelope.insert(0, header_node)
+
+    security_node = view.security
+
+    if security_node is not None:
+        wsse_header = _find_wsse_header(security_node)
+    else:
+        wsse_header = _new_wsse_header(certificate=certificate())
+        header_node.append(wsse_header.security)
+
+    body_node = view.body
+    if body_node is None:
+        raise SignerError("'Body' tag not found in SOAP envelope!'")
+    body_id = "Id-%s" % str(uuid.uuid4())
+    body_node.attrib['{%s}Id' % NS_MAP['wsu']] = body_id
+    wsse_header.reference.attrib['URI'] = "#%s" % body_id
+
+    return body_node, wsse_header
+
+
+def _set_digest_value(wsse_header, digest_value):
+    u'''
+    Второй этап подписания сообщения: запись хэш-кода тела.
+
+    :param WsseHeader wsse_header: Элементы заголовка WS-Security.
+    :param unicode digest_value: Хэш-код каноникализированного тела.
+    :return: Каноникализированный блок SignedInfo.
+    :rtype: str
+    '''
+    wsse_header.digest_value.text = digest_value
+    return c14n_tags(wsse_header.signed_info)
+
+
+def _set_signature_value(doc, wsse_header, signature_value):
+    u'''
+    Последний этап подписания сообщения: запись ЭП блока SignedInfo.
+
+    :param doc: Подписываемый XML-документ.
+    :type doc: lxml.Element or EnvelopeView
+    :param WsseHeader wsse_header: Элементы заголовка WS-Security.
+    :param unicode signature_value: ЭП блока SignedInfo.
+    :return: Подписанный XML-документ.
+    :rtype:  lxml.Element
+    '''
+    wsse_header.signature_value.text = signature_value
+    return EnvelopeView.of(doc).envelope
+
+
+def _sign_envelope(doc, certificate, get_signature):
+    u'''
+    Подписание сообщения: вычисление хэш-кода тела и ЭП блока SignedInfo.
+
+    :param doc: Подписываемый XML-документ.
+    :type doc: lxml.Element or EnvelopeView
+    :param certificate: Функция, возвращающая base64-представление
+                        сертификата (см. _prepare_envelope).
+    :param get_signature: Функция получения ЭП текста.
+
+    :return: Подписанный XML-документ.
+    :rtype:  lxml.Element
+    '''
+    body_node, wsse_header = _prepare_envelope(doc, certificate)
+    c14n_sign_info = _set_digest_value(
+        wsse_header, get_c14n_digest(body_node, _get_binary_data(doc, None)))
+    return _set_signature_value(doc, wsse_header, get_signature(c14n_sign_info))
+
+
+def _sign_envelopes(docs, certificate, get_signature, workers=None, pools=None,
+                    window=None):
+    u'''
+    Конвейерное подписание множества сообщений.
+
+    Хэш-коды тел вычисляются в пуле процессов, ЭП - в пуле потоков
+    (каждая ЭП - вызов внешнего процесса OpenSSL), каноникализация и
+    изменение документов выполняются в текущем потоке. Таким образом,
+    этапы подписания разных сообщений выполняются одновременно.
+
+    Одновременно обрабатывается не более window сообщений: следующий
+    документ берется из docs только после завершения подписания самого
+    раннего, поэтому промежуточные данные (каноникализированные тела,
+    блоки SignedInfo) хранятся в памяти только для них.
+
+    :param docs: Подписываемые XML-документы.
+    :param certificate: Функция, возвращающая base64-представление сертификата.
+    :param get_signature: Функция получения ЭП текста.
+    :param int workers: Размер пулов (по умолчанию - по числу ядер).
+    :param tuple pools: Используемые пулы процессов и потоков (не закрываются).
+    :param int window: Количество одновременно обрабатываемых сообщений
+                       (по умолчанию - четыре на исполнителя).
+    :return: Подписанные XML-документы или исключения, возникшие
+             при подписании соответствующих документов.
+    :rtype: list
+    '''
+    workers = workers or multiprocessing.cpu_count()
+    window = window or 4 * workers
+    if pools is None:
+        digest_pool, signature_pool = multiprocessing.Pool(workers), ThreadPool(workers)
+    else:
+        digest_pool, signature_pool = pools
+
+    def stage(func, *args):
+        try:
+            return func(*args)
+        except Exception as err:
+            return err
+
+    def start_digest(doc):
+        u'''
+        Каноникализация тела и запуск вычисления его хэш-кода.
+        '''
+        prepared = stage(_prepare_envelope, doc, certificate)
+        if isinstance(prepared, Exception):
+            return _SigningJob(doc, None, prepared)
+        body_node, wsse_header = prepared
+        binary_data = _get_binary_data(doc, None)
+        if binary_data:
+            # Вложения подставляются при каноникализации по частям,
+            # поэтому хэш-код вычисляется в пуле потоков
+            return _SigningJob(doc, wsse_header, signature_pool.apply_async(
+                get_c14n_digest, (body_node, binary_data)))
+        c14n_body = stage(c14n_tags, body_node)
+        if not isinstance(c14n_body, Exception):
+            c14n_body = digest_pool.apply_async(get_text_digest, (c14n_body,))
+        return _SigningJob(doc, wsse_header, c14n_body)
+
+    def start_signature(job):
+        u'''
+        Запись хэш-кода и запуск вычисления ЭП.
+        '''
+        digest = job.result
+        if not isinstance(digest, Exception):
+            digest = stage(digest.get)
+        if not isinstance(digest, Exception):
+            c14n_sign_info = stage(_set_digest_value, job.wsse_header, digest)
+            if isinstance(c14n_sign_info, Exception):
+                digest = c14n_sign_info
+            else:
+                digest = signature_pool.apply_async(get_signature, (c14n_sign_info,))
+        job.result, job.signing = digest, True
+
+    def finish(job):
+        if not job.signing:
+            start_signature(job)
+        signature = job.result
+        if not isinstance(signature, Exception):
+            signature = stage(signature.get)
+        if isinstance(signature, Exception):
+            return signature
+        return stage(_set_signature_value, job.doc, job.wsse_header, signature)
+
+    try:
+        results, jobs = [], deque()
+        for doc in docs:
+            jobs.append(start_digest(doc))
+            # Готовые хэш-коды передаются на вычисление ЭП
+            for job in jobs:
+                if not job.signing and job.ready():
+                    start_signature(job)
+            # Готовые сообщения выдаются в исходном порядке; при заполнении
+            # окна ожидается завершение самого раннего
+            while jobs and (len(jobs) >= window or jobs[0].signing and jobs[0].ready()):
+                results.append(finish(jobs.popleft()))
+
+        while jobs:
+            results.append(finish(jobs.popleft()))
+        return results
+    finally:
+        if pools is None:
+            digest_pool.terminate()
+            signature_pool.terminate()
+            digest_pool.join()
+            signature_pool.join()
+
+
+class _SigningJob(object):
+    u'''
+    Состояние подписания сообщения в конвейере _sign_envelopes: результат
+    текущего этапа (AsyncResult) или возникшее исключение.
+    '''
+
+    __slots__ = ('doc', 'wsse_header', 'result', 'signing')
+
+    def __init__(self, doc, wsse_header, result):
+        self.doc = doc
+        self.wsse_header = wsse_header
+        self.result = result
+        self.signing = False
+
+    def ready(self):
+        return isinstance(self.result, Exception) or self.result.ready()
+
+
+def sign_document(doc, priv_key_fn=None, priv_key_pass=None, cert_file=None,
+                  socket_path=None):
     u'''
     Подписание сообщения без вложения согласно ГОСТ Р 34.10-2001.
 
-    :param lxml.Element doc: Подписываемый XML-документ, содержащий себе в себе СМЭВ-сообщение.
+    Для подписания множества сообщений одним ключом следует использовать
+    класс Signer.
+
+    Если указан путь к сокету службы подписания (см. модуль
+    signing_service), ЭП блока SignedInfo вычисляется службой, ключ
+    и пароль не используются. Соединение со службой и полученный от нее
+    сертификат используются повторно при следующих вызовах.
+
+    :param doc: Подписываемый XML-документ, содержащий себе в себе СМЭВ-сообщение.
+    :type doc: lxml.Element or EnvelopeView
     :param unicode priv_key_fn: Путь к файлу с частному ключу подписи.
     :param unicode priv_key_pass: Пароль к частному ключу подписи.
     :param unicode cert_file: Путь к файлу с сертификатом.
+    :param unicode socket_path: Путь к сокету службы подписания.
 
     :return: Подписанный XML-документ.
     :rtype:  lxml.Element
     '''
-    header_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header')
+    if socket_path is not None:
+        return _get_signing_client(socket_path).sign(doc)
 
-    if not header_node:
-        header_node = [etree.Element('{%s}Header' % NS_MAP['SOAP-ENV'])]
-        doc.insert(0, header_node[0])
+    def certificate():
+        with open(cert_file or priv_key_fn, 'rb') as cert_file_fh:
+            return load_cert_from_pem(cert_file_fh.read())
 
-    security_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security')
+    return _sign_envelope(
+        doc, certificate,
+        lambda text: get_text_signature(text, priv_key_fn, priv_key_pass))
 
-    if not security_node:
-        if cert_file is not None:
-            with open(cert_file, 'rb') as cert_file_fh:
-                cert_data = load_cert_from_pem(cert_file_fh.read())
-        else:
-            with open(priv_key_fn, 'rb') as priv_key_file:
-                cert_data = load_cert_from_pem(priv_key_file.read())
-        wsse_header_node = construct_wsse_header(certificate=cert_data)
-        header_node[0].append(wsse_header_node)
 
-    body_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Body')
-    body_id = "Id-%s" % str(uuid.uuid4())
-    body_node[0].attrib['{%s}Id' % NS_MAP['wsu']] = body_id
+def _get_signing_client(socket_path):
+    u'''
+    Клиент службы подписания текущего процесса.
 
-    reference_node = tags(
-        doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security/'
-             'ds:Signature/ds:SignedInfo/ds:Reference')
-    reference_node[0].attrib['URI'] = "#%s" % body_id
+    :param unicode socket_path: Путь к сокету службы подписания.
+    :rtype: signing_service.SigningClient
+    '''
+    from signing_service import SigningClient
 
-    c14n_body = c14n_tags(body_node[0])
-    digest_value = get_text_digest(c14n_body)
+    pid = os.getpid()
+    with _signing_clients_lock:
+        client_pid, client = _signing_clients.get(socket_path, (None, None))
+        if client_pid != pid:
+            client = SigningClient(socket_path)
+            _signing_clients[socket_path] = pid, client
+        return client
 
-    digest_val_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security/ds:Signature/ds:SignedInfo/ds:Reference/ds:DigestValue')
-    digest_val_node[0].text = digest_value
 
-    sign_info_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security/ds:Signature/ds:SignedInfo')
-    c14n_sign_info = c14n_tags(sign_info_node[0])
-    signature_value = get_text_signature(c14n_sign_info, priv_key_fn, priv_key_pass)
+class Signer(object):
+    u'''
+    Подписание сообщений одним и тем же ключом.
 
-    sign_val_node = tags(doc, '/SOAP-ENV:Envelope/SOAP-ENV:Header/wsse:Security/ds:Signature/ds:SignatureValue')
-    sign_val_node[0].text = signature_value
+    Сертификат считывается и разбирается один раз при создании объекта,
+    частный ключ расшифровывается один раз и хранится в памяти (при
+    отсутствии поддержки каналов в ОС - используется файл ключа и пароль).
 
-    return doc
+    Пулы конвейерного подписания (см. sign_many) запускаются при первом
+    вызове и используются повторно до вызова close (или выхода из блока
+    with).
+
+    :param unicode priv_key_fn: Путь к файлу с частному ключу подписи.
+    :param unicode priv_key_pass: Пароль к частному ключу подписи.
+    :param unicode cert_file: Путь к файлу с сертификатом.
+    '''
+
+    def __init__(self, priv_key_fn, priv_key_pass, cert_file=None):
+        self.priv_key_fn = priv_key_fn
+        self._pools = None
+        self._workers = None
+
+        with open(priv_key_fn, 'rb') as priv_key_file:
+            priv_key_data = priv_key_file.read()
+
+        if cert_file is not None:
+            with open(cert_file, 'rb') as cert_file_fh:
+                self.certificate = load_cert_from_pem(cert_file_fh.read())
+        else:
+            self.certificate = load_cert_from_pem(priv_key_data)
+
+        if _crypto_backend.supports_key_data:
+            self._priv_key_pass = None
+            self._private_key = decrypt_private_key(priv_key_data, priv_key_pass)
+        else:
+            self._priv_key_pass = priv_key_pass
+            self._private_key = None
+
+    def get_text_signature(self, text):
+        u'''
+        Получение ЭП указанного текста.
+
+        :param unicode text: Подписываемый текст.
+        :return: Закодированная в base64 ЭП текста.
+        :rtype: unicode
+        '''
+        if self._private_key is not None:
+            return get_text_signature_with_key(text, self._private_key)
+        return get_text_signature(text, self.priv_key_fn, self._priv_key_pass)
+
+    def sign(self, doc):
+        u'''
+        Подписание сообщения (см. sign_document).
+
+        :param lxml.Element doc: Подписываемый XML-документ.
+        :return: Подписанный XML-документ.
+        :rtype:  lxml.Element
+        '''
+        return _sign_envelope(doc, lambda: self.certificate, self.get_text_signature)
+
+    def sign_many(self, docs, workers=None, window=None):
+        u'''
+        Подписание нескольких сообщений.
+
+        Если указано более одного исполнителя, этапы подписания разных
+        сообщений выполняются конвейером (см. sign_documents). Ошибка
+        подписания одного сообщения не прерывает подписание остальных:
+        вместо такого документа возвращается исключение.
+
+        :param docs: Подписываемые XML-документы.
+        :type docs: iterable of lxml.Element
+        :param int workers: Количество исполнителей (None или 1 -
+                            последовательное подписание).
+        :param int window: Количество одновременно обрабатываемых
+                           сообщений (по умолчанию - четыре на исполнителя).
+        :return: Подписанные XML-документы или исключения.
+        :rtype: list
+        '''
+        if workers is None or workers == 1:
+            results = []
+            for doc in docs:
+                try:
+                    results.append(self.sign(doc))
+                except Exception as err:
+                    results.append(err)
+            return results
+
+        if self._workers != workers:
+            self.close()
+            self._pools = multiprocessing.Pool(workers), ThreadPool(workers)
+            self._workers = workers
+        return _sign_envelopes(docs, lambda: self.certificate, self.get_text_signature,
+                               workers, self._pools, window)
+
+    def close(self):
+        u'''
+        Завершение пулов конвейерного подписания.
+        '''
+        if self._pools is not None:
+            for pool in self._pools:
+                pool.terminate()
+            for pool in self._pools:
+                pool.join()
+            self._pools = self._workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def sign_documents(docs, priv_key_fn, priv_key_pass, cert_file=None, workers=None):
+    u'''
+    Пакетное подписание сообщений одним ключом.
+
+    Каноникализация, вычисление хэш-кода и ЭП разных сообщений выполняются
+    одновременно в пулах процессов и потоков, порядок результатов
+    соответствует порядку документов. Ошибка подписания одного сообщения
+    не прерывает подписание остальных: вместо такого документа
+    возвращается исключение.
+
+    :param docs: Подписываемые XML-документы.
+    :type docs: iterable of lxml.Element
+    :param unicode priv_key_fn: Путь к файлу с частному ключу подписи.
+    :param unicode priv_key_pass: Пароль к частному ключу подписи.
+    :param unicode cert_file: Путь к файлу с сертификатом.
+    :param int workers: Размер пулов (по умолчанию - по числу ядер).
+    :return: Подписанные XML-документы или исключения.
+    :rtype: list
+    '''
+    with Signer(priv_key_fn, priv_key_pass, cert_file) as signer:
+        return signer.sign_many(docs, workers=workers or multiprocessing.cpu_count())
 
 
 def verify_gost94_signature(text, public_key, signature_value):
@@ -313,70 +1038,246 @@ def verify_gost94_signature(text, public_key, signature_value):
     :type: boolean
     '''
 
-    # Так как OpenSSL не умеет считывать значения подписи и проверяемый
-    # текст со стандартного ввода, мы вынуждены использовать временные файлы.
-    # После записи они закрываются, т.к. Windows не позволяет считывать
-    # открытые файлы.
-    tmp_public_key = NamedTemporaryFile(delete=False)
-    tmp_public_key.file.write(public_key)
-    tmp_public_key.file.close()
-
-    tmp_signature_value = NamedTemporaryFile(delete=False)
-    tmp_signature_value.file.write(base64.b64decode(signature_value))
-    tmp_signature_value.file.close()
-
-    openssl_sign_cmd = ['openssl', 'dgst', '-md_gost94', '-verify',
-                        tmp_public_key.name, '-signature',
-                        tmp_signature_value.name]
-
-    out, err = run_cmd(openssl_sign_cmd, input=text)
-
-    if err:
+    try:
+        return _crypto_backend.verify(text, public_key, base64.b64decode(signature_value))
+    except CryptoError as err:
         raise SignerError(unicode(err))
 
-    # Убираем за собой
-    os.remove(tmp_signature_value.name)
-    os.remove(tmp_public_key.name)
-
-    return out.strip() == "Verified OK"
 
-
-def verify_envelope_signature(envelope):
+def verify_envelope_signature(envelope, cache=None):
     u'''
     Проверка подписи SOAP-запроса по ГОСТ Р 34.11-94.
 
-    :param lxml.Element envelope: Подписанный XML-документ.
+    Публичный ключ, извлеченный из сертификата отправителя, сохраняется
+    в кэше (по умолчанию - pubkey_cache).
+
+    :param envelope: Подписанный XML-документ.
+    :type envelope: lxml.Element or EnvelopeView
+    :param PubkeyCache cache: Кэш публичных ключей.
     :return: Флаг корректности подписи документа.
     :rtype: boolean
     '''
 
-    header, body = _from_soap(envelope)
+    body, digest_value, certificate, signed_info, signature_value = \
+        _find_signature_nodes(envelope)
+
+    if digest_value != get_c14n_digest(body, _get_binary_data(envelope, None)):
+        return False
+
+    return _verify_signature_parts(
+        (None, digest_value, certificate, c14n_tags(signed_info), signature_value),
+        cache, check_digest=False)
+
+
+def _find_signature_nodes(envelope):
+    u'''
+    Поиск в подписанном SOAP-запросе элементов, необходимых для
+    проверки подписи.
+
+    :param envelope: Подписанный XML-документ.
+    :type envelope: lxml.Element or EnvelopeView
+    :return: Кортеж (тело, DigestValue, сертификат, SignedInfo,
+             SignatureValue).
+    :rtype: tuple
+    '''
+    view = EnvelopeView.of(envelope)
+    header, body = _from_soap(view)
 
     if body is None:
         raise SignerError("'Body' tag not found in SOAP envelope!'")
 
-    digest_value = tags(envelope, ".//ds:DigestValue")
-    if not digest_value:
+    digest_value = view.digest_value
+    if digest_value is None:
         raise SignerError("'DigestValue' tag is not found")
 
-    binary_security_token = tags(envelope, './/wsse:BinarySecurityToken')
-    if not binary_security_token:
+    binary_security_token = view.token
+    if binary_security_token is None:
         raise SignerError("'BinarySecurityToken' tag is not found")
 
-    signed_info = tags(envelope, './/ds:SignedInfo')
-    if not signed_info:
+    signed_info = view.signed_info
+    if signed_info is None:
         raise SignerError("`SignedInfo' tag is not found")
 
-    signature_value = tags(envelope, ".//ds:SignatureValue")
-    if not signed_info:
+    signature_value = view.signature_value
+    if signature_value is None:
         raise SignerError("`SignatureValue' tag is not found")
 
-    if digest_value[0].text != get_text_digest(c14n_tags(body)):
-        return False
+    return (body, digest_value.text, binary_security_token.text,
+            signed_info, signature_value.text)
+
+
+def _extract_signature_parts(envelope):
+    u'''
+    Выделение из подписанного SOAP-запроса данных, необходимых для
+    проверки подписи: каноникализированных тела и блока SignedInfo,
+    хэш-кода, сертификата и значения подписи.
+
+    Для сообщений с вынесенными из дерева вложениями вместо
+    каноникализированного тела передается вычисленный хэш-код
+    (кортеж из одного элемента).
+
+    :param envelope: Подписанный XML-документ.
+    :type envelope: lxml.Element or EnvelopeView
+    :return: Кортеж (c14n тела, DigestValue, сертификат, c14n SignedInfo,
+             SignatureValue).
+    :rtype: tuple
+    '''
+    body, digest_value, certificate, signed_info, signature_value = \
+        _find_signature_nodes(envelope)
+    binary_data = _get_binary_data(envelope, None)
+    if binary_data:
+        c14n_body = (get_c14n_digest(body, binary_data),)
+    else:
+        c14n_body = c14n_tags(body)
+    return (c14n_body, digest_value, certificate,
+            c14n_tags(signed_info), signature_value)
+
+
+def _verify_signature_parts(parts, cache=None, check_digest=True):
+    u'''
+    Проверка подписи по данным, выделенным _extract_signature_parts.
+
+    :param tuple parts: Данные для проверки подписи.
+    :param PubkeyCache cache: Кэш публичных ключей.
+    :param bool check_digest: Флаг проверки хэш-кода тела.
+    :return: Флаг корректности подписи документа.
+    :rtype: boolean
+    '''
+    c14n_body, digest_value, certificate, c14n_signed_info, signature_value = parts
+
+    if check_digest:
+        if isinstance(c14n_body, tuple):
+            body_digest, = c14n_body
+        else:
+            body_digest = get_text_digest(c14n_body)
+        if digest_value != body_digest:
+            return False
 
     # Извлекаем публичный ключ из заголовка WS-Security
-    tmp_cert = _format_pem(binary_security_token[0].text)
-    public_key = load_pubkey_from_pem(tmp_cert)
+    public_key = (cache if cache is not None else pubkey_cache).get(certificate)
+
+    return verify_gost94_signature(c14n_signed_info, public_key, signature_value)
+
+
+def _stage(func, *args):
+    try:
+        return func(*args)
+    except Exception as err:
+        return err
+
+
+def _verify_job(job):
+    u'''
+    Проверка подписи одного запроса в процессе-исполнителе.
+
+    :param tuple job: Номер запроса и сериализованный запрос (или данные,
+                      выделенные _extract_signature_parts, или исключение).
+    :return: Номер запроса и флаг корректности подписи (или исключение).
+    :rtype: tuple
+    '''
+    index, data = job
+    if isinstance(data, Exception):
+        return index, data
+    try:
+        if not isinstance(data, tuple):
+            data = _extract_signature_parts(parse_xml_string(data))
+        return index, _verify_signature_parts(data)
+    except Exception as err:
+        return index, err
+
 
-    return verify_gost94_signature(c14n_tags(signed_info[0]), public_key,
-                                   signature_value[0].text)
+def _verify_jobs(jobs):
+    return [_verify_job(job) for job in jobs]
+
+
+def verify_envelopes(envelopes, workers=None, ordered=True, chunksize=1, window=None):
+    u'''
+    Проверка подписей множества SOAP-запросов в нескольких процессах.
+
+    Процессам-исполнителям передаются сериализованные запросы, разбор,
+    каноникализация и проверка подписи выполняются в них. Запросы с
+    вынесенными из дерева вложениями (streaming.StreamedEnvelope)
+    каноникализируются в текущем процессе. Ошибка проверки одного
+    запроса не прерывает проверку остальных: вместо флага для такого
+    запроса возвращается исключение.
+
+    Одновременно проверяется не более window запросов: следующий запрос
+    берется из envelopes только после получения результата одного из
+    предыдущих.
+
+    :param envelopes: Подписанные XML-документы.
+    :type envelopes: iterable of lxml.Element
+    :param int workers: Количество процессов (по умолчанию - по числу ядер,
+                        1 - проверка в текущем процессе).
+    :param bool ordered: Возвращать результаты в порядке запросов; если
+                         False - пары (номер запроса, результат) по мере
+                         готовности.
+    :param int chunksize: Количество запросов, передаваемых процессу за раз.
+    :param int window: Количество одновременно проверяемых запросов
+                       (по умолчанию - четыре на процесс).
+    :return: Флаги корректности подписей (или исключения).
+    :rtype: iterator
+    '''
+    if workers == 1:
+        results = (_verify_job((index, _stage(_extract_signature_parts, envelope)))
+                   for index, envelope in enumerate(envelopes))
+    else:
+        results = _verify_in_pool(envelopes, workers or multiprocessing.cpu_count(),
+                                  ordered, chunksize, window)
+
+    if ordered:
+        return (result for index, result in results)
+    return results
+
+
+def _serialize_envelope(envelope):
+    u'''
+    Данные запроса, передаваемые процессу-исполнителю.
+    '''
+    if _get_binary_data(envelope, None):
+        # Вложения не передаются в другой процесс
+        return _extract_signature_parts(envelope)
+    return etree.tostring(EnvelopeView.of(envelope).envelope)
+
+
+def _verify_in_pool(envelopes, workers, ordered, chunksize, window):
+    u'''
+    Проверка подписей в пуле процессов с ограничением количества
+    одновременно проверяемых запросов и остановкой пула по завершении
+    перебора результатов.
+    '''
+    window = max(window or 4 * workers, chunksize)
+    pool = multiprocessing.Pool(workers)
+    pending, done = deque(), Queue()
+
+    def start(chunk):
+        if ordered:
+            pending.append(pool.apply_async(_verify_jobs, (chunk,)))
+        else:
+            pool.apply_async(_verify_jobs, (chunk,), callback=done.put)
+            pending.append(None)
+
+    def finish():
+        result = pending.popleft()
+        return result.get() if ordered else done.get()
+
+    try:
+        chunk = []
+        for index, envelope in enumerate(envelopes):
+            chunk.append((index, _stage(_serialize_envelope, envelope)))
+            if len(chunk) < chunksize:
+                continue
+            start(chunk)
+            chunk = []
+            # Следующие запросы берутся только при свободном месте в окне
+            while len(pending) * chunksize >= window:
+                for result in finish():
+                    yield result
+        if chunk:
+            start(chunk)
+        while pending:
+            for result in finish():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,374 @@
+#coding: utf-8
+u'''
+Служба подписания сообщений, разделяемая несколькими процессами.
+
+Служба хранит расшифрованный частный ключ и принимает через сокет Unix
+пакеты каноникализированных блоков SignedInfo, возвращая их ЭП.
+Подготовка сообщений и вычисление хэш-кодов тел выполняются на стороне
+клиента (SigningClient, sign_document с параметром socket_path), поэтому
+рабочие процессы приложения не хранят ключ и пароль к нему.
+
+ЭП пакета вычисляются в пуле потоков (по умолчанию - по числу ядер):
+внешние процессы OpenSSL (crypto.CliBackend) и вызовы libcrypto
+(crypto.LibcryptoBackend) выполняются параллельно.
+
+Запуск::
+
+    LIBSMEV_KEY_PASS=... python -m libsmev.signing_service --socket /run/libsmev/sign.sock --key key.pem
+
+Параметр --backend libcrypto выполняет подписание через
+crypto.LibcryptoBackend (без запуска процессов OpenSSL).
+'''
+
+import os
+import sys
+import stat
+import shutil
+import socket
+import tempfile
+import struct
+import getpass
+import argparse
+import threading
+import multiprocessing
+import SocketServer
+from multiprocessing.pool import ThreadPool
+
+from coprocess import _read_exactly
+from crypto import CliBackend, LibcryptoBackend
+from signer import Signer, SignerError, get_c14n_digest, _prepare_envelope, \
+    _set_digest_value, _set_signature_value, configure_crypto_backend
+from streaming import _get_binary_data
+
+_header = struct.Struct('>I')
+
+# Запрос сертификата
+OP_CERTIFICATE = 'C'
+# Запрос ЭП пакета текстов
+OP_SIGN = 'S'
+
+# Признаки успешного и ошибочного результата
+STATUS_OK = '+'
+STATUS_ERROR = '-'
+
+# Переменная окружения с паролем к частному ключу
+KEY_PASS_ENV = 'LIBSMEV_KEY_PASS'
+
+# Ограничения сообщения: количество элементов и общий размер
+MAX_ITEMS = 4096
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Криптографические модули, выбираемые параметром --backend
+BACKENDS = {
+    'cli': CliBackend,
+    'libcrypto': LibcryptoBackend,
+}
+
+
+def _write_message(stream, items):
+    u'''
+    Запись сообщения: количество элементов и элементы с их длиной.
+    '''
+    chunks = [_header.pack(len(items))]
+    for item in items:
+        chunks.append(_header.pack(len(item)))
+        chunks.append(item)
+    stream.write(''.join(chunks))
+    stream.flush()
+
+
+def _read_message(stream):
+    u'''
+    Чтение сообщения, записанного _write_message. Если сообщение
+    превышает MAX_ITEMS или MAX_MESSAGE_SIZE, возбуждается ValueError.
+    '''
+    count, = _header.unpack(_read_exactly(stream, _header.size))
+    if count > MAX_ITEMS:
+        raise ValueError(u'Too many items in message: %d' % count)
+    items = []
+    total = 0
+    for _ in xrange(count):
+        size, = _header.unpack(_read_exactly(stream, _header.size))
+        total += size
+        if total > MAX_MESSAGE_SIZE:
+            raise ValueError(u'Message is too large')
+        items.append(_read_exactly(stream, size))
+    return items
+
+
+class _SigningHandler(SocketServer.StreamRequestHandler):
+    u'''
+    Обработка запросов одного клиента (соединение используется повторно).
+    '''
+
+    def handle(self):
+        while True:
+            try:
+                request = _read_message(self.rfile)
+            except (EOFError, ValueError):
+                # Неполное или недопустимое сообщение - соединение закрывается
+                break
+            if not request:
+                break
+
+            op, args = request[0], request[1:]
+            if op == OP_CERTIFICATE:
+                response = [STATUS_OK + self.server.signer.certificate]
+            elif op == OP_SIGN:
+                response = self.server.pool.map(self.server.sign, args)
+            else:
+                response = [STATUS_ERROR + 'Unknown operation %r' % op]
+            _write_message(self.wfile, response)
+
+
+class SigningServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    u'''
+    Служба подписания, принимающая запросы через сокет Unix.
+
+    Каждое соединение обслуживается отдельным потоком, ЭП пакета
+    вычисляются в общем пуле потоков. Сокет создается в закрытой
+    временной папке рядом с socket_path и переносится на место после
+    установки прав mode, поэтому до этого к нему не могут подключиться
+    другие пользователи (маска процесса, общая для всех потоков, не
+    меняется).
+
+    :param unicode socket_path: Путь к сокету (существующий файл
+                                заменяется).
+    :param signer.Signer signer: Объект подписания с загруженным ключом.
+    :param int workers: Размер пула (по умолчанию - по числу ядер).
+    :param int mode: Права доступа к сокету.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, signer, workers=None, mode=0600):
+        self.signer = signer
+        self.mode = mode
+        self.pool = ThreadPool(workers or multiprocessing.cpu_count())
+
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _SigningHandler)
+
+    def server_bind(self):
+        socket_path = self.server_address
+        # mkdtemp создает папку, доступную только владельцу
+        private_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(socket_path)))
+        try:
+            temp_path = os.path.join(private_dir, 's')
+            self.socket.bind(temp_path)
+            os.chmod(temp_path, self.mode)
+            os.rename(temp_path, socket_path)
+        finally:
+            shutil.rmtree(private_dir, ignore_errors=True)
+
+    def sign(self, text):
+        u'''
+        ЭП текста с признаком результата.
+        '''
+        try:
+            return STATUS_OK + self.signer.get_text_signature(text)
+        except Exception as err:
+            return STATUS_ERROR + unicode(err).encode('utf-8')
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class SigningClient(object):
+    u'''
+    Клиент службы подписания.
+
+    Сообщения подготавливаются, и хэш-коды их тел вычисляются в текущем
+    процессе, службе передаются только блоки SignedInfo. Соединение
+    устанавливается при первом запросе и используется повторно; объект
+    можно использовать из нескольких потоков.
+
+    :param unicode socket_path: Путь к сокету службы.
+    :param float timeout: Время ожидания ответа службы.
+    '''
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._socket = None
+        self._rfile = self._wfile = None
+        self._certificate = None
+        self._lock = threading.Lock()
+
+    def _request(self, items):
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._socket.settimeout(self.timeout)
+                    self._socket.connect(self.socket_path)
+                    self._rfile = self._socket.makefile('rb')
+                    self._wfile = self._socket.makefile('wb')
+                _write_message(self._wfile, items)
+                return _read_message(self._rfile)
+            except (socket.error, EOFError, struct.error, ValueError) as err:
+                self.close()
+                raise SignerError(u'Signing service error: %s' % err)
+
+    @staticmethod
+    def _result(item):
+        if item[:1] == STATUS_OK:
+            return item[1:]
+        return SignerError(item[1:].decode('utf-8'))
+
+    @property
+    def certificate(self):
+        u'''
+        base64-представление сертификата службы.
+        '''
+        if self._certificate is None:
+            result = self._result(self._request([OP_CERTIFICATE])[0])
+            if isinstance(result, Exception):
+                raise result
+            self._certificate = result
+        return self._certificate
+
+    def get_text_signatures(self, texts):
+        u'''
+        Получение ЭП пакета текстов одним запросом.
+
+        :param list texts: Подписываемые тексты.
+        :return: Закодированные в base64 ЭП или исключения SignerError.
+        :rtype: list
+        '''
+        texts = list(texts)
+        results = []
+        # Пакет разбивается на запросы, не превышающие MAX_ITEMS
+        for pos in xrange(0, len(texts), MAX_ITEMS - 1):
+            response = self._request([OP_SIGN] + texts[pos:pos + MAX_ITEMS - 1])
+            results.extend(self._result(item) for item in response)
+        return results
+
+    def get_text_signature(self, text):
+        u'''
+        Получение ЭП текста.
+
+        :param str text: Подписываемый текст.
+        :return: Закодированная в base64 ЭП текста.
+        :rtype: unicode
+        '''
+        result = self.get_text_signatures([text])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def sign(self, doc):
+        u'''
+        Подписание сообщения (см. signer.sign_document).
+
+        :param doc: Подписываемый XML-документ.
+        :type doc: lxml.Element or EnvelopeView
+        :return: Подписанный XML-документ.
+        :rtype: lxml.Element
+        '''
+        return self.sign_many([doc], raise_errors=True)[0]
+
+    def sign_many(self, docs, raise_errors=False):
+        u'''
+        Подписание нескольких сообщений: блоки SignedInfo всех сообщений
+        передаются службе одним пакетом. Ошибка подписания одного
+        сообщения не прерывает подписание остальных: вместо такого
+        документа возвращается исключение.
+
+        :param docs: Подписываемые XML-документы.
+        :type docs: iterable of lxml.Element
+        :param bool raise_errors: Возбуждать исключение при первой ошибке.
+        :return: Подписанные XML-документы или исключения.
+        :rtype: list
+        '''
+        results, prepared = [], []
+        for doc in docs:
+            try:
+                body_node, wsse_header = _prepare_envelope(doc, lambda: self.certificate)
+                c14n_sign_info = _set_digest_value(
+                    wsse_header, get_c14n_digest(body_node, _get_binary_data(doc, None)))
+            except Exception as err:
+                if raise_errors:
+                    raise
+                results.append(err)
+            else:
+                prepared.append((len(results), doc, wsse_header, c14n_sign_info))
+                results.append(None)
+
+        signatures = self.get_text_signatures([item[3] for item in prepared])
+        for (index, doc, wsse_header, _), signature in zip(prepared, signatures):
+            if isinstance(signature, Exception):
+                if raise_errors:
+                    raise signature
+                results[index] = signature
+            else:
+                results[index] = _set_signature_value(doc, wsse_header, signature)
+        return results
+
+    def close(self):
+        if self._socket is not None:
+            for fh in (self._rfile, self._wfile, self._socket):
+                try:
+                    if fh is not None:
+                        fh.close()
+                except (socket.error, IOError):
+                    pass
+            self._socket = self._rfile = self._wfile = None
+        # После переподключения сертификат запрашивается заново: служба
+        # могла быть перезапущена с другим ключом
+        self._certificate = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def serve(socket_path, priv_key_fn, priv_key_pass, cert_file=None, workers=None):
+    u'''
+    Запуск службы подписания (до прерывания процесса).
+
+    :param unicode socket_path: Путь к сокету.
+    :param unicode priv_key_fn: Путь к файлу с частным ключом подписи.
+    :param unicode priv_key_pass: Пароль к частному ключу подписи.
+    :param unicode cert_file: Путь к файлу с сертификатом.
+    :param int workers: Размер пула (по умолчанию - по числу ядер).
+    '''
+    server = SigningServer(socket_path, Signer(priv_key_fn, priv_key_pass, cert_file), workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u'libsmev signing service')
+    parser.add_argument('--socket', required=True, help=u'Path to the Unix socket')
+    parser.add_argument('--key', required=True, help=u'Private key PEM file')
+    parser.add_argument('--cert', help=u'Certificate PEM file')
+    parser.add_argument('--workers', type=int, help=u'Signing threads (default: CPU count)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='cli',
+                        help=u'Crypto backend (default: cli)')
+    args = parser.parse_args(argv)
+
+    configure_crypto_backend(BACKENDS[args.backend]())
+
+    # Пароль не передается в командной строке, чтобы не попасть в список процессов
+    priv_key_pass = os.environ.pop(KEY_PASS_ENV, None)
+    if priv_key_pass is None:
+        priv_key_pass = getpass.getpass('Private key password: ')
+
+    try:
+        serve(args.socket, args.key, priv_key_pass, args.cert, args.workers)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,8 +5,9 @@ import copy
 from lxml import etree
 from datetime import datetime
 
-from helpers import make_node, extract_smev_parts, tag_single, dict_to_xmldoc
+from helpers import make_node, extract_smev_parts, tags, dict_to_xmldoc, EnvelopeView
 from namespaces import NS_MAP, make_node_with_ns
+from streaming import BinaryDataSource
 
 
 SMEV_VERSIONS = ['2.4.4', '2.5.5', '2.5.6']
@@ -28,7 +29,8 @@ def convert_smev_request(envelope, from_ver='2.5.6', to_ver=None):
     Внимание: преобразование происходит прямо над переданным объектом,
     _не_ над копией.
 
-    :param  lxml.Element envelope: Преобразуемое СМЭВ сообщение в виде дерева XML.
+    :param  envelope: Преобразуемое СМЭВ сообщение в виде дерева XML.
+    :type   envelope: lxml.Element or EnvelopeView
     :param  unicode from_ver: Версия переданного сообщения.
     :param  unicode from_ver: Версия, в которую необходимо преобразовать сообщение.
 
@@ -37,11 +39,12 @@ def convert_smev_request(envelope, from_ver='2.5.6', to_ver=None):
     '''
 
     smev_node = make_node_with_ns('smev')
-    token, signature, msg_node, msg_data_node = extract_smev_parts(envelope)
+    view = EnvelopeView.of(envelope)
+    token, signature, msg_node, msg_data_node = extract_smev_parts(view)
 
     def convert_256_to_255(envelope):
-        service_node = msg_data_node.xpath('//smev:Service', namespaces=NS_MAP)[0]
-        name_node = msg_data_node.xpath('//smev:Service/smev:Mnemonic', namespaces=NS_MAP)
+        service_node = tags(msg_node, 'smev:Service')[0]
+        name_node = tags(service_node, 'smev:Mnemonic')
         if name_node:
             name = name_node[0].text
         servicename_node = smev_node('ServiceName')
@@ -58,7 +61,7 @@ def convert_smev_request(envelope, from_ver='2.5.6', to_ver=None):
     if not (from_ver, to_ver) in mapping:
         raise NoViableConversionError("from %s to %s" % (from_ver, to_ver))
 
-    return mapping[(from_ver, to_ver)](envelope)
+    return mapping[(from_ver, to_ver)](view.envelope)
 
 
 def create_empty_context(version='2.5.6'):
@@ -131,7 +134,11 @@ def extract_context_from_envelope(envelope):
     Если какой-либо из элементов содержит текст "true" или "false", то значение
     будет заменено на True или False соответственно.
 
-    :param  lxml.Element envelope: Сообщение СМЭВ.
+    Просматривается только заголовок smev:Message, поэтому время разбора
+    не зависит от размера данных сообщения (AppData, BinaryData).
+
+    :param  envelope: Сообщение СМЭВ.
+    :type   envelope: lxml.Element or EnvelopeView
     :return: Словарь контекста.
     :rtype: dict
 
@@ -140,33 +147,235 @@ def extract_context_from_envelope(envelope):
     smev_version = '2.5.6'
 
     ctx = create_empty_context(version=smev_version)
-    ctx['Sender']['Code'] = tag_single(envelope, './/smev:Sender/smev:Code')
-    ctx['Sender']['Name'] = tag_single(envelope, './/smev:Sender/smev:Name')
+    for section in ('Sender', 'Originator', 'Recipient'):
+        ctx[section]['Code'] = ctx[section]['Name'] = None
+    ctx['Service']['Mnemonic'] = ctx['Service']['Version'] = None
+    ctx['Status'] = ctx['TypeCode'] = ctx['TestMsg'] = None
+
+    message = EnvelopeView.of(envelope).message
+    if message is None:
+        return ctx
+
+    def text(node):
+        value = node.text
+        if value in ('true', 'false'):
+            return value == 'true'
+        return value
+
+    # Заголовок разбирается за один проход по дочерним элементам
+    # smev:Message, блок MessageData не просматривается.
+    smev_ns = '{%s}' % NS_MAP['smev']
+    for node in message.iterchildren(tag=etree.Element):
+        if not node.tag.startswith(smev_ns):
+            continue
+        name = node.tag[len(smev_ns):]
+
+        if name in ('Sender', 'Originator', 'Recipient', 'Service'):
+            section = ctx[name]
+            for field in node.iterchildren(tag=etree.Element):
+                if field.tag.startswith(smev_ns) and field.tag[len(smev_ns):] in section:
+                    section[field.tag[len(smev_ns):]] = text(field)
+        elif name in ('Status', 'TypeCode', 'TestMsg'):
+            ctx[name] = text(node)
+
+    return ctx
+
+
+# Обязательные поля контекста СМЭВ-сообщения
+REQUIRED_FIELDS = (
+    'Sender',
+    'Recipient',
+    'TypeCode',
+    'Status',
+)
+
+TYPE_CODES = frozenset([
+    'GSRV',  # Оказание государственных услуг
+    'GFNC',  # Исполнение государственных функций
+    'OTHR'   # Взаимодействие в иных целях
+])
+
+STATUSES = frozenset([
+    'ACCEPT',  # Сообщение-квиток о приеме
+    'CANCEL',  # Отзыв заявления
+    'FAILURE',  # Технический сбой
+    'INVALID',  # Ошибка при ФЛК (форматно-логический контроль)
+    'NOTIFY',  # Уведомление об ошибке
+    'PING',  # Запрос данных/результатов
+    'PACKET',  # Пакетный режим обмена
+    'PROCESS',  # В обработке
+    'REJECT',  # Мотивированный отказ
+    'REQUEST',
+    'RESULT',
+    'STATE'  # Возврат состояния
+])
+
+# Статусы многократно повторяющихся опросных сообщений, для которых
+# кэшируются полностью заполненные (кроме даты) обертки.
+POLLING_STATUSES = frozenset(['PING', 'STATE'])
+POLLING_CACHE_SIZE = 256
+
+_envelope_templates = {}
+_polling_envelopes = {}
+
+
+class _EnvelopeTemplate(object):
+    u'''
+    Шаблон обертки СМЭВ-сообщения для заданных имени блока с данными,
+    карты пространств имен и версии методических рекомендаций.
+
+    Шаблон формируется один раз, при создании сообщения копируется
+    и заполняется значениями из контекста.
+    '''
+
+    def __init__(self, action_name, ns_map, version, test_msg, case_number):
+        self.version = version
+
+        nodes = {}
+        self.root = self._build(action_name, ns_map, version, test_msg, case_number, nodes)
+
+        # Позиции изменяемых элементов в порядке обхода дерева
+        positions = dict((id(node), i) for i, node in enumerate(self.root.iter()))
+        self.positions = dict((name, positions[id(node)]) for name, node in nodes.items())
+
+    @staticmethod
+    def _build(action_name, _ns_map, version, test_msg, case_number, nodes):
+        envelope = etree.Element("{%s}Envelope" % _ns_map['SOAP-ENV'], nsmap=_ns_map)
+        header_node = etree.SubElement(envelope, "{%s}Header" % _ns_map['SOAP-ENV'])
+        body_node = etree.SubElement(envelope, "{%s}Body" % _ns_map['SOAP-ENV'],
+                                     attrib={"{%s}Id" % _ns_map['wsu']: "body"})
+
+        own_section_node = etree.SubElement(
+            body_node, "{%s}%s" % (_ns_map['inf'], action_name), nsmap=_ns_map)
+        message_node = etree.SubElement(own_section_node, "{%s}Message" % _ns_map['smev'])
+
+        def smev_node(parent, name, field=None):
+            node = etree.SubElement(parent, "{%s}%s" % (_ns_map['smev'], name))
+            if field is not None:
+                nodes[field] = node
+            return node
+
+        # Данные о системе-инициаторе взаимодействия (Поставщике)
+        # Данные о системе-получателе сообщения (Потребителе)
+        # Данные о системе, инициировавшей цепочку из нескольких
+        # запросов-ответов, объединенных единым процессом в рамках
+        # взаимодействия
+        for name in ('Sender', 'Recipient', 'Originator'):
+            system_node = smev_node(message_node, name)
+            smev_node(system_node, 'Code', (name, 'Code'))
+            smev_node(system_node, 'Name', (name, 'Name'))
+
+        # Данные о вызванном сервисе
+        if version == '2.5.6':
+            service_node = smev_node(message_node, 'Service')
+            smev_node(service_node, 'Mnemonic', ('Service', 'Mnemonic'))
+            smev_node(service_node, 'Version', ('Service', 'Version'))
+        else:
+            smev_node(message_node, 'ServiceName', 'ServiceName')
 
-    ctx['Originator']['Code'] = tag_single(envelope, './/smev:Originator/smev:Code')
-    ctx['Originator']['Name'] = tag_single(envelope, './/smev:Originator/smev:Name')
+        # Тип сообщения по классификатору типов сообщений,  передаваемых через
+        # узел СМЭВ (приложение 2 метод. рекомендаций )
+        smev_node(message_node, 'TypeCode', 'TypeCode')
 
-    ctx['Recipient']['Code'] = tag_single(envelope, './/smev:Recipient/smev:Code')
-    ctx['Recipient']['Name'] = tag_single(envelope, './/smev:Recipient/smev:Name')
+        # Сведения о статусе электронного сообщения (см. приложение 2)
+        smev_node(message_node, 'Status', 'Status')
 
-    ctx['Service']['Mnemonic'] = tag_single(envelope, './/smev:Service/smev:Mnemonic')
-    ctx['Service']['Version'] = tag_single(envelope, './/smev:Service/smev:Version')
+        # Дата и время создания сообщения в формате UTC
+        smev_node(message_node, 'Date', 'Date')
 
-    ctx['Status'] = tag_single(envelope, './/smev:Status')
-    ctx['TypeCode'] = tag_single(envelope, './/smev:TypeCode')
-    ctx['TestMsg'] = tag_single(envelope, './/smev:TestMsg')
+        # Признак принадлежности электронного сообщения различным категориям
+        # взаимодействия, возникающим при межведомственном обмене (приложение 2)
+        smev_node(message_node, 'ExchangeType', 'ExchangeType')
 
-    def format_tag_contents(root):
-        for k, v in root.iteritems():
-            if isinstance(v, dict):
-                root[k] = format_tag_contents(v)
+        # Признак тестового режима
+        if test_msg:
+            smev_node(message_node, 'TestMsg').text = 'true'
+
+        if case_number:
+            # Номер дела в ИС отправителя
+            smev_node(message_node, 'CaseNumber', 'CaseNumber')
+
+        messagedata_node = smev_node(own_section_node, 'MessageData')
+        etree.SubElement(messagedata_node, "{%s}AppData" % _ns_map['smev'],
+                         attrib={"{%s}Id" % _ns_map['wsu']: "AppData"})
+        app_document_node = smev_node(messagedata_node, 'AppDocument', 'AppDocument')
+        smev_node(app_document_node, 'RequestCode', ('AppDocument', 'RequestCode'))
+        smev_node(app_document_node, 'BinaryData', ('AppDocument', 'BinaryData'))
+
+        return envelope
+
+    def values(self, context):
+        u'''
+        Значения изменяемых элементов (кроме даты) из контекста.
+
+        :param dict context: Словарь с данными заголовка СМЭВ-сообщения.
+        :return: Список пар (позиция элемента, текст).
+        :rtype: list
+        '''
+        values = [
+            ('Sender', 'Code'), ('Sender', 'Name'),
+            ('Recipient', 'Code'), ('Recipient', 'Name'),
+            ('Originator', 'Code'), ('Originator', 'Name'),
+        ]
+        values = [(field, context[field[0]][field[1]]) for field in values]
+
+        if self.version == '2.5.6':
+            values.append((('Service', 'Mnemonic'), context['Service']['Mnemonic']))
+            values.append((('Service', 'Version'), context['Service']['Version']))
+        else:
+            values.append(('ServiceName', context['ServiceName']))
+
+        values.append(('TypeCode', context.get('TypeCode', '')))
+        values.append(('Status', context.get('Status', '')))
+        # По умолчанию выставляется "Неопределенная категория"
+        values.append(('ExchangeType', context.get('Exchangetype', '0')))
+
+        if 'CaseNumber' in context:
+            values.append(('CaseNumber', context['CaseNumber']))
+
+        app_document = context.get('AppDocument')
+        if app_document is not None:
+            if isinstance(app_document, dict):
+                binary_data = app_document['BinaryData']
+                if isinstance(binary_data, BinaryDataSource):
+                    # Содержимое подставляется при записи сообщения
+                    binary_data = None
+                values.append((('AppDocument', 'RequestCode'), app_document['RequestCode'] or ''))
+                values.append((('AppDocument', 'BinaryData'), binary_data or ''))
             else:
-                root[k] = getattr(v, 'text', v)
-                if root[k] in ('true', 'false'):
-                    root[k] = root[k] == 'true'
-        return root
+                values.append(('AppDocument', app_document or ''))
+
+        return [(self.positions[field], value) for field, value in values]
+
+    def fill(self, values, date=None):
+        u'''
+        Создание обертки сообщения копированием шаблона.
+
+        :param list values: Значения изменяемых элементов (см. values).
+        :param unicode date: Дата создания сообщения.
+        :rtype: lxml.Element
+        '''
+        envelope = copy.deepcopy(self.root)
+        nodes = list(envelope.iter())
+        for position, value in values:
+            nodes[position].text = value
+        if date is not None:
+            nodes[self.positions['Date']].text = date
+        return envelope
+
+
+def _get_envelope_template(action_name, context, nsmap, version):
+    key = (action_name, version, tuple(sorted(nsmap.items())) if nsmap else None,
+           bool(context.get('TestMsg', True)), 'CaseNumber' in context)
 
-    return format_tag_contents(ctx)
+    template = _envelope_templates.get(key)
+    if template is None:
+        _ns_map = copy.copy(NS_MAP)
+        if nsmap:
+            _ns_map.update(nsmap)
+        template = _envelope_templates[key] = _EnvelopeTemplate(
+            action_name, _ns_map, version, *key[3:])
+    return key, template
 
 
 def construct_smev_envelope(action_name, context, nsmap=None, version='2.5.6'):
@@ -174,6 +383,15 @@ def construct_smev_envelope(action_name, context, nsmap=None, version='2.5.6'):
     Составления обертки СМЭВ-сообщения на основе переданного контекста и имени
     блока с данными.
 
+    Обертка создается копированием шаблона, сформированного один раз для
+    каждого сочетания имени блока, версии и карты пространств имен.
+    Опросные сообщения (PING, STATE) без вложений кэшируются целиком:
+    при повторном создании изменяется только дата.
+
+    Вложение может быть передано в виде streaming.BinaryDataSource: в
+    дерево оно не копируется, а подставляется при записи сообщения
+    функцией streaming.write_envelope.
+
     :param unicode action_name: Имя блока, содержащего данные сообщения.
     :param dict context: Словарь с данными заголовка СМЭВ-сообщения.
     :param dict nsmap: Карта пространств имен XML-документа.
@@ -184,176 +402,38 @@ def construct_smev_envelope(action_name, context, nsmap=None, version='2.5.6'):
     :rtype: lxml.Element
     '''
 
-    required_fields = [
-        'Sender',
-        'Recipient',
-        'TypeCode',
-        'Status',
-    ]
-    type_codes = (
-        'GSRV',  # Оказание государственных услуг
-        'GFNC',  # Исполнение государственных функций
-        'OTHR'   # Взаимодействие в иных целях
-    )
-    statuses = (
-        'ACCEPT',  # Сообщение-квиток о приеме
-        'CANCEL',  # Отзыв заявления
-        'FAILURE',  # Технический сбой
-        'INVALID',  # Ошибка при ФЛК (форматно-логический контроль)
-        'NOTIFY',  # Уведомление об ошибке
-        'PING',  # Запрос данных/результатов
-        'PACKET',  # Пакетный режим обмена
-        'PROCESS',  # В обработке
-        'REJECT',  # Мотивированный отказ
-        'REQUEST',
-        'RESULT',
-        'STATE'  # Возврат состояния
-    )
-
-    for name in required_fields:
+    for name in REQUIRED_FIELDS:
         assert name in context, u'Required field "%s" missing from context!' % name
-    assert context['TypeCode'] in type_codes, u'Type code should be one of %s' % (type_codes,)
-    assert context['Status'] in statuses, u'Status code should be one of %s' % (statuses,)
-
-    _ns_map = copy.copy(NS_MAP)
-    if nsmap:
-        _ns_map.update(nsmap)
-
-    envelope = etree.Element("{%s}Envelope" % _ns_map['SOAP-ENV'], nsmap=_ns_map)
-    header_node = etree.Element("{%s}Header" % _ns_map['SOAP-ENV'])
-    body_node = etree.Element("{%s}Body" % _ns_map['SOAP-ENV'], attrib={"{%s}Id" % _ns_map['wsu']: "body"})
-
-    message_node = etree.Element("{%s}Message" % _ns_map['smev'])
-
-    # Данные о системе-инициаторе взаимодействия (Поставщике)
-    sender_node = etree.Element("{%s}Sender" % _ns_map['smev'])
-    sender_code_node = etree.Element("{%s}Code" % _ns_map['smev'])
-    sender_name_node = etree.Element("{%s}Name" % _ns_map['smev'])
-    sender_code_node.text = context['Sender']['Code']
-    sender_name_node.text = context['Sender']['Name']
-
-    # Данные о системе-получателе сообщения (Потребителе)
-    recipient_node = etree.Element("{%s}Recipient" % _ns_map['smev'])
-    recipient_code_node = etree.Element("{%s}Code" % _ns_map['smev'])
-    recipient_name_node = etree.Element("{%s}Name" % _ns_map['smev'])
-    recipient_code_node.text = context['Recipient']['Code']
-    recipient_name_node.text = context['Recipient']['Name']
-
-    # Данные о системе, инициировавшей цепочку из нескольких
-    # запросов-ответов, объединенных единым процессом в рамках
-    # взаимодействия
-    originator_node = etree.Element("{%s}Originator" % _ns_map['smev'])
-    originator_code_node = etree.Element("{%s}Code" % _ns_map['smev'])
-    originator_name_node = etree.Element("{%s}Name" % _ns_map['smev'])
-    originator_code_node.text = context['Originator']['Code']
-    originator_name_node.text = context['Originator']['Name']
-
-    # Данные о вызванном сервисе
-    if version == '2.5.6':
-        service_node = etree.Element("{%s}Service" % _ns_map['smev'])
-        service_mnemonic_node = etree.Element("{%s}Mnemonic" % _ns_map['smev'])
-        service_version_node = etree.Element("{%s}Version" % _ns_map['smev'])
-        service_mnemonic_node.text = context['Service']['Mnemonic']
-        service_version_node.text = context['Service']['Version']
-
-        service_node.extend([
-            service_mnemonic_node,
-            service_version_node])
-    else:
-        service_node = etree.Element("{%s}ServiceName" % _ns_map['smev'])
-        service_node.text = context['ServiceName']
+    assert context['TypeCode'] in TYPE_CODES, u'Type code should be one of %s' % (tuple(TYPE_CODES),)
+    assert context['Status'] in STATUSES, u'Status code should be one of %s' % (tuple(STATUSES),)
 
-    # Тип сообщения по классификатору типов сообщений,  передаваемых через
-    # узел СМЭВ (приложение 2 метод. рекомендаций )
-    typecode_node = etree.Element("{%s}TypeCode" % _ns_map['smev'])
-    typecode_node.text = context.get('TypeCode', '')
-
-    # Сведения о статусе электронного сообщения (см. приложение 2)
-    status_node = etree.Element("{%s}Status" % _ns_map['smev'])
-    status_node.text = context.get('Status', '')
+    key, template = _get_envelope_template(action_name, context, nsmap, version)
+    values = template.values(context)
 
     # Дата и время создания сообщения в формате UTC
     # 'yyyy-MM-dd'T'HH:mm:ss.SSSZ’
-    utc_now = datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%f")[:-2]
-    date_node = etree.Element("{%s}Date" % _ns_map['smev'])
-    date_node.text = context.get('Date', utc_now)
-
-    # Признак принадлежности электронного сообщения различным категориям
-    # взаимодействия, возникающим при межведомственном обмене (приложение 2)
-    # По умолчанию выставляется "Неопределенная категория"
-    exchangetype_node = etree.Element("{%s}ExchangeType" % _ns_map['smev'])
-    exchangetype_node.text = context.get('Exchangetype', '0')
-
-    # Признак тестового режима
-    testmsg_node = None
-    if context.get('TestMsg', True):
-        testmsg_node = etree.Element("{%s}TestMsg" % _ns_map['smev'])
-        testmsg_node.text = 'true'
-
-    messagedata_node = etree.Element("{%s}MessageData" % _ns_map['smev'])
-    appdata_node = etree.Element("{%s}AppData" % _ns_map['smev'], attrib={"{%s}Id" % _ns_map['wsu']: "AppData"})
-    app_document_node = etree.Element("{%s}AppDocument" % _ns_map['smev'])
-    binarydata_node = etree.Element("{%s}BinaryData" % _ns_map['smev'])
-    requestcode_node = etree.Element("{%s}RequestCode" % _ns_map['smev'])
+    if 'Date' in context:
+        date = context['Date']
+    else:
+        date = datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%f")[:-2]
 
     app_document = context.get('AppDocument')
-    if app_document is not None:
-        if isinstance(app_document, dict):
-            requestcode_node.text = app_document['RequestCode'] or ''
-            binarydata_node.text = app_document['BinaryData'] or ''
-        else:
-            app_document_node.text = app_document or ''
-
-    app_document_node.extend([
-        requestcode_node,
-        binarydata_node])
-
-    messagedata_node.extend([
-        appdata_node,
-        app_document_node])
-
-    sender_node.extend([
-        sender_code_node,
-        sender_name_node])
-
-    recipient_node.extend([
-        recipient_code_node,
-        recipient_name_node])
-
-    originator_node.extend([
-        originator_code_node,
-        originator_name_node])
-
-    message_node.extend([
-        sender_node,
-        recipient_node,
-        originator_node,
-        service_node,
-        typecode_node,
-        status_node,
-        date_node,
-        exchangetype_node,
-    ])
-    if testmsg_node is not None:
-        message_node.append(testmsg_node)
-
-    if 'CaseNumber' in context:
-        # Номер дела в ИС отправителя
-        casenumber_node = etree.Element("{%s}CaseNumber" % _ns_map['smev'])
-        casenumber_node.text = context['CaseNumber']
-        message_node.append(casenumber_node)
-
-    own_section_node = etree.Element("{%s}%s" % (_ns_map['inf'], action_name), nsmap=_ns_map)
-    own_section_node.extend([
-        message_node,
-        messagedata_node])
-
-    body_node.append(
-        own_section_node)
-    envelope.extend([
-        header_node,
-        body_node])
+    if context['Status'] not in POLLING_STATUSES or app_document is not None:
+        envelope = template.fill(values, date)
+        if isinstance(app_document, dict) and isinstance(
+                app_document['BinaryData'], BinaryDataSource):
+            app_document['BinaryData'].element = EnvelopeView(envelope).binary_data
+        return envelope
+
+    polling_key = (key, tuple(values))
+    prototype = _polling_envelopes.get(polling_key)
+    if prototype is None:
+        if len(_polling_envelopes) >= POLLING_CACHE_SIZE:
+            _polling_envelopes.clear()
+        prototype = _polling_envelopes[polling_key] = template.fill(values)
 
+    envelope = copy.deepcopy(prototype)
+    list(envelope.iter())[template.positions['Date']].text = date
     return envelope
 
 
@@ -362,7 +442,8 @@ def construct_error_reply(original_req, err_code, msg, custom_status=None):
     Создание ответ на СМЭВ-сообщение, который будет содержать в себе
     код и сообщение об ошибке.
 
-    :param lxml.Element original_req: СМЭВ-сообщение, на которое формируется ответ.
+    :param original_req: СМЭВ-сообщение, на которое формируется ответ.
+    :type  original_req: lxml.Element or EnvelopeView
     :param unicode err_code: Код сообщения об ошибке.
     :param unicode msg: Текст сообщения об ошибке.
     :param unicode custom_status: Статус в заголовке СМЭВ-сообщения.
@@ -385,7 +466,7 @@ def construct_error_reply(original_req, err_code, msg, custom_status=None):
     reply_ctx['Status'] = custom_status or 'REJECT'
 
     reply_req = construct_smev_envelope('Error', reply_ctx)
-    appdata_node = tag_single(reply_req, './/smev:AppData')
+    appdata_node = EnvelopeView(reply_req).app_data
 
     dict_to_xmldoc(appdata_node, {
                    '__ns__': 'inf',
@@ -0,0 +1,501 @@
+#coding: utf-8
+u'''
+Потоковая обработка СМЭВ-сообщений с вложениями большого размера.
+
+При разборе сообщения содержимое элементов smev:BinaryData не попадает
+в дерево XML, а по мере поступления записывается во временный файл
+(в памяти хранятся только файлы небольшого размера). При записи
+сообщения и вычислении хэш-кода тела содержимое вложений подставляется
+в выходной поток по частям.
+'''
+
+import uuid
+import binascii
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+
+from lxml import etree
+from lxml.etree import XMLSyntaxError
+
+from helpers import Fault, EnvelopeView, PARSER_OPTIONS
+from namespaces import NS_MAP
+
+
+# Размер порции данных, считываемой из источника при разборе
+READ_CHUNK_SIZE = 64 * 1024
+
+# Размер вложения, при превышении которого оно переносится из памяти на диск
+SPOOL_MAX_SIZE = 1024 * 1024
+
+BINARY_DATA_TAG = '{%s}BinaryData' % NS_MAP['smev']
+
+# Метки, временно заменяющие текст элементов BinaryData при записи
+_MARKER_PREFIX = 'libsmev-binary-data-'
+_MARKER_SIZE = len(_MARKER_PREFIX) + 32
+
+
+class BinaryDataFile(object):
+    u'''
+    Содержимое элемента smev:BinaryData, вынесенное из дерева XML во
+    временный файл.
+
+    Текст элемента сохраняется в том виде, в котором он получен (это
+    необходимо для вычисления хэш-кода тела сообщения), декодированные
+    данные записываются в отдельный временный файл при первом
+    обращении к ним.
+
+    :param lxml.Element element: Элемент BinaryData (без текста).
+    :param int max_size: Размер, при превышении которого данные
+                         переносятся на диск.
+    '''
+
+    def __init__(self, element, max_size=SPOOL_MAX_SIZE):
+        self.element = element
+        self.max_size = max_size
+        self.file = SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+        self._decoded = None
+
+    def _count(self, data):
+        self.size += len(data)
+
+    def open_base64(self):
+        u'''
+        Получение файлового объекта с текстом элемента (base64),
+        установленного на начало.
+
+        :rtype: file
+        '''
+        self.file.seek(0)
+        return self.file
+
+    def iter_base64(self, chunk_size=READ_CHUNK_SIZE):
+        u'''
+        Чтение текста элемента (base64) по частям.
+
+        :rtype: iterator
+        '''
+        source = self.open_base64()
+        return iter(lambda: source.read(chunk_size), '')
+
+    def open(self):
+        u'''
+        Получение файлового объекта с декодированными данными,
+        установленного на начало.
+
+        :rtype: file
+        '''
+        if self._decoded is None:
+            decoded = SpooledTemporaryFile(max_size=self.max_size)
+            decoder = _Base64Decoder(decoded.write)
+            for chunk in self.iter_base64():
+                decoder.feed(chunk)
+            decoder.close()
+            self._decoded = decoded
+        self._decoded.seek(0)
+        return self._decoded
+
+    def read(self):
+        u'''
+        Чтение декодированных данных целиком.
+
+        :rtype: str
+        '''
+        return self.open().read()
+
+    def close(self):
+        self.file.close()
+        if self._decoded is not None:
+            self._decoded.close()
+
+
+class BinaryDataSource(object):
+    u'''
+    Содержимое элемента smev:BinaryData исходящего сообщения, которое
+    не помещается в дерево XML, а подставляется при записи сообщения
+    (write_envelope) и вычислении хэш-кода тела.
+
+    Источником может быть путь к файлу, файловый объект или итератор
+    порций данных. Данные кодируются в base64 по частям; если они уже
+    закодированы, следует указать encoded=True. Итератор может быть
+    прочитан только один раз, поэтому при первом чтении данные
+    дополнительно сохраняются во временный файл; если первое чтение
+    не было завершено, повторное возбуждает ValueError.
+
+    Объект передается в контексте construct_smev_envelope
+    (context['AppDocument']['BinaryData']), созданное сообщение
+    для подписания и записи оборачивается в StreamedEnvelope::
+
+        source = BinaryDataSource(encoded_chunks, encoded=True)
+        context['AppDocument'] = {'RequestCode': code, 'BinaryData': source}
+        envelope = StreamedEnvelope(
+            construct_smev_envelope('Request', context), [source])
+        sign_document(envelope, key_fn, key_pass)
+        write_envelope(envelope, output)
+
+    :param source: Путь к файлу, файловый объект или итератор строк.
+    :param bool encoded: Данные уже закодированы в base64.
+    :param int max_size: Размер, при превышении которого сохраненные
+                         данные итератора переносятся на диск.
+    '''
+
+    def __init__(self, source, encoded=False, max_size=SPOOL_MAX_SIZE):
+        self.source = source
+        self.encoded = encoded
+        self.max_size = max_size
+        self.element = None
+        self._spool = None
+        self._spooling = False
+
+    def _iter_source(self):
+        source = self.source
+        if isinstance(source, basestring):
+            with open(source, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(READ_CHUNK_SIZE), ''):
+                    yield chunk
+        elif hasattr(source, 'read'):
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), ''):
+                yield chunk
+        else:
+            for chunk in source:
+                yield chunk
+
+    def _iter_encoded(self):
+        if self.encoded:
+            for chunk in self._iter_source():
+                yield chunk
+            return
+
+        # Кодируются порции, кратные 3 байтам, чтобы не возникало
+        # промежуточных символов дополнения
+        tail = ''
+        for chunk in self._iter_source():
+            chunk = tail + chunk
+            size = len(chunk) - len(chunk) % 3
+            tail = chunk[size:]
+            if size:
+                yield binascii.b2a_base64(chunk[:size])[:-1]
+        if tail:
+            yield binascii.b2a_base64(tail)[:-1]
+
+    def iter_base64(self):
+        u'''
+        Чтение данных в base64 по частям.
+
+        :rtype: iterator
+        '''
+        if self._spool is not None:
+            self._spool.seek(0)
+            return iter(lambda: self._spool.read(READ_CHUNK_SIZE), '')
+
+        if isinstance(self.source, basestring) or hasattr(self.source, 'seek'):
+            return self._iter_encoded()
+        if self._spooling:
+            # Итератор уже частично прочитан: данные были бы неполными
+            raise ValueError(u'BinaryDataSource iterator has already been read')
+        return self._iter_spooled()
+
+    def _iter_spooled(self):
+        self._spooling = True
+        spool = SpooledTemporaryFile(max_size=self.max_size)
+        try:
+            for chunk in self._iter_encoded():
+                spool.write(chunk)
+                yield chunk
+        except:
+            spool.close()
+            raise
+        self._spool = spool
+
+    def close(self):
+        u'''
+        Удаление сохраненных данных итератора и закрытие файлового
+        объекта-источника.
+        '''
+        if self._spool is not None:
+            self._spool.close()
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+class _Base64Decoder(object):
+    u'''
+    Инкрементальное декодирование base64 с пропуском пробельных символов.
+
+    :param write: Функция, которой передаются декодированные данные.
+    '''
+
+    def __init__(self, write):
+        self.write = write
+        self.buffer = ''
+
+    def feed(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('ascii')
+        data = self.buffer + ''.join(data.split())
+        tail = len(data) % 4
+        self.buffer = data[len(data) - tail:]
+        if len(data) > tail:
+            self.write(binascii.a2b_base64(data[:len(data) - tail]))
+
+    def close(self):
+        if self.buffer:
+            raise binascii.Error('Incorrect padding')
+
+
+class _EnvelopeTarget(object):
+    u'''
+    Цель парсера lxml: строит дерево через TreeBuilder, перенаправляя
+    текст элементов BinaryData в BinaryDataFile.
+    '''
+
+    def __init__(self, max_size):
+        self.builder = etree.TreeBuilder()
+        self.max_size = max_size
+        self.binary_data = []
+        self.current = None
+        self.decoder = None
+
+    def start(self, tag, attrib, nsmap=None):
+        element = self.builder.start(tag, attrib, nsmap)
+        if tag == BINARY_DATA_TAG:
+            self.current = BinaryDataFile(element, self.max_size)
+            self.binary_data.append(self.current)
+            # Данные декодируются только для проверки и подсчета размера
+            self.decoder = _Base64Decoder(self.current._count)
+
+    def end(self, tag):
+        if tag == BINARY_DATA_TAG:
+            self.decoder.close()
+            self.current = self.decoder = None
+        return self.builder.end(tag)
+
+    def data(self, data):
+        if self.current is not None:
+            if isinstance(data, unicode):
+                data = data.encode('ascii')
+            self.decoder.feed(data)
+            self.current.file.write(data)
+        else:
+            self.builder.data(data)
+
+    def pi(self, target, data=None):
+        return self.builder.pi(target, data)
+
+    def close(self):
+        return self.builder.close()
+
+
+class StreamedEnvelope(EnvelopeView):
+    u'''
+    Сообщение с вынесенными из дерева вложениями: результат
+    parse_envelope_stream или исходящее сообщение с BinaryDataSource.
+
+    Является структурным индексом конверта (см. helpers.EnvelopeView),
+    вложения учитываются при подписании, проверке подписи и записи
+    сообщения. Временные файлы удаляются методом close или при выходе
+    из блока with.
+
+    :param lxml.Element envelope: Корень XML-документа.
+    :param list binary_data: Вложения (BinaryDataFile, BinaryDataSource).
+    '''
+
+    def __init__(self, envelope, binary_data):
+        super(StreamedEnvelope, self).__init__(envelope)
+        self.binary_data_files = binary_data
+
+    def get_binary_data(self, element=None):
+        u'''
+        Получение вложения по элементу BinaryData.
+
+        :param lxml.Element element: Элемент BinaryData (по умолчанию -
+                                     из smev:AppDocument сообщения).
+        :return: Вложение или None.
+        :rtype: BinaryDataFile
+        '''
+        if element is None:
+            element = self.binary_data
+        for binary_data in self.binary_data_files:
+            if binary_data.element is element:
+                return binary_data
+        return None
+
+    def close(self):
+        for binary_data in self.binary_data_files:
+            binary_data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parse_envelope_stream(source, huge_tree=False, max_size=SPOOL_MAX_SIZE):
+    u'''
+    Потоковый разбор СМЭВ-сообщения с выносом вложений во временные файлы.
+
+    Дерево строится как обычно (комментарии удаляются, как и в
+    parse_xml_string), но текст элементов smev:BinaryData проверяется
+    инкрементальным декодером base64 и сохраняется в BinaryDataFile,
+    а сами элементы остаются пустыми. Таким образом, объем используемой
+    памяти не зависит от размера вложений.
+
+    Парсер создается с параметрами PARSER_OPTIONS: внешние сущности не
+    подставляются, сеть не используется. Данные передаются парсеру
+    порциями, поэтому ограничения libxml2 на размер узлов не мешают
+    разбору больших вложений.
+
+    :param source: Строка с XML-документом или файловый объект.
+    :param bool huge_tree: Снятие ограничений libxml2 на размер и
+                           вложенность документа (только для доверенных
+                           источников).
+    :param int max_size: Размер вложения, при превышении которого оно
+                         переносится на диск.
+    :return: Разобранное сообщение.
+    :rtype: StreamedEnvelope
+    '''
+    target = _EnvelopeTarget(max_size)
+    options = dict(PARSER_OPTIONS)
+    if huge_tree:
+        options['huge_tree'] = True
+    parser = etree.XMLParser(target=target, **options)
+
+    try:
+        try:
+            if isinstance(source, basestring):
+                for pos in xrange(0, len(source), READ_CHUNK_SIZE):
+                    parser.feed(source[pos:pos + READ_CHUNK_SIZE])
+            else:
+                for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), ''):
+                    parser.feed(chunk)
+            root = parser.close()
+        except XMLSyntaxError as err:
+            raise Fault(unicode(err))
+        except (binascii.Error, UnicodeError) as err:
+            raise Fault(u'Invalid BinaryData: %s' % err)
+    except:
+        for binary_data in target.binary_data:
+            binary_data.close()
+        raise
+
+    return StreamedEnvelope(root, target.binary_data)
+
+
+class _SpliceWriter(object):
+    u'''
+    Файлоподобный объект, заменяющий в записываемых данных метки
+    вложений их содержимым в base64. Текст, похожий на метку, но не
+    совпадающий ни с одной из них, записывается без изменений.
+    '''
+
+    def __init__(self, output, markers):
+        self.output = output
+        self.markers = markers
+        self.pending = ''
+
+    def write(self, data):
+        if not self.markers:
+            self.output.write(data)
+            return
+
+        data = self.pending + data
+        while True:
+            pos = data.find(_MARKER_PREFIX)
+            if pos < 0:
+                # Конец данных может оказаться началом метки
+                keep = min(len(data), len(_MARKER_PREFIX) - 1)
+                break
+            if len(data) < pos + _MARKER_SIZE:
+                keep = len(data) - pos
+                break
+            item = self.markers.get(data[pos:pos + _MARKER_SIZE])
+            if item is None:
+                # Префикс не пересекается сам с собой, поэтому следующая
+                # метка может начинаться только после него
+                self.output.write(data[:pos + len(_MARKER_PREFIX)])
+                data = data[pos + len(_MARKER_PREFIX):]
+                continue
+            self.output.write(data[:pos])
+            for chunk in item.iter_base64():
+                self.output.write(chunk)
+            data = data[pos + _MARKER_SIZE:]
+
+        if len(data) > keep:
+            self.output.write(data[:len(data) - keep])
+        self.pending = data[len(data) - keep:]
+
+    def close(self):
+        if self.pending:
+            self.output.write(self.pending)
+            self.pending = ''
+
+
+@contextmanager
+def _binary_data_markers(binary_data):
+    u'''
+    Временная замена текста элементов BinaryData уникальными метками.
+    '''
+    markers = {}
+    saved = []
+    try:
+        for item in binary_data:
+            if item.element is None:
+                continue
+            marker = _MARKER_PREFIX + uuid.uuid4().hex
+            markers[marker] = item
+            saved.append((item.element, item.element.text))
+            item.element.text = marker
+        yield markers
+    finally:
+        for element, text in saved:
+            element.text = text
+
+
+def _get_binary_data(envelope, binary_data):
+    if binary_data is None:
+        binary_data = getattr(envelope, 'binary_data_files', None)
+    return binary_data or []
+
+
+def write_c14n(tag, output, binary_data=None):
+    u'''
+    Запись исключительной каноникализированной формы дерева XML-элементов
+    с подстановкой содержимого вложений.
+
+    :param lxml.Element tag: Корень дерева XML-элементов.
+    :param output: Файлоподобный объект, в который записываются данные.
+    :param list binary_data: Вложения (BinaryDataFile, BinaryDataSource).
+    '''
+    with _binary_data_markers(binary_data or []) as markers:
+        writer = _SpliceWriter(output, markers)
+        etree.ElementTree(tag).write_c14n(writer, exclusive=True, with_comments=False)
+        writer.close()
+
+
+def write_envelope(envelope, output, binary_data=None, encoding='utf-8',
+                   xml_declaration=True):
+    u'''
+    Запись сообщения в файл или сокет с подстановкой содержимого вложений
+    по частям, без сборки сообщения в одну строку.
+
+    На время записи текст элементов BinaryData заменяется метками, поэтому
+    одновременная запись одного и того же дерева из разных потоков
+    недопустима.
+
+    :param envelope: Записываемое сообщение.
+    :type envelope: lxml.Element or EnvelopeView
+    :param output: Файлоподобный объект, в который записывается сообщение.
+    :param list binary_data: Вложения (по умолчанию - вложения
+                             StreamedEnvelope).
+    :param str encoding: Кодировка.
+    :param bool xml_declaration: Флаг записи объявления XML.
+    '''
+    view = EnvelopeView.of(envelope)
+    with _binary_data_markers(_get_binary_data(view, binary_data)) as markers:
+        writer = _SpliceWriter(output, markers)
+        etree.ElementTree(view.envelope).write(
+            writer, encoding=encoding, xml_declaration=xml_declaration)
+        writer.close()
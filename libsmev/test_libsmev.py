@@ -7,16 +7,45 @@ import uuid
 import unittest
 import os
 import zipfile
+import tempfile
+import sqlite3
+import threading
+import hashlib
+import time
+import errno
+import stat
+import socket
+import struct
+import multiprocessing
 
 from lxml import etree
 from mimetypes import types_map
 from tempfile import NamedTemporaryFile, mkdtemp
+from multiprocessing.pool import ThreadPool
 
-from skeleton import construct_smev_envelope
-from helpers import dict_to_xmldoc, extract_smev_parts
+from skeleton import construct_smev_envelope, extract_context_from_envelope, convert_smev_request
+from helpers import dict_to_xmldoc, extract_smev_parts, EnvelopeView, Fault
 from namespaces import NS_MAP
-from signer import sign_document, verify_envelope_signature, get_text_digest
-from attachments import encode_directory, extract_directory
+from helpers import run_cmd, configure_coprocess_pool, PipeInput, compile_xpath, tags, \
+    parse_xml_string, get_parser, configure_parser, PARSER_OPTIONS
+from signer import sign_document, verify_envelope_signature, get_text_digest, Signer, \
+    verify_gost94_signature, SignerError, PubkeyCache, verify_envelopes, \
+    sign_documents, get_c14n_digest, c14n_tags, construct_wsse_header, \
+    get_file_digest, get_file_digests, configure_crypto_backend, get_crypto_backend, \
+    get_text_signature_with_key, decrypt_private_key, load_pubkey_from_pem, load_cert_from_pem, \
+    new_hasher
+import gost94
+import helpers
+import signer
+import crypto
+import signing_service
+from signing_service import SigningServer, SigningClient, MAX_ITEMS, MAX_MESSAGE_SIZE
+from crypto import CliBackend, LibcryptoBackend, FakeBackend, CryptoError, _split_digest_cmds, \
+    DIGEST_SPOOL_SIZE
+from coprocess import CoprocessError
+from streaming import parse_envelope_stream, write_envelope, BinaryDataSource, StreamedEnvelope
+from attachments import encode_directory, extract_directory, encode_directory_stream, \
+    InvalidFileDigestException, AttachmentArchive, DigestCache, configure_digest_cache
 
 # Тестовый ключ
 PEM = r'''
@@ -85,6 +114,64 @@ class TestHelpersFunctions(unittest.TestCase):
             self.assertEquals(inf_node[0].text, val)
 
 
+    def test_compile_xpath(self):
+        path = '/SOAP-ENV:Envelope/SOAP-ENV:Body'
+        self.assertTrue(compile_xpath(path) is compile_xpath(path, NS_MAP))
+        self.assertEquals(tags(self.envelope, path), self.envelope.xpath(path, namespaces=NS_MAP))
+
+        custom = {'e': NS_MAP['SOAP-ENV']}
+        self.assertTrue(compile_xpath('e:Body', custom) is compile_xpath('e:Body', dict(custom)))
+        self.assertEquals(len(tags(self.envelope, 'e:Body', custom)), 1)
+
+        # У каждого потока свой реестр
+        compiled = []
+        thread = threading.Thread(target=lambda: compiled.append(compile_xpath(path)))
+        thread.start()
+        thread.join()
+        assert compiled[0] is not compile_xpath(path)
+
+        # При переполнении вытесняются давно не использовавшиеся выражения
+        size, helpers.XPATH_REGISTRY_SIZE = helpers.XPATH_REGISTRY_SIZE, 4
+        try:
+            hot = compile_xpath(path)
+            cold = compile_xpath('e:Body[0]', custom)
+            for index in range(1, 8):
+                assert compile_xpath(path) is hot
+                compile_xpath('e:Body[%d]' % index, custom)
+            assert compile_xpath('e:Body[0]', custom) is not cold
+        finally:
+            helpers.XPATH_REGISTRY_SIZE = size
+
+    def test_thread_local_parsers(self):
+        from threading import Thread
+
+        parsers = []
+        def parse():
+            parsers.append(get_parser())
+            parse_xml_string(TEST_ENVELOPE)
+
+        threads = [Thread(target=parse) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(parsers), 2)
+        assert parsers[0] is not parsers[1]
+        assert get_parser() is get_parser()
+
+    def test_configure_parser(self):
+        options = dict(PARSER_OPTIONS)
+        parser = get_parser()
+        try:
+            configure_parser(huge_tree=True)
+            assert get_parser() is not parser
+        finally:
+            configure_parser(**options)
+
+        # Внешние сущности не подставляются
+        doc = parse_xml_string('<!DOCTYPE a [<!ENTITY e SYSTEM "file:///etc/passwd">]><a>&e;</a>')
+        self.assertEquals(doc.text, None)
+
     def test_extract_smev_parts(self):
         parts = extract_smev_parts(self.envelope)
         assert len(parts) == 4, "Too many or too few parts returned."
@@ -148,6 +235,399 @@ class TestSkeletonFunction(unittest.TestCase):
             self.assertEquals(node[0].text, val)
 
 
+def openssl_has_gost():
+    try:
+        out, err = run_cmd(['openssl', 'dgst', '-binary', '-md_gost94'], input='')
+    except OSError:
+        return False
+    return not err
+
+
+def setUpModule():
+    # Без поддержки ГОСТ в OpenSSL хэш-коды больших данных и ЭП
+    # вычисляются имитацией криптографического модуля
+    if not openssl_has_gost():
+        configure_crypto_backend(FakeBackend())
+
+
+def tearDownModule():
+    configure_crypto_backend(None)
+
+
+def make_signer(test, signer_class=Signer):
+    # Подписание тестовым ключом; файл ключа и пулы подписания
+    # освобождаются по завершении теста
+    key_file = NamedTemporaryFile(delete=False)
+    key_file.write(PEM)
+    key_file.close()
+    test.addCleanup(os.remove, key_file.name)
+    signer = signer_class(key_file.name, PEM_PASS)
+    test.addCleanup(signer.close)
+    return signer
+
+
+# Тестовые векторы ГОСТ Р 34.11-94 с параметрами CryptoPro
+GOST94_VECTORS = (
+    ('', '981e5f3ca30c841487830f84fb433e13ac1101569b9c13584ac483234cd656c0'),
+    ('a', 'e74c52dd282183bf37af0079c9f78055715a103f17e3133ceff1aacf2f403011'),
+    ('abc', 'b285056dbf18d7392d7677369524dd14747459ed8143997e163b2986f92fd42c'),
+    ('message digest', 'bc6041dd2aa401ebfa6e9886734174febdb4729aa972d60f549ac39b29721ba0'),
+    ('The quick brown fox jumps over the lazy dog',
+     '9004294a361a508c586fe53d1f1b02746765e71b765472786e4770d565830a76'),
+)
+
+
+class TestCoprocessPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = configure_coprocess_pool(size=2)
+
+    def test_run_cmd(self):
+        self.assertEquals(run_cmd(['cat'], input='Hello, world'), ('Hello, world', ''))
+        out, err = run_cmd(['sh', '-c', 'echo oops >&2'])
+        self.assertEquals((out, err), ('', 'oops\n'))
+        self.assertRaises(OSError, run_cmd, ['/nonexistent/command'])
+
+    def test_pipe_input(self):
+        large = str(uuid.uuid4()) * 10000
+        for pool_size in (0, 1):
+            configure_coprocess_pool(size=pool_size)
+            out, err = run_cmd(['cat', PipeInput('small'), '-', PipeInput(large)], input='stdin')
+            self.assertEquals(out, 'small' + 'stdin' + large)
+
+    def test_restart_on_crash(self):
+        # Команды запускаются исполнителем напрямую, поэтому $PPID
+        # команды - это процесс-исполнитель. Простаивающие исполнители
+        # завершаются в фоне уже после выдачи результата.
+        for _ in range(self.pool.size):
+            run_cmd(['sh', '-c', '(sleep 0.1; kill -9 $PPID) >/dev/null 2>&1 &'])
+        time.sleep(0.5)
+        for i in range(self.pool.size + 1):
+            self.assertEquals(run_cmd(['cat'], input=str(i)), (str(i), ''))
+
+        # Исполнитель аварийно завершился во время выполнения задания:
+        # задание повторяется на перезапущенном исполнителе
+        marker = os.path.join(mkdtemp(), 'crashed')
+        try:
+            crash_once = 'if [ ! -e "$0" ]; then touch "$0"; kill -9 $PPID; fi; cat'
+            for i in range(self.pool.size + 1):
+                self.assertEquals(run_cmd(['sh', '-c', crash_once, marker], input=str(i)),
+                                  (str(i), ''))
+            self.assertTrue(os.path.exists(marker))
+        finally:
+            shutil.rmtree(os.path.dirname(marker))
+
+        # Повторно завершившееся задание не повторяется бесконечно
+        self.assertRaises(CoprocessError, run_cmd, ['sh', '-c', 'kill -9 $PPID'])
+        self.assertEquals(run_cmd(['cat'], input='alive'), ('alive', ''))
+
+    def test_concurrent_pipe_input(self):
+        # Команды, одновременно запускаемые из разных потоков, не должны
+        # наследовать каналы друг друга (иначе cat не дождется конца данных)
+        configure_coprocess_pool(size=0)
+        large = str(uuid.uuid4()) * 10000
+        results = []
+
+        def run():
+            for _ in range(5):
+                results.append(run_cmd(['cat', PipeInput(large)], timeout=30))
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, [(large, '')] * 40)
+
+    def test_timeout(self):
+        for pool_size in (0, 1):
+            configure_coprocess_pool(size=pool_size)
+            started = time.time()
+            try:
+                run_cmd(['sleep', '10'], timeout=0.2)
+            except OSError as err:
+                self.assertEquals(err.errno, errno.ETIMEDOUT)
+            else:
+                self.fail('Command was not killed')
+            assert time.time() - started < 5
+            self.assertEquals(run_cmd(['cat'], input='alive', timeout=5), ('alive', ''))
+
+    def test_health_check(self):
+        # Исполнитель опрашивается перед каждым заданием; опрос
+        # не должен нарушать обмен данными с ним
+        self.pool = configure_coprocess_pool(size=2, health_check_interval=0)
+        for i in range(5):
+            self.assertEquals(run_cmd(['cat'], input=str(i)), (str(i), ''))
+        run_cmd(['sh', '-c', '(sleep 0.1; kill -9 $PPID) >/dev/null 2>&1 &'])
+        time.sleep(0.5)
+        for i in range(self.pool.size + 1):
+            self.assertEquals(run_cmd(['cat'], input=str(i)), (str(i), ''))
+
+    def tearDown(self):
+        configure_coprocess_pool(size=0)
+
+
+class TestGost94(unittest.TestCase):
+    def test_vectors(self):
+        for text, hexdigest in GOST94_VECTORS:
+            self.assertEquals(gost94.new(text).hexdigest(), hexdigest)
+
+    def test_incremental_update(self):
+        text = str(uuid.uuid4()) * 37
+        hasher = gost94.new()
+        for pos in range(0, len(text), 7):
+            hasher.update(text[pos:pos + 7])
+        self.assertEquals(hasher.digest(), gost94.new(text).digest())
+
+        copied = hasher.copy()
+        copied.update('tail')
+        self.assertEquals(hasher.digest(), gost94.new(text).digest())
+        self.assertEquals(copied.digest(), gost94.new(text + 'tail').digest())
+
+    def test_envelope_body_digest(self):
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        body = envelope.xpath('//SOAP-ENV:Body', namespaces=NS_MAP)[0]
+        c14n_body = etree.tostring(body, method='c14n', exclusive=True, with_comments=False)
+        self.assertEquals(get_text_digest(c14n_body), 'y1Feix2ktiF64VtgPmEyBtam5yaxkJeGdTcX3bg44h0=')
+
+    def test_c14n_digest(self):
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        body = envelope.xpath('//SOAP-ENV:Body', namespaces=NS_MAP)[0]
+        self.assertEquals(get_c14n_digest(body), 'y1Feix2ktiF64VtgPmEyBtam5yaxkJeGdTcX3bg44h0=')
+
+        binary_data = body.xpath('.//smev:BinaryData', namespaces=NS_MAP)[0]
+        binary_data.text = base64.b64encode(str(uuid.uuid4()) * 3000)
+        self.assertEquals(get_c14n_digest(body), get_text_digest(c14n_tags(body)))
+
+    @unittest.skipIf(not openssl_has_gost(), 'OpenSSL without GOST engine')
+    def test_openssl_compatibility(self):
+        for text in [v[0] for v in GOST94_VECTORS] + [str(uuid.uuid4()) * 100]:
+            out, err = run_cmd(['openssl', 'dgst', '-binary', '-md_gost94'], input=text)
+            self.assertEquals(gost94.new(text).digest(), out)
+
+
+class TestExtractContext(unittest.TestCase):
+    def test_extract_context(self):
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        # Элементы с теми же именами в данных сообщения не учитываются
+        app_data = envelope.xpath('.//smev:AppData', namespaces=NS_MAP)[0]
+        dict_to_xmldoc(app_data, {'__ns__': 'smev', 'Status': 'FAKE'})
+
+        ctx = extract_context_from_envelope(envelope)
+        self.assertEquals(ctx['Sender'], {'Code': 'AAAA11112', 'Name': 'Sender'})
+        self.assertEquals(ctx['Recipient'], {'Code': 'BBBB22222', 'Name': 'Recipient'})
+        self.assertEquals(ctx['Originator'], {'Code': 'AAAA11112', 'Name': 'Originator'})
+        self.assertEquals(ctx['Service'], {'Mnemonic': 'TEST001001', 'Version': '0.10'})
+        self.assertEquals(ctx['Status'], 'REQUEST')
+        self.assertEquals(ctx['TypeCode'], 'GSRV')
+        self.assertEquals(ctx['TestMsg'], True)
+
+    def test_missing_fields(self):
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        test_msg = envelope.xpath('.//smev:TestMsg', namespaces=NS_MAP)[0]
+        test_msg.getparent().remove(test_msg)
+        self.assertEquals(extract_context_from_envelope(envelope)['TestMsg'], None)
+
+
+class TestEnvelopeView(unittest.TestCase):
+    def test_resolve_parts(self):
+        envelope = etree.fromstring(TEST_ENVELOPE)
+        view = EnvelopeView(envelope)
+
+        def find(path):
+            return envelope.xpath(path, namespaces=NS_MAP)[0]
+
+        self.assertEquals(view.header, find('SOAP-ENV:Header'))
+        self.assertEquals(view.body, find('SOAP-ENV:Body'))
+        self.assertEquals(view.security, find('.//wsse:Security'))
+        self.assertEquals(view.token, find('.//wsse:BinarySecurityToken'))
+        self.assertEquals(view.signed_info, find('.//ds:SignedInfo'))
+        self.assertEquals(view.digest_value, find('.//ds:DigestValue'))
+        self.assertEquals(view.signature_value, find('.//ds:SignatureValue'))
+        self.assertEquals(view.message, find('.//smev:Message'))
+        self.assertEquals(view.message_data, find('.//smev:MessageData'))
+        self.assertEquals(view.app_data, find('.//smev:AppData'))
+        assert EnvelopeView.of(view) is view
+
+        parts = extract_smev_parts(view)
+        self.assertEquals(parts, (view.token, view.signature, view.message, view.message_data))
+
+    def test_mutation(self):
+        view = EnvelopeView(etree.fromstring(TEST_ENVELOPE))
+        message = view.message
+
+        # Перемещенное сообщение ищется заново
+        operation = message.getparent()
+        operation.remove(message)
+        self.assertEquals(view.message, None)
+        operation.append(message)
+        self.assertEquals(view.message, message)
+
+        # Вместе с заголовком пропадает и все его содержимое
+        view.envelope.remove(view.header)
+        self.assertEquals(view.security, None)
+        self.assertEquals(view.token, None)
+
+    def test_pipeline(self):
+        ctx = extract_context_from_envelope(etree.fromstring(TEST_ENVELOPE))
+        view = EnvelopeView(construct_smev_envelope('TestPacket', ctx))
+        self.assertEquals(view.security, None)
+
+        signer = make_signer(self)
+        signed, = signer.sign_many([view], workers=2)
+        assert signed is view.envelope
+        self.assertEquals(view.token.text, signer.certificate)
+        assert verify_envelope_signature(signed)
+        self.assertEquals(extract_context_from_envelope(view), ctx)
+
+        converted = convert_smev_request(view, '2.5.6', '2.5.5')
+        assert converted is view.envelope
+        self.assertEquals(view.message.findtext('{%s}ServiceName' % NS_MAP['smev']), 'TEST001001')
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.payload = os.urandom(3000)
+        self.envelope = TEST_ENVELOPE.replace(
+            '<smev:BinaryData/>',
+            '<smev:BinaryData>%s</smev:BinaryData>' % base64.encodestring(self.payload))
+
+    def test_parse_envelope_stream(self):
+        with parse_envelope_stream(StringIO.StringIO(self.envelope)) as streamed:
+            binary_data = streamed.get_binary_data()
+            self.assertEquals(binary_data.size, len(self.payload))
+            self.assertEquals(binary_data.read(), self.payload)
+            assert binary_data.element is streamed.binary_data
+            self.assertEquals(streamed.binary_data.text, None)
+
+            # Остальная часть дерева совпадает с обычным разбором
+            streamed.binary_data.text = base64.encodestring(self.payload)
+            assert c14n_tags(streamed.envelope) == c14n_tags(etree.fromstring(self.envelope))
+            self.assertEquals(extract_context_from_envelope(streamed)['Status'], 'REQUEST')
+
+    def test_streamed_body_digest(self):
+        envelope = etree.fromstring(self.envelope)
+        with parse_envelope_stream(self.envelope) as streamed:
+            self.assertEquals(get_c14n_digest(streamed.body, streamed.binary_data_files),
+                              get_c14n_digest(envelope[1]))
+
+            output = StringIO.StringIO()
+            write_envelope(streamed, output)
+            assert c14n_tags(etree.fromstring(output.getvalue())) == c14n_tags(envelope)
+            self.assertEquals(streamed.binary_data.text, None)
+
+    def test_binary_data_source(self):
+        def chunks():
+            for pos in range(0, len(self.payload), 1000):
+                yield self.payload[pos:pos + 1000]
+
+        source = BinaryDataSource(chunks())
+        ctx = extract_context_from_envelope(etree.fromstring(TEST_ENVELOPE))
+        ctx['AppDocument'] = {'RequestCode': 'RC', 'BinaryData': source}
+        envelope = StreamedEnvelope(construct_smev_envelope('TestPacket', ctx), [source])
+        self.assertEquals(envelope.binary_data.text, '')
+
+        # Хэш-код тела вычисляется с подстановкой вложения, при записи
+        # используются сохраненные данные итератора
+        make_signer(self).sign_many([envelope], workers=2)
+        output = StringIO.StringIO()
+        write_envelope(envelope, output)
+
+        written = etree.fromstring(output.getvalue())
+        written_view = EnvelopeView(written)
+        self.assertEquals(base64.b64decode(written_view.binary_data.text), self.payload)
+        self.assertEquals(written_view.digest_value.text, get_c14n_digest(written_view.body))
+
+        # Частично прочитанный итератор не выдает неполные данные повторно
+        source = BinaryDataSource(chunks())
+        next(source.iter_base64())
+        self.assertRaises(ValueError, source.iter_base64)
+
+    def test_marker_like_text(self):
+        source = BinaryDataSource(StringIO.StringIO(self.payload))
+        ctx = extract_context_from_envelope(etree.fromstring(TEST_ENVELOPE))
+        ctx['AppDocument'] = {'RequestCode': 'RC', 'BinaryData': source}
+        envelope = StreamedEnvelope(construct_smev_envelope('TestPacket', ctx), [source])
+        text = 'libsmev-binary-data-' + 'f' * 32 + ' libsmev-binary-data-'
+        etree.SubElement(envelope.app_data, 'Note').text = text
+
+        output = StringIO.StringIO()
+        write_envelope(envelope, output)
+        written_view = EnvelopeView(etree.fromstring(output.getvalue()))
+        self.assertEquals(written_view.app_data.find('Note').text, text)
+        self.assertEquals(base64.b64decode(written_view.binary_data.text), self.payload)
+
+    def test_invalid_binary_data(self):
+        self.assertRaises(Fault, parse_envelope_stream, self.envelope.replace(
+            '</smev:BinaryData>', 'Q</smev:BinaryData>'))
+        self.assertRaises(Fault, parse_envelope_stream, self.envelope[:-50])
+
+    def test_untrusted_input(self):
+        declaration, envelope = self.envelope.split('\n', 1)
+
+        # Внешние сущности не подставляются
+        secret = NamedTemporaryFile(delete=False)
+        secret.write('SECRET')
+        secret.close()
+        try:
+            doctype = '<!DOCTYPE SOAP-ENV:Envelope [<!ENTITY xxe SYSTEM "file://%s">]>' % secret.name
+            source = '\n'.join([declaration, doctype, envelope.replace('>Sender<', '>&xxe;<', 1)])
+            with parse_envelope_stream(source) as streamed:
+                assert 'SECRET' not in etree.tostring(streamed.envelope)
+        finally:
+            os.remove(secret.name)
+
+        # Экспоненциальная подстановка сущностей прерывается
+        entities = ['<!ENTITY lol0 "lol">'] + [
+            '<!ENTITY lol%d "%s">' % (level, ('&lol%d;' % (level - 1)) * 10) for level in range(1, 10)]
+        doctype = '<!DOCTYPE SOAP-ENV:Envelope [%s]>' % ''.join(entities)
+        source = '\n'.join([declaration, doctype, envelope.replace('>World<', '>&lol9;<', 1)])
+        self.assertRaises(Fault, parse_envelope_stream, source)
+
+    def test_large_string_source(self):
+        # Текст вложения больше ограничения libxml2 на размер узла (10 МБ)
+        payload = os.urandom(8 * 1024 * 1024)
+        source = TEST_ENVELOPE.replace(
+            '<smev:BinaryData/>',
+            '<smev:BinaryData>%s</smev:BinaryData>' % base64.encodestring(payload))
+        with parse_envelope_stream(source) as streamed:
+            self.assertEquals(streamed.get_binary_data().size, len(payload))
+
+
+class TestEnvelopeTemplates(unittest.TestCase):
+    def setUp(self):
+        self.ctx = {
+            'Service': {'Mnemonic': 'MONR001001', 'Version': '0.10'},
+            'Sender': {'Code': 'SEND01001', 'Name': 'Sender'},
+            'Recipient': {'Code': 'RECV01001', 'Name': 'Recipient'},
+            'Originator': {'Code': 'SEND01001', 'Name': 'Sender'},
+            'TypeCode': 'GSRV',
+            'Status': 'PING',
+        }
+
+    def test_polling_envelopes_are_independent(self):
+        self.ctx['Date'] = 'first'
+        first = construct_smev_envelope('Poll', self.ctx)
+        first.xpath('.//smev:Sender/smev:Name', namespaces=NS_MAP)[0].text = 'Changed'
+
+        self.ctx['Date'] = 'second'
+        second = construct_smev_envelope('Poll', self.ctx)
+        self.assertEquals(second.xpath('.//smev:Sender/smev:Name', namespaces=NS_MAP)[0].text, 'Sender')
+        self.assertEquals(second.xpath('.//smev:Date', namespaces=NS_MAP)[0].text, 'second')
+        self.assertEquals(first.xpath('.//smev:Date', namespaces=NS_MAP)[0].text, 'first')
+
+    def test_structure_variants(self):
+        self.ctx.update(Status='REQUEST', TestMsg=False, CaseNumber='42',
+                        AppDocument={'RequestCode': 'RC', 'BinaryData': 'QUJD'})
+        envelope = construct_smev_envelope('Packet', self.ctx)
+        self.assertEquals(envelope.xpath('.//smev:TestMsg', namespaces=NS_MAP), [])
+        self.assertEquals(envelope.xpath('.//smev:CaseNumber', namespaces=NS_MAP)[0].text, '42')
+        self.assertEquals(envelope.xpath('.//smev:BinaryData', namespaces=NS_MAP)[0].text, 'QUJD')
+
+        del self.ctx['AppDocument']
+        envelope = construct_smev_envelope('Packet', self.ctx)
+        self.assertEquals(envelope.xpath('.//smev:BinaryData', namespaces=NS_MAP)[0].text, None)
+
+
 class TestSigner(unittest.TestCase):
     def setUp(self):
         self.ctx = {
@@ -185,11 +665,337 @@ class TestSigner(unittest.TestCase):
         sender_node.text = 'Impersonator'
         assert not verify_envelope_signature(signed), 'Document was changed, but signature still verifies!'
 
+    def test_verify_with_cache(self):
+        signed = sign_document(self.req, self.tmp_file.name, PEM_PASS)
+        # Пустой кэш тоже используется, а не заменяется pubkey_cache
+        cache = PubkeyCache()
+        assert verify_envelope_signature(signed, cache=cache)
+        self.assertEquals(len(cache), 1)
+
+    def test_verify_envelopes_reports_errors(self):
+        envelopes = [etree.fromstring(TEST_ENVELOPE), self.req, etree.fromstring(TEST_ENVELOPE)]
+        for workers in (1, 2):
+            results = list(verify_envelopes(envelopes, workers=workers))
+            self.assertEquals(len(results), 3)
+            # В неподписанном сообщении нет заголовка WS-Security
+            assert isinstance(results[1], SignerError)
+
+            unordered = sorted(verify_envelopes(envelopes, workers=workers, ordered=False))
+            self.assertEquals([index for index, result in unordered], [0, 1, 2])
+
+    def test_verify_envelopes_window(self):
+        signed = sign_document(self.req, self.tmp_file.name, PEM_PASS)
+        consumed = []
+
+        def iter_envelopes(count):
+            for _ in range(count):
+                consumed.append(1)
+                yield etree.fromstring(etree.tostring(signed))
+
+        # Следующий запрос считывается только при свободном месте в окне
+        results = verify_envelopes(iter_envelopes(6), workers=2, window=2)
+        self.assertEquals(next(results), True)
+        self.assertEquals(len(consumed), 2)
+        self.assertEquals(list(results), [True] * 5)
+
+        del consumed[:]
+        results = verify_envelopes(iter_envelopes(7), workers=2, ordered=False, chunksize=2, window=4)
+        first = next(results)
+        self.assertEquals(len(consumed), 4)
+        results = [first] + list(results)
+        self.assertEquals(sorted(index for index, result in results), range(7))
+        self.assertEquals([result for index, result in results], [True] * 7)
+
+    # TEST_ENVELOPE подписан настоящей ЭП ГОСТ Р 34.10-2001
+    @unittest.skipIf(not openssl_has_gost(), 'OpenSSL without GOST engine')
+    def test_verify_envelopes(self):
+        signed = sign_document(self.req, self.tmp_file.name, PEM_PASS)
+        envelopes = [etree.fromstring(TEST_ENVELOPE), signed] * 4
+        self.assertEquals(list(verify_envelopes(envelopes, workers=2)), [True] * 8)
+
+    def test_wsse_header_template(self):
+        first = construct_wsse_header(certificate='CERT1', digest='DIGEST')
+        second = construct_wsse_header(certificate='CERT2')
+
+        token = first.xpath('wsse:BinarySecurityToken', namespaces=NS_MAP)[0]
+        reference = first.xpath('.//wsse:Reference', namespaces=NS_MAP)[0]
+        self.assertEquals(token.text, 'CERT1')
+        self.assertEquals(reference.attrib['URI'], '#%s' % token.attrib['{%s}Id' % NS_MAP['wsu']])
+        self.assertEquals(first.xpath('.//ds:DigestValue', namespaces=NS_MAP)[0].text, 'DIGEST')
+
+        self.assertEquals(second.xpath('wsse:BinarySecurityToken', namespaces=NS_MAP)[0].text, 'CERT2')
+        self.assertEquals(second.xpath('.//ds:DigestValue', namespaces=NS_MAP)[0].text, None)
+        self.assertNotEquals(reference.attrib['URI'],
+                             second.xpath('.//wsse:Reference', namespaces=NS_MAP)[0].attrib['URI'])
+
+    def test_sign_envelopes_pipeline(self):
+        docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(4)]
+        docs.insert(2, etree.Element('NotAnEnvelope'))
+        docs.append(etree.fromstring(TEST_ENVELOPE))
+
+        signed = []
+
+        class CountingSigner(Signer):
+            def get_text_signature(self, text):
+                signed.append(text)
+                return super(CountingSigner, self).get_text_signature(text)
+
+        signer = make_signer(self, CountingSigner)
+        results = signer.sign_many(docs, workers=2)
+        self.assertEquals(len(results), 6)
+        assert isinstance(results[2], Exception)
+        for doc in results[:2] + results[3:]:
+            assert verify_envelope_signature(doc)
+
+        # Следующий документ считывается только при свободном месте в окне
+        def iter_docs(docs, window):
+            for index, doc in enumerate(docs):
+                assert len(signed) >= index - window
+                yield doc
+
+        del signed[:]
+        docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(6)]
+        results = signer.sign_many(iter_docs(docs, 2), workers=2, window=2)
+        self.assertEquals(results, docs)
+        self.assertEquals(len(signed), 6)
+
+    def test_sign_documents(self):
+        docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(4)]
+        for doc in sign_documents(docs, self.tmp_file.name, PEM_PASS, workers=2):
+            assert verify_envelope_signature(doc)
+
+    def test_verify_without_temp_files(self):
+        tmp_dir = mkdtemp()
+        old_tmp_dir, tempfile.tempdir = tempfile.tempdir, tmp_dir
+        try:
+            try:
+                verify_gost94_signature('text', 'not a key', base64.b64encode('not a signature'))
+            except SignerError:
+                pass
+            self.assertEquals(os.listdir(tmp_dir), [])
+        finally:
+            tempfile.tempdir = old_tmp_dir
+            shutil.rmtree(tmp_dir)
+
+    def test_signer(self):
+        signer = Signer(self.tmp_file.name, PEM_PASS)
+        req2 = construct_smev_envelope('TestPacket', self.ctx)
+        signed = signer.sign_many([self.req, req2])
+        for doc in signed:
+            assert verify_envelope_signature(doc), 'Signer produced invalid signature'
+
+        # Пулы конвейерного подписания используются повторно
+        with signer:
+            docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(3)]
+            self.assertEquals(signer.sign_many(docs, workers=2), docs)
+            children = set(multiprocessing.active_children())
+            signer.sign_many([construct_smev_envelope('TestPacket', self.ctx)], workers=2)
+            self.assertEquals(set(multiprocessing.active_children()), children)
+        self.assertEquals(multiprocessing.active_children(), [])
+
+        # После закрытия пулы запускаются заново
+        docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(2)]
+        with signer:
+            self.assertEquals(signer.sign_many(docs, workers=2), docs)
+
+    def test_signing_service(self):
+        socket_dir = mkdtemp()
+        socket_path = os.path.join(socket_dir, 'sign.sock')
+        connections = []
+
+        class CountingServer(SigningServer):
+            def verify_request(self, request, client_address):
+                connections.append(request)
+                return True
+
+        server = CountingServer(socket_path, Signer(self.tmp_file.name, PEM_PASS), workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            signed = sign_document(self.req, socket_path=socket_path)
+            assert verify_envelope_signature(signed), 'Signing service produced invalid signature'
+            # Соединение sign_document используется повторно
+            signed = sign_document(construct_smev_envelope('TestPacket', self.ctx), socket_path=socket_path)
+            assert verify_envelope_signature(signed)
+            self.assertEquals(len(connections), 1)
+
+            docs = [construct_smev_envelope('TestPacket', self.ctx) for _ in range(3)]
+            docs.insert(1, etree.Element('NotAnEnvelope'))
+            with SigningClient(socket_path) as client:
+                results = client.sign_many(docs)
+                self.assertEquals(client.get_text_signature('text'),
+                                  Signer(self.tmp_file.name, PEM_PASS).get_text_signature('text'))
+            assert isinstance(results[1], Exception)
+            for doc in results[:1] + results[2:]:
+                assert verify_envelope_signature(doc)
+
+            self.assertEquals(stat.S_IMODE(os.stat(socket_path).st_mode), 0600)
+            self.assertEquals(os.listdir(socket_dir), ['sign.sock'])
+
+            # Сообщение сверх ограничений закрывает соединение
+            for header in (struct.pack('>I', MAX_ITEMS + 1),
+                           struct.pack('>II', 1, MAX_MESSAGE_SIZE + 1)):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(socket_path)
+                sock.sendall(header)
+                self.assertEquals(sock.recv(1), '')
+                sock.close()
+
+            # Большой пакет передается несколькими запросами
+            max_items, signing_service.MAX_ITEMS = signing_service.MAX_ITEMS, 3
+            try:
+                with SigningClient(socket_path) as client:
+                    signatures = client.get_text_signatures(['a', 'b', 'c', 'd', 'e'])
+                self.assertEquals(signatures[4], client.get_text_signature('e'))
+            finally:
+                signing_service.MAX_ITEMS = max_items
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(socket_dir)
+        self.assertRaises(SignerError, SigningClient(socket_path).get_text_signature, 'text')
 
     def tearDown(self):
         os.remove(self.tmp_file.name)
 
 
+class TestCryptoBackends(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.key_fn = os.path.join(self.directory, 'key.pem')
+        self.cert_fn = os.path.join(self.directory, 'cert.pem')
+        self.enc_key_fn = os.path.join(self.directory, 'enc_key.pem')
+        run_cmd(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                 '-subj', '/CN=libsmev', '-keyout', self.key_fn, '-out', self.cert_fn])
+        run_cmd(['openssl', 'pkey', '-in', self.key_fn, '-aes128', '-passout', 'pass:secret',
+                 '-out', self.enc_key_fn])
+        with open(self.cert_fn) as f:
+            self.certificate = f.read()
+        with open(self.enc_key_fn) as f:
+            self.encrypted_key = f.read()
+
+    def test_backends(self):
+        cli, libcrypto = CliBackend('sha256'), LibcryptoBackend('sha256', engine=None)
+        public_key = cli.extract_public_key(self.certificate)
+        self.assertEquals(libcrypto.extract_public_key(self.certificate), public_key)
+
+        for backend in (cli, libcrypto):
+            self.assertEquals(backend.digest('abc'), hashlib.sha256('abc').digest())
+            self.assertEquals(backend.file_digests([self.cert_fn]),
+                              {self.cert_fn: hashlib.sha256(self.certificate).digest()})
+
+            private_key = backend.decrypt_private_key(self.encrypted_key, 'secret')
+            self.assertRaises(CryptoError, backend.decrypt_private_key, self.encrypted_key, 'wrong')
+            signature = backend.sign('text', private_key)
+            self.assertEquals(backend.sign_with_key_file('text', self.enc_key_fn, 'secret'), signature)
+
+            # Подпись проверяется обоими модулями
+            for other in (cli, libcrypto):
+                assert other.verify('text', public_key, signature)
+                assert not other.verify('other text', public_key, signature)
+
+        self.assertRaises(CryptoError, libcrypto.extract_public_key, 'not a certificate')
+
+    def test_cli_stream_digest(self):
+        backend = CliBackend('sha256')
+        # Небольшие данные передаются OpenSSL через stdin, большие -
+        # через временный файл
+        for size in (1000, DIGEST_SPOOL_SIZE + 1000):
+            data = os.urandom(size)
+            digest = backend.new_digest()
+            for pos in xrange(0, size, 300):
+                digest.update(data[pos:pos + 300])
+            self.assertEquals(digest.digest(), hashlib.sha256(data).digest())
+
+        # Ошибка запуска OpenSSL возбуждает CryptoError
+        path, os.environ['PATH'] = os.environ['PATH'], self.directory
+        try:
+            self.assertRaises(CryptoError, backend.digest, 'abc')
+        finally:
+            os.environ['PATH'] = path
+
+    @unittest.skipIf(openssl_has_gost(), 'OpenSSL with GOST engine')
+    def test_libcrypto_without_engine(self):
+        self.assertRaises(CryptoError, LibcryptoBackend().digest, 'abc')
+
+    def test_digest_threshold(self):
+        backend = get_crypto_backend()
+        # Хэш-коды, вычисленные модулем, отличаются от ГОСТ Р 34.11-94
+        configure_crypto_backend(CliBackend('sha256'))
+        try:
+            small = 'a' * signer.BUILTIN_DIGEST_MAX_SIZE
+            large = small + 'b'
+            expected = {small: gost94.new(small).digest(), large: hashlib.sha256(large).digest()}
+            for text in (small, large):
+                self.assertEquals(get_text_digest(text), base64.b64encode(expected[text]))
+                hasher = new_hasher()
+                for i in xrange(0, len(text), 10000):
+                    hasher.update(text[i:i + 10000])
+                self.assertEquals(hasher.digest(), expected[text])
+
+                fn = os.path.join(self.directory, str(len(text)))
+                with open(fn, 'wb') as f:
+                    f.write(text)
+                self.assertEquals(get_file_digests([fn]), {fn: base64.b64encode(expected[text])})
+
+            # Модуль, работающий в текущем процессе, вычисляет все хэш-коды
+            configure_crypto_backend(LibcryptoBackend('sha256', engine=None))
+            self.assertEquals(get_text_digest('abc'), base64.b64encode(hashlib.sha256('abc').digest()))
+        finally:
+            configure_crypto_backend(backend)
+
+    def test_fake_backend(self):
+        backend = get_crypto_backend()
+        assert isinstance(configure_crypto_backend(None), CliBackend)
+        configure_crypto_backend(FakeBackend())
+        try:
+            self.assertEquals(get_crypto_backend().digest('abc'), gost94.new('abc').digest())
+            signature = get_text_signature_with_key('text', decrypt_private_key(PEM, PEM_PASS))
+            public_key = load_pubkey_from_pem(load_cert_from_pem(PEM).join(
+                ['-----BEGIN CERTIFICATE-----\n', '\n-----END CERTIFICATE-----']))
+            assert verify_gost94_signature('text', public_key, signature)
+            assert not verify_gost94_signature('other text', public_key, signature)
+        finally:
+            configure_crypto_backend(backend)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestPubkeyCache(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+
+    def loader(self, pem):
+        self.loaded.append(pem)
+        return 'KEY %d' % len(self.loaded)
+
+    def test_hits_and_misses(self):
+        cache = PubkeyCache(maxsize=2)
+        self.assertEquals(cache.get('AAAA', self.loader), 'KEY 1')
+        self.assertEquals(cache.get('AA\nAA', self.loader), 'KEY 1')
+        self.assertEquals(cache.get('BBBB', self.loader), 'KEY 2')
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+        assert '-----BEGIN CERTIFICATE-----' in self.loaded[0]
+
+    def test_lru_eviction(self):
+        cache = PubkeyCache(maxsize=2)
+        cache.get('AAAA', self.loader)
+        cache.get('BBBB', self.loader)
+        cache.get('AAAA', self.loader)
+        cache.get('CCCC', self.loader)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('AAAA', self.loader), 'KEY 1')
+        self.assertEquals(cache.get('BBBB', self.loader), 'KEY 4')
+
+    def test_ttl(self):
+        cache = PubkeyCache(ttl=0)
+        cache.get('AAAA', self.loader)
+        self.assertEquals(cache.get('AAAA', self.loader), 'KEY 2')
+        self.assertEquals(cache.hits, 0)
+
+
 class TestAttachments(unittest.TestCase):
     def setUp(self):
         self.directory = mkdtemp()
@@ -252,6 +1058,295 @@ class TestAttachments(unittest.TestCase):
             else:
                 assert doc_info['Type'] == 'application/octet-stream', 'File without extension not classified as octet-stream!'
 
+    def test_parallel_digests(self):
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        for index in range(5):
+            with open(os.path.join(self.directory, 'sub', '%s.txt' % index), 'w') as f:
+                f.write(str(uuid.uuid4()) * (index + 1))
+
+        def archive(workers, pool=None):
+            req_code, encoded_zip = encode_directory(self.directory, workers=workers, pool=pool)
+            zip_arc = zipfile.ZipFile(StringIO.StringIO(base64.b64decode(encoded_zip)), 'r')
+            names = zip_arc.namelist()
+            manifest = zip_arc.read('req_%s.xml' % req_code)
+            return names[:-2], [zip_arc.read(name) for name in names[:-2]], manifest
+
+        self.assertEquals(archive(1), archive(3))
+
+        # Пул вызывающего кода используется повторно и не закрывается
+        pool = ThreadPool(2)
+        try:
+            self.assertEquals(archive(1), archive(1, pool))
+            self.assertEquals(archive(1), archive(1, pool))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_encode_directory_stream(self):
+        req_code, source = encode_directory_stream(self.directory, workers=1, max_size=1024)
+        chunks = list(source.iter_base64())
+        assert max(len(chunk) for chunk in chunks) <= 4 * 64 * 1024 / 3 + 4
+        encoded_zip = ''.join(chunks)
+        self.assertEquals(''.join(source.iter_base64()), encoded_zip)
+
+        manifest, extracted_to = extract_directory(req_code, encoded_zip)
+        try:
+            self.assertEquals(sorted(os.listdir(extracted_to)), sorted(self.files))
+        finally:
+            shutil.rmtree(extracted_to)
+
+        # Архив подставляется в сообщение при записи
+        ctx = extract_context_from_envelope(etree.fromstring(TEST_ENVELOPE))
+        ctx['AppDocument'] = {'RequestCode': req_code, 'BinaryData': source}
+        with StreamedEnvelope(construct_smev_envelope('TestPacket', ctx), [source]) as envelope:
+            output = StringIO.StringIO()
+            write_envelope(envelope, output)
+        written = EnvelopeView(etree.fromstring(output.getvalue()))
+        self.assertEquals(written.binary_data.text, encoded_zip)
+
+    def test_extract_stream(self):
+        req_code, encoded_zip = encode_directory(self.directory)
+
+        # Файловый объект с base64 и вложение из потокового разбора
+        sources = [StringIO.StringIO(encoded_zip), BinaryDataSource(StringIO.StringIO(encoded_zip), encoded=True)]
+        for source in sources:
+            manifest, extracted_to = extract_directory(req_code, source)
+            try:
+                self.assertEquals(sorted(os.listdir(extracted_to)), sorted(self.files))
+                with open(os.path.join(extracted_to, self.files[0])) as f:
+                    self.assertEquals(f.read(), self.example_text)
+            finally:
+                shutil.rmtree(extracted_to)
+
+        # Содержимое файла не соответствует манифесту
+        zip_arc = zipfile.ZipFile(StringIO.StringIO(base64.b64decode(encoded_zip)), 'r')
+        output = StringIO.StringIO()
+        corrupted = zipfile.ZipFile(output, 'w')
+        for name in zip_arc.namelist():
+            corrupted.writestr(name, 'corrupted' if name == self.files[0] else zip_arc.read(name))
+        corrupted.close()
+
+        extracted_to = mkdtemp()
+        try:
+            self.assertRaises(InvalidFileDigestException, extract_directory,
+                              req_code, base64.b64encode(output.getvalue()), extracted_to)
+        finally:
+            shutil.rmtree(extracted_to)
+
+    def test_attachment_archive(self):
+        req_code, encoded_zip = encode_directory(self.directory)
+
+        with AttachmentArchive(req_code, encoded_zip) as archive:
+            self.assertEquals(len(archive.documents), 2 * len(self.files))
+            fn = self.files[0]
+            assert fn in archive and '%s.sig' % fn in archive
+            self.assertEquals(archive.get_document(fn)['DigestValue'], self.example_hash)
+            self.assertRaises(KeyError, archive.open, 'missing')
+
+            f = archive.open(fn)
+            self.assertEquals(f.read(), self.example_text)
+            f.close()
+            self.assertEquals(archive.open('%s.sig' % fn).read(), self.example_hash)
+
+            path_to_file = archive.extract(self.files[1])
+            with open(path_to_file) as f:
+                self.assertEquals(f.read(), self.example_text)
+        assert not os.path.exists(path_to_file)
+
+        # Хэш-код проверяется при обращении к файлу
+        archive = AttachmentArchive(req_code, encoded_zip)
+        try:
+            archive.documents[self.files[0]]['DigestValue'] = self.example_sig_hash
+            archive.open(self.files[1]).close()
+            archive.open(self.files[0], verify=False).close()
+            self.assertRaises(InvalidFileDigestException, archive.open, self.files[0])
+        finally:
+            archive.close()
+
+    @unittest.skipIf(not os.path.isdir('/proc/self/fd'), 'No /proc/self/fd')
+    def test_corrupt_manifest(self):
+        # Архив больше SPOOL_MAX_SIZE декодируется во временный файл
+        archive = StringIO.StringIO()
+        zip_arc = zipfile.ZipFile(archive, 'w')
+        zip_arc.writestr('req_code.xml', '<broken')
+        zip_arc.writestr('data.bin', os.urandom(2 * 1024 * 1024))
+        zip_arc.close()
+        encoded = StringIO.StringIO(base64.b64encode(archive.getvalue()))
+
+        # Файл закрывается, если манифест не разбирается (а не при
+        # удалении объекта, на который ссылается трассировка исключения)
+        fds = len(os.listdir('/proc/self/fd'))
+        try:
+            AttachmentArchive('code', encoded)
+        except Fault:
+            self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+        else:
+            self.fail('Corrupt manifest was parsed')
+
+    def test_digest_cache(self):
+        db_path = os.path.join(mkdtemp(), 'digests.db')
+        try:
+            cache = DigestCache(db_path, max_entries=2)
+            path_to_file = os.path.join(self.directory, self.files[0])
+            # Целое время изменения восстанавливается без потери точности
+            file_times = (1500000000, 1500000000)
+            os.utime(path_to_file, file_times)
+            self.assertEquals(cache.get_file_digest(path_to_file), self.example_hash)
+
+            # Записанный в кэш хэш-код используется повторно, в т.ч. для
+            # копии файла и другим экземпляром кэша
+            connection = sqlite3.connect(db_path)
+            connection.execute('UPDATE digests SET digest = ?', ('cached',))
+            connection.commit()
+            copy_path = os.path.join(self.directory, 'copy')
+            shutil.copy(path_to_file, copy_path)
+            self.assertEquals(cache.get_file_digest(path_to_file), 'cached')
+            self.assertEquals(DigestCache(db_path).get_file_digest(copy_path), 'cached')
+
+            # У каждого пути своя запись
+            self.assertEquals(connection.execute('SELECT COUNT(*) FROM files').fetchone()[0], 2)
+            no_read = DigestCache(db_path, check_content=False)
+            for path in (path_to_file, copy_path):
+                self.assertEquals(no_read.get_file_digest(path), 'cached')
+
+            # Изменение содержимого без изменения размера и времени
+            # обнаруживается только при проверке содержимого: без нее
+            # найденный по атрибутам файл не считывается
+            with open(path_to_file, 'w') as f:
+                f.write(str(uuid.uuid4()))
+            os.utime(path_to_file, file_times)
+            self.assertEquals(no_read.get_file_digest(path_to_file), 'cached')
+            self.assertEquals(cache.get_file_digest(path_to_file), get_file_digest(path_to_file))
+
+            for fn in self.files[1:3]:
+                cache.get_file_digest(os.path.join(self.directory, fn))
+            self.assertEquals(connection.execute('SELECT COUNT(*) FROM digests').fetchone()[0], 2)
+            self.assertEquals(connection.execute('SELECT COUNT(*) FROM files').fetchone()[0], 2)
+            connection.close()
+
+            cache.clear()
+            configure_digest_cache(db_path)
+            try:
+                req_code, encoded_zip = encode_directory(self.directory, workers=2)
+                shutil.rmtree(extract_directory(req_code, encoded_zip)[1])
+            finally:
+                configure_digest_cache(None)
+        finally:
+            shutil.rmtree(os.path.dirname(db_path))
+
+    def test_extract_in_memory(self):
+        large_name = 'large.bin'
+        large_text = str(uuid.uuid4()) * 100
+        with open(os.path.join(self.directory, large_name), 'w') as f:
+            f.write(large_text)
+        req_code, encoded_zip = encode_directory(self.directory)
+
+        manifest, files = extract_directory(req_code, encoded_zip, in_memory=True, max_size=1024)
+        self.assertEquals(sorted(files.keys()), sorted(self.files + [large_name]))
+        self.assertEquals(files[self.files[0]], self.example_text)
+        self.assertEquals(files[large_name].read(), large_text)
+        files[large_name].close()
+
+        with AttachmentArchive(req_code, encoded_zip) as archive:
+            self.assertEquals(archive.read('%s.sig' % large_name), get_text_digest(large_text))
+            archive.documents[large_name]['DigestValue'] = self.example_hash
+            self.assertRaises(InvalidFileDigestException, archive.read, large_name, max_size=1024)
+
+        # Криптографический модуль вычисляет хэш-код по мере чтения,
+        # файл не считывается из архива повторно
+        hashed = []
+
+        class CountingDigest(object):
+            def __init__(self, digest):
+                self._digest = digest
+
+            def update(self, data):
+                hashed.append(data)
+                self._digest.update(data)
+
+            def digest(self):
+                return self._digest.digest()
+
+        class CountingBackend(FakeBackend):
+            def new_digest(self):
+                return CountingDigest(super(CountingBackend, self).new_digest())
+
+        old_backend = get_crypto_backend()
+        configure_crypto_backend(CountingBackend())
+        signer.USE_BUILTIN_DIGEST = False
+        try:
+            with AttachmentArchive(req_code, encoded_zip) as archive:
+                self.assertEquals(archive.read(large_name), large_text)
+                self.assertEquals(''.join(hashed), large_text)
+                self.assertEquals(archive.read(large_name), large_text)
+                self.assertEquals(''.join(hashed), large_text)
+                self.assertEquals(archive.digest(large_name),
+                                  archive.documents[large_name]['DigestValue'])
+        finally:
+            signer.USE_BUILTIN_DIGEST = None
+            configure_crypto_backend(old_backend)
+
+    def test_file_digests(self):
+        paths = [os.path.join(self.directory, fn) for fn in self.files]
+        self.assertEquals(get_file_digests(paths), dict((path, self.example_hash) for path in paths))
+
+        cmd = ['openssl', 'dgst', '-binary', '-md_gost94']
+        max_cmd_length = crypto.MAX_CMD_LENGTH
+        crypto.MAX_CMD_LENGTH = 500
+        try:
+            chunks = list(_split_digest_cmds(cmd, paths))
+        finally:
+            crypto.MAX_CMD_LENGTH = max_cmd_length
+        assert len(chunks) > 1
+        self.assertEquals(sum(chunks, []), paths)
+        for chunk in chunks:
+            assert len(' '.join(cmd + chunk)) < 500
+
+    def test_batch_digests(self):
+        calls = []
+
+        class BatchBackend(CliBackend):
+            def file_digests(self, paths):
+                calls.append(paths)
+                return CliBackend.file_digests(self, paths)
+
+        # Файлы больше BUILTIN_DIGEST_MAX_SIZE передаются OpenSSL
+        for fn in self.files:
+            with open(os.path.join(self.directory, fn), 'w') as f:
+                f.write(self.example_text * 100)
+
+        backend = get_crypto_backend()
+        # Хэш-коды, вычисленные модулем, отличаются от ГОСТ Р 34.11-94
+        configure_crypto_backend(BatchBackend('sha256'))
+        try:
+            # При USE_BUILTIN_DIGEST = None хэш-коды вычисляются пакетно
+            # и при формировании, и при распаковке архива
+            req_code, encoded_zip = encode_directory(self.directory)
+            shutil.rmtree(extract_directory(req_code, encoded_zip)[1])
+            self.assertEquals(len(calls), 2)
+            for paths in calls:
+                self.assertEquals(sorted(os.path.basename(path) for path in paths), sorted(self.files))
+
+            # Пакеты распределяются между исполнителями пула
+            del calls[:]
+            req_code, encoded_zip = encode_directory(self.directory, workers=3)
+            self.assertEquals(len(calls), 3)
+            self.assertEquals(sum(len(paths) for paths in calls), len(self.files))
+            shutil.rmtree(extract_directory(req_code, encoded_zip)[1])
+        finally:
+            configure_crypto_backend(backend)
+
+    @unittest.skipIf(not openssl_has_gost(), 'OpenSSL without GOST engine')
+    def test_openssl_file_digests(self):
+        paths = [os.path.join(self.directory, fn) for fn in self.files]
+        signer.USE_BUILTIN_DIGEST = False
+        try:
+            self.assertEquals(get_file_digests(paths), dict((path, self.example_hash) for path in paths))
+            req_code, encoded_zip = encode_directory(self.directory)
+            shutil.rmtree(extract_directory(req_code, encoded_zip)[1])
+        finally:
+            signer.USE_BUILTIN_DIGEST = None
+
     def tearDown(self):
         shutil.rmtree(self.directory)
 
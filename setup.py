@@ -19,6 +19,7 @@ setup(
     long_description=read('README.rst'),
     packages=['libsmev'],
     install_requires=['lxml >= 3.1.0'],
+    python_requires='>=2.7, <3',
     classifiers=(
         'Intended Audience :: Developers',
         'Environment :: Web Environment',
@@ -26,6 +27,7 @@ setup(
         'Natural Language :: English',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 2.7',
         'License :: OSI Approved :: MIT License',
         'Development Status :: 5 - Production/Stable',
     )